@@ -2,15 +2,32 @@ import os
 import json
 import secrets
 from datetime import datetime, date, timedelta, timezone
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file, send_from_directory
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file, send_from_directory, g, abort, session, Response
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.datastructures import MultiDict
 from werkzeug.utils import secure_filename
 from werkzeug.middleware.proxy_fix import ProxyFix
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.orm import Session, defer, joinedload, load_only, selectinload, undefer
+from collections import OrderedDict, namedtuple
+import base64
+import bisect
+import click
+import csv
+import html
 import io
+import math
+import queue
 import re
+import select
+import socket
+import threading
+import time
+import unicodedata
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
@@ -70,6 +87,10 @@ class Client(db.Model):
     has_support = db.Column(db.Boolean, default=False)
     # ✅ NUEVO: horario de soporte — 'lv'=L-V / 'ls'=L-S / 'ld'=L-D
     support_schedule = db.Column(db.String(5), nullable=True)
+    # Horas de soporte remoto al mes; NULL = REMOTE_HOURS_DEFAULT_LIMIT
+    remote_hours_limit = db.Column(db.Float, nullable=True)
+    # Nombre normalizado (sin acentos, minúsculas) para búsquedas indexadas
+    name_search = db.Column(db.String(100), nullable=True, index=True)
 
 class TechProfile(db.Model):
     """Perfil extendido de técnico - datos personales y notas internas del admin"""
@@ -109,10 +130,13 @@ class Stock(db.Model):
     min_stock = db.Column(db.Integer, default=5)
     description = db.Column(db.Text)
     supplier = db.Column(db.String(100), nullable=True)  # ✅ NUEVO CAMPO PROVEEDOR
+    # Nombre normalizado (sin acentos, minúsculas) para búsquedas indexadas
+    name_search = db.Column(db.String(100), nullable=True, index=True)
 
 class Task(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    tech_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    # active_history: los eventos en vivo necesitan el técnico anterior aunque el atributo estuviera expirado
+    tech_id = db.column_property(db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True), active_history=True)
     client_id = db.Column(db.Integer, db.ForeignKey('client.id'), nullable=True)
     client_name = db.Column(db.String(100))
     description = db.Column(db.Text)
@@ -138,7 +162,10 @@ class Task(db.Model):
     signature_data = db.Column(db.Text)
     signature_client_name = db.Column(db.String(100))
     signature_timestamp = db.Column(db.DateTime)
-    
+    # Saber si hay firma sin cargar la imagen (signature_data puede ocupar cientos de KB)
+    has_signature = db.column_property(
+        db.func.coalesce(db.func.length(signature_data), 0) > 0, deferred=True)
+
     # Archivos adjuntos
     attachments = db.Column(db.Text)  # JSON
     
@@ -157,6 +184,16 @@ class Task(db.Model):
     # ✅ NUEVO: Campo para registrar quién creó la tarea (admin que la agendó)
     created_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
 
+    # Agenda del técnico (tech_agenda_query): propias por estado/fecha y sin asignar por estado/fecha
+    __table_args__ = (
+        db.Index('ix_task_tech_status_date', 'tech_id', 'status', 'date'),
+        db.Index('ix_task_status_date_id', 'status', 'date', 'id'),
+        # Listados por cursor (paginate_keyset) sin filtro de estado
+        db.Index('ix_task_date_id', 'date', 'id'),
+        # Historial de servicios de un cliente
+        db.Index('ix_task_client_date_id', 'client_id', 'date', 'id'),
+    )
+
     tech = db.relationship('User', foreign_keys=[tech_id], backref='tasks')
     client = db.relationship('Client', backref='tasks')
     service_type = db.relationship('ServiceType', backref='tasks')
@@ -170,6 +207,19 @@ class TaskTechnician(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
     task = db.relationship('Task', backref=db.backref('extra_technicians', cascade='all, delete-orphan'))
     user = db.relationship('User', backref='extra_tasks')
+    __table_args__ = (
+        db.Index('ix_task_technician_user_task', 'user_id', 'task_id'),
+        db.Index('ix_task_technician_task', 'task_id'),
+    )
+
+class ClientRemoteUsage(db.Model):
+    """Consumo de soporte remoto por cliente y mes (asistencias remotas completadas).
+    Lo mantiene _track_remote_usage en la misma transacción que las tareas."""
+    __tablename__ = 'client_remote_usage'
+    client_id = db.Column(db.Integer, db.ForeignKey('client.id', ondelete='CASCADE'), primary_key=True)
+    year_month = db.Column(db.String(7), primary_key=True)  # AAAA-MM
+    hours = db.Column(db.Float, nullable=False, default=0)
+    sessions = db.Column(db.Integer, nullable=False, default=0)
 
 class Alarm(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -192,6 +242,11 @@ class ClientPayment(db.Model):
     first_payment = db.Column(db.Float, default=0.0)
     created_at = db.Column(db.DateTime, default=datetime.now)
     updated_at = db.Column(db.DateTime, default=datetime.now)
+    # ✅ NUEVO: saldo materializado (lo mantiene refresh_client_balance en cada escritura)
+    paid_total = db.Column(db.Float, default=0.0, nullable=False)
+    pending_total = db.Column(db.Float, default=0.0, nullable=False)
+    status = db.Column(db.String(10), nullable=True)  # 'paid' | 'pending' | 'none'
+    __table_args__ = (db.Index('ix_client_payment_status_pending', 'status', 'pending_total'),)
 
 class PaymentRecord(db.Model):
     """Cobro parcial registrado para un cliente"""
@@ -217,10 +272,445 @@ class TimerSession(db.Model):
     user = db.relationship('User', backref='timer_sessions')
     task = db.relationship('Task', backref='timer_sessions')
 
+class StockMovement(db.Model):
+    """Movimiento de stock: cantidad con signo (negativa = salida) y su origen"""
+    id = db.Column(db.Integer, primary_key=True)
+    stock_id = db.Column(db.Integer, db.ForeignKey('stock.id', ondelete='CASCADE'), nullable=False)
+    task_id = db.Column(db.Integer, db.ForeignKey('task.id', ondelete='SET NULL'), nullable=True, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='SET NULL'), nullable=True)
+    quantity = db.Column(db.Integer, nullable=False)
+    action = db.Column(db.String(20), nullable=False)  # usar, retirar, devolver, ajuste, importacion
+    created_at = db.Column(db.DateTime, default=datetime.now, nullable=False, index=True)
+    task = db.relationship('Task')
+    __table_args__ = (db.Index('ix_stock_movement_stock_created', 'stock_id', 'created_at'),)
+
+class StockForecast(db.Model):
+    """Previsión de consumo por artículo (calculada por refresh_stock_forecast)"""
+    stock_id = db.Column(db.Integer, db.ForeignKey('stock.id', ondelete='CASCADE'), primary_key=True)
+    daily_rate = db.Column(db.Float, default=0.0)          # unidades consumidas por día
+    days_of_cover = db.Column(db.Float, nullable=True)     # None = sin consumo en la ventana
+    reorder_point = db.Column(db.Integer, default=0)       # pedir al bajar de este nivel
+    suggested_qty = db.Column(db.Integer, default=0)       # cantidad sugerida a pedir hoy
+    computed_at = db.Column(db.DateTime, default=datetime.now, index=True)
+
+class DataVersion(db.Model):
+    """Contador de versión por conjunto de datos, compartido entre workers de gunicorn"""
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+class ChangeLog(db.Model):
+    """Registro de cambios (outbox): una fila por entidad escrita, en la misma transacción.
+
+    seq es creciente, así que cualquier consumidor (sincronización del calendario,
+    invalidación de cachés, eventos en vivo) lee solo lo posterior a su último seq.
+    """
+    seq = db.Column(db.Integer, primary_key=True)
+    dataset = db.Column(db.String(50), nullable=False)     # conjunto de data_version: tasks, clients...
+    entity = db.Column(db.String(50), nullable=True)       # tabla; None = cambio masivo del conjunto
+    entity_id = db.Column(db.Integer, nullable=True)
+    op = db.Column(db.String(10), nullable=False)          # insert, update, delete, bulk
+    user_id = db.Column(db.Integer, nullable=True)         # solo para este técnico: ha dejado de ver la tarea
+    version = db.Column(db.Integer, nullable=False)        # data_version del conjunto tras el cambio
+    created_at = db.Column(db.DateTime, default=datetime.now, nullable=False, index=True)
+    __table_args__ = (
+        db.Index('ix_change_log_dataset_seq', 'dataset', 'seq'),
+        {'sqlite_autoincrement': True},  # no reutilizar seq tras compactar
+    )
+
+def normalize_search_text(value):
+    """Normaliza texto para búsquedas: sin acentos, minúsculas y espacios simples"""
+    if not value:
+        return ''
+    text = unicodedata.normalize('NFKD', value)
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch))
+    return ' '.join(text.casefold().split())
+
+@event.listens_for(Client, 'before_insert')
+@event.listens_for(Client, 'before_update')
+@event.listens_for(Stock, 'before_insert')
+@event.listens_for(Stock, 'before_update')
+def _sync_name_search(mapper, connection, target):
+    """Mantiene sincronizada la columna normalizada name_search con name"""
+    target.name_search = normalize_search_text(target.name)[:100]
+
+class Job(db.Model):
+    """Trabajo en segundo plano (importaciones, exportaciones, mantenimiento).
+
+    La fila es la cola: cualquier worker la reclama pasando de queued a running con un
+    UPDATE condicional, y va dejando progreso y latido hasta terminar en done o error.
+    """
+    id = db.Column(db.String(32), primary_key=True, default=lambda: secrets.token_hex(16))
+    kind = db.Column(db.String(40), nullable=False)
+    status = db.Column(db.String(10), nullable=False, default='queued')  # queued, running, done, error
+    params = db.Column(db.Text, nullable=True)      # JSON con los argumentos del manejador
+    progress = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer, nullable=True)
+    message = db.Column(db.String(200), nullable=True)
+    result = db.Column(db.Text, nullable=True)      # JSON devuelto por el manejador
+    error = db.Column(db.Text, nullable=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='SET NULL'), nullable=True)
+    worker = db.Column(db.String(100), nullable=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.now, nullable=False)
+    started_at = db.Column(db.DateTime, nullable=True)
+    heartbeat_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    __table_args__ = (db.Index('ix_job_status_created', 'status', 'created_at'),)
+
+# --- VERSIONES DE DATOS (invalidación de índices en memoria) ---
+# Modelo → conjunto de datos cuya versión se incrementa al escribir en él
+VERSIONED_MODELS = {
+    Client: 'clients',
+    Stock: 'stock',
+    StockCategory: 'stock',
+    ServiceType: 'service_types',
+    User: 'users',
+    Alarm: 'alarms',
+    Task: 'tasks',
+    TaskTechnician: 'tasks',
+    ClientPayment: 'payments',
+    PaymentRecord: 'payments',
+}
+# Versiones vistas por este proceso tras sus propios commits (sin esperar al sondeo de BD)
+_local_versions = {}
+
+def _change_key(obj, op):
+    """(conjunto, entidad, id, op) con que se anota un objeto en change_log"""
+    if isinstance(obj, TaskTechnician):
+        # Cambiar técnicos secundarios es una modificación de la tarea
+        return 'tasks', 'task', obj.task_id, 'update'
+    return VERSIONED_MODELS[type(obj)], obj.__table__.name, obj.id, op
+
+@event.listens_for(Session, 'after_flush')
+def _bump_data_versions(session, flush_context):
+    """Anota los conjuntos y entidades escritos en el flush; la versión y change_log se
+    escriben en _write_change_log, justo antes del COMMIT"""
+    changes = session.info.setdefault('pending_changes', {})
+    revoked = session.info.setdefault('revoked_tasks', {})
+    for op, objs in (('insert', session.new), ('delete', session.deleted), ('update', session.dirty)):
+        for obj in objs:
+            if type(obj) not in VERSIONED_MODELS:
+                continue
+            if op == 'update' and not session.is_modified(obj):
+                continue
+            dataset, entity, entity_id, op_ = _change_key(obj, op)
+            if op_ == 'delete' or (entity, entity_id) not in changes:
+                changes[(entity, entity_id)] = (dataset, op_)
+            # Quién podía ver la tarea antes del cambio (None = estaba sin asignar)
+            if isinstance(obj, Task) and op == 'update':
+                revoked.setdefault(obj.id, set()).update(db.inspect(obj).attrs.tech_id.history.deleted)
+            elif isinstance(obj, TaskTechnician) and op == 'delete':
+                revoked.setdefault(obj.task_id, set()).add(obj.user_id)
+
+def bump_data_versions(session, names):
+    """Incrementa al confirmar (una vez por transacción) la versión de los conjuntos indicados.
+
+    Las operaciones masivas (insert()/update() sobre listas) no disparan after_flush,
+    así que deben llamar a esta función explícitamente antes del commit; en ese caso
+    se anota en change_log un cambio 'bulk' por conjunto (los consumidores recargan
+    el conjunto entero).
+    """
+    session.info.setdefault('bulk_datasets', set()).update(names)
+
+def _revoked_task_rows(conn, revoked, changes):
+    """[(task_id, user_id)] de los técnicos que han dejado de ver una tarea en la transacción:
+    el principal anterior, los secundarios retirados y, si estaba sin asignar, el resto"""
+    revoked = {task_id: users for task_id, users in revoked.items()
+               if changes.get(('task', task_id), ('', ''))[1] != 'delete'}
+    if not revoked:
+        return []
+    audience = {}
+    for task_id, tech_id in conn.execute(db.select(Task.id, Task.tech_id).where(Task.id.in_(revoked))):
+        audience[task_id] = {tech_id}
+    for task_id, user_id in conn.execute(db.select(TaskTechnician.task_id, TaskTechnician.user_id)
+                                         .where(TaskTechnician.task_id.in_(revoked))):
+        audience.setdefault(task_id, set()).add(user_id)
+    techs = None
+    rows = []
+    for task_id, users in revoked.items():
+        current = audience.get(task_id)
+        if not current or None in current:
+            continue  # borrada, o sin asignar: la siguen viendo todos
+        if None in users:
+            if techs is None:
+                techs = {user_id for (user_id,) in conn.execute(db.select(User.id).where(User.role == 'tech'))}
+            users = users | techs
+        rows.extend((task_id, user_id) for user_id in sorted(users - current - {None}))
+    return rows
+
+# Clave del advisory lock de PostgreSQL que ordena las escrituras en change_log
+CHANGE_LOG_LOCK_KEY = 0x636c6f67
+
+@event.listens_for(Session, 'before_commit')
+def _write_change_log(session):
+    """Incrementa data_version e inserta las filas de change_log justo antes del COMMIT.
+
+    En PostgreSQL seq sale de una secuencia al insertar, no al confirmar: dos transacciones
+    podrían hacerse visibles en otro orden y un lector saltarse el seq menor. Con el
+    advisory lock, insertar y confirmar es exclusivo, así que los seq se hacen visibles en
+    orden y max(seq) es una marca segura. Las filas de data_version se actualizan aquí
+    también, tras el lock: quedan bloqueadas solo hasta el COMMIT inmediato y no durante
+    toda la transacción. SQLite ya serializa a los escritores.
+    """
+    session.flush()  # commit() hace su flush después de este evento; adelantarlo
+    changes = session.info.pop('pending_changes', {})
+    revoked = session.info.pop('revoked_tasks', {})
+    bulk = session.info.pop('bulk_datasets', set())
+    names = {dataset for dataset, _ in changes.values()} | bulk
+    if not names:
+        return
+    conn = session.connection()
+    if conn.dialect.name == 'postgresql':
+        conn.execute(db.text('SELECT pg_advisory_xact_lock(:key)'), {'key': CHANGE_LOG_LOCK_KEY})
+    table = DataVersion.__table__
+    conn.execute(table.update().where(table.c.name.in_(names)).values(version=table.c.version + 1))
+    versions = dict.fromkeys(names, 0)
+    versions.update(conn.execute(db.select(table.c.name, table.c.version).where(table.c.name.in_(names))).all())
+    session.info['data_versions'] = versions
+
+    now = datetime.now()
+    rows = [{'dataset': dataset, 'entity': entity, 'entity_id': entity_id, 'op': op, 'user_id': None,
+             'version': versions[dataset], 'created_at': now}
+            for (entity, entity_id), (dataset, op) in changes.items()]
+    rows += [{'dataset': name, 'entity': None, 'entity_id': None, 'op': 'bulk', 'user_id': None,
+              'version': versions[name], 'created_at': now} for name in bulk]
+    # Una fila por técnico que deja de ver la tarea: su sincronización la vuelve a pedir y la quita
+    rows += [{'dataset': 'tasks', 'entity': 'task', 'entity_id': task_id, 'op': 'update', 'user_id': user_id,
+              'version': versions['tasks'], 'created_at': now}
+             for task_id, user_id in _revoked_task_rows(conn, revoked, changes)]
+    conn.execute(ChangeLog.__table__.insert(), rows)
+
+@event.listens_for(Session, 'after_commit')
+def _publish_local_versions(session):
+    names = session.info.pop('data_versions', ())
+    for name in names:
+        _local_versions[name] = _local_versions.get(name, 0) + 1
+    if names:
+        # Aviso a los demás workers para que invaliden sus cachés; sale con los eventos
+        # en vivo de esta transacción (_publish_live_events se registra después)
+        session.info.setdefault('live_events', {})[('data_version', None)] = {
+            'type': 'data_version', 'datasets': sorted(names)}
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_local_versions(session):
+    for key in ('data_versions', 'pending_changes', 'revoked_tasks', 'bulk_datasets'):
+        session.info.pop(key, None)
+
+# --- EVENTOS EN VIVO (SSE) ---
+# Cada commit que crea/modifica/borra tareas, crea alarmas o deja un artículo bajo mínimo
+# publica eventos compactos. Los paneles los reciben por /api/events/stream y refrescan
+# solo lo afectado en lugar de recargar calendarios enteros.
+LIVE_EVENTS_CHANNEL = 'paco_live_events'
+INTERNAL_EVENT_TYPES = {'data_version'}  # solo para oyentes internos, no se envían por SSE
+SSE_KEEPALIVE_SECONDS = 25      # comentario periódico para que proxies no corten la conexión
+SSE_MAX_STREAM_SECONDS = 300    # el navegador reconecta solo; evita ocupar un hilo indefinidamente
+SSE_QUEUE_SIZE = 200            # eventos pendientes por conexión antes de pedir resync
+# Cada stream ocupa un hilo del worker (gthread, ver gunicorn.conf.py): con más conexiones
+# abiertas se pide al navegador que vuelva a intentarlo más tarde y quedan hilos libres
+SSE_MAX_STREAMS = int(os.environ.get('SSE_MAX_STREAMS', '8'))
+SSE_BUSY_RETRY_MS = 30000
+
+class EventBroker:
+    """Reparte eventos a las conexiones SSE abiertas en este worker y a los oyentes
+    internos (p. ej. las cachés, que se invalidan con los eventos data_version)"""
+
+    def __init__(self):
+        self._subscribers = set()
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+
+    def subscribe(self):
+        """Cola para una conexión SSE; None si el worker ya tiene SSE_MAX_STREAMS abiertas"""
+        q = queue.Queue(maxsize=SSE_QUEUE_SIZE)
+        with self._lock:
+            if len(self._subscribers) >= SSE_MAX_STREAMS:
+                return None
+            self._subscribers.add(q)
+        return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._subscribers.discard(q)
+
+    def dispatch(self, events):
+        for callback in self._listeners:
+            for ev in events:
+                callback(ev)
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            for ev in events:
+                try:
+                    q.put_nowait(ev)
+                except queue.Full:
+                    # Cliente lento: descartar lo pendiente y pedirle que recargue todo
+                    with q.mutex:
+                        q.queue.clear()
+                    q.put_nowait({'type': 'resync'})
+                    break
+
+class LocalEventBackend:
+    """Un solo proceso (SQLite / desarrollo): entrega directa al broker del worker"""
+
+    listening = False  # no hay otros workers que avisen
+
+    def __init__(self, broker):
+        self.broker = broker
+
+    def start(self):
+        pass
+
+    def publish(self, events):
+        self.broker.dispatch(events)
+
+class PostgresEventBackend:
+    """Varios workers: NOTIFY tras el commit y un hilo LISTEN por worker que reparte
+    lo recibido (también lo propio) a su broker local."""
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.listening = False  # True mientras el LISTEN está activo
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._listen, name='live-events', daemon=True)
+                self._thread.start()
+
+    def publish(self, events):
+        with db.engine.begin() as conn:
+            for ev in events:
+                conn.execute(db.text('SELECT pg_notify(:channel, :payload)'),
+                             {'channel': LIVE_EVENTS_CHANNEL, 'payload': json.dumps(ev)})
+
+    def _listen(self):
+        while True:
+            try:
+                # Conexión propia fuera del pool: queda ocupada escuchando
+                raw = db.engine.raw_connection()
+                raw.detach()
+                conn = raw.driver_connection
+                conn.autocommit = True
+                conn.cursor().execute(f'LISTEN {LIVE_EVENTS_CHANNEL}')
+                self.listening = True
+                # Lo cambiado mientras no se escuchaba solo se vería con el sondeo
+                self.broker.dispatch([{'type': 'data_version', 'datasets': []}])
+                while True:
+                    if not select.select([conn], [], [], SSE_KEEPALIVE_SECONDS)[0]:
+                        continue
+                    conn.poll()
+                    events = []
+                    while conn.notifies:
+                        events.append(json.loads(conn.notifies.pop(0).payload))
+                    if events:
+                        self.broker.dispatch(events)
+            except Exception as e:
+                self.listening = False
+                print(f"⚠  Escucha de eventos en vivo interrumpida: {e}")
+                time.sleep(5)
+
+live_broker = EventBroker()
+live_events = None  # backend elegido en initialize_database() según el motor de BD
+
+def _task_event(kind, task, audience):
+    """Evento de tarea. audience son los técnicos a los que afecta, antes y después del cambio
+    (principal y secundarios, incluidos los retirados); None en audience = estaba o queda
+    sin asignar, y eso lo ven todos los técnicos."""
+    return {
+        'type': f'task.{kind}',
+        'id': task.id,
+        'tech_id': task.tech_id,
+        'audience': sorted(u for u in audience if u is not None),
+        'unassigned': None in audience,
+        'date': task.date.isoformat() if task.date else None,
+        'status': task.status,
+    }
+
+@event.listens_for(Session, 'after_flush')
+def _collect_live_events(session, flush_context):
+    """Acumula en la sesión los eventos de la transacción; se publican tras el commit"""
+    pending = session.info.setdefault('live_events', {})
+    tasks = {}      # task_id → (tipo, tarea) de las tareas escritas en este flush
+    affected = {}   # task_id → técnicos anteriores o retirados (historial de atributos)
+    for obj in session.new:
+        if isinstance(obj, Task):
+            tasks[obj.id] = ('created', obj)
+        elif isinstance(obj, Alarm):
+            pending[('alarm', obj.id)] = {'type': 'alarm.created', 'id': obj.id, 'title': obj.title,
+                                          'alarm_type': obj.alarm_type, 'priority': obj.priority}
+        elif isinstance(obj, TaskTechnician):
+            affected.setdefault(obj.task_id, set()).add(obj.user_id)
+    for obj in session.dirty:
+        if isinstance(obj, Task) and session.is_modified(obj):
+            tasks[obj.id] = ('updated', obj)
+            affected.setdefault(obj.id, set()).update(db.inspect(obj).attrs.tech_id.history.deleted)
+        elif isinstance(obj, Stock):
+            old = db.inspect(obj).attrs.quantity.history.deleted
+            min_stock = obj.min_stock or 0
+            if old and old[0] is not None and old[0] > min_stock >= (obj.quantity or 0):
+                pending[('stock', obj.id)] = {'type': 'stock.low', 'id': obj.id, 'name': obj.name,
+                                              'quantity': obj.quantity, 'min_stock': obj.min_stock}
+    for obj in session.deleted:
+        if isinstance(obj, Task):
+            tasks[obj.id] = ('deleted', obj)
+            affected.setdefault(obj.id, set()).update(db.inspect(obj).attrs.tech_id.history.deleted)
+        elif isinstance(obj, TaskTechnician):
+            affected.setdefault(obj.task_id, set()).add(obj.user_id)
+    task_ids = set(tasks) | set(affected)
+    if not task_ids:
+        return
+
+    # Secundarios actuales de las tareas tocadas (los de este flush ya están en la BD)
+    extra = {}
+    live_ids = [task_id for task_id in task_ids if tasks.get(task_id, ('',))[0] != 'deleted']
+    if live_ids:
+        rows = session.connection().execute(db.select(TaskTechnician.task_id, TaskTechnician.user_id)
+                                            .where(TaskTechnician.task_id.in_(live_ids)))
+        for task_id, user_id in rows:
+            extra.setdefault(task_id, set()).add(user_id)
+    for task_id in task_ids:
+        kind, task = tasks.get(task_id) or ('updated', session.get(Task, task_id))
+        if task is None:
+            continue
+        audience = {task.tech_id} | affected.get(task_id, set()) | extra.get(task_id, set())
+        prev = pending.get(('task', task_id))
+        if prev:
+            audience |= set(prev['audience'])
+            if prev['unassigned']:
+                audience.add(None)
+            if prev['type'] == 'task.created' and kind == 'updated':
+                kind = 'created'
+        pending[('task', task_id)] = _task_event(kind, task, audience)
+
+def publish_live_events(events):
+    """Publica eventos ya confirmados. Las escrituras ORM lo hacen solas tras el commit;
+    las operaciones masivas (insert()/update() sobre listas) deben llamarla ellas."""
+    if not events or live_events is None:
+        return
+    try:
+        live_events.publish(list(events))
+    except Exception as e:
+        print(f"⚠  No se pudieron publicar eventos en vivo: {e}")
+
+@event.listens_for(Session, 'after_commit')
+def _publish_live_events(session):
+    pending = session.info.pop('live_events', None)
+    if pending:
+        publish_live_events(pending.values())
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_live_events(session):
+    session.info.pop('live_events', None)
+
 @login_manager.user_loader
 def load_user(user_id):
     try:
-        return db.session.get(User, int(user_id))
+        return cached_user_identity(int(user_id))
     except Exception as e:
         print(f"ERROR load_user: {e}")
         return None
@@ -252,14 +742,14 @@ def check_low_stock():
     """Verificar stock bajo y crear alarmas"""
     try:
         low_items = Stock.query.filter(Stock.quantity <= Stock.min_stock).all()
+        # Una sola consulta para las alarmas ya abiertas (antes: una por artículo)
+        alarmed_ids = {row[0] for row in db.session.query(Alarm.stock_item_id).filter(
+            Alarm.alarm_type == 'low_stock',
+            Alarm.is_read == False,
+            Alarm.stock_item_id != None
+        )}
         for item in low_items:
-            existing = Alarm.query.filter_by(
-                alarm_type='low_stock',
-                stock_item_id=item.id,
-                is_read=False
-            ).first()
-            
-            if not existing:
+            if item.id not in alarmed_ids:
                 alarm = Alarm(
                     alarm_type='low_stock',
                     title=f'Stock bajo: {item.name}',
@@ -273,7 +763,1137 @@ def check_low_stock():
         db.session.rollback()
         print(f"Error en check_low_stock: {str(e)}")
 
+def _like_escape(value):
+    """Escapa comodines de LIKE (%, _) para buscar texto literal"""
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def search_by_name(model, q, limit, options=()):
+    """Búsqueda por nombre insensible a acentos y mayúsculas, ordenada por relevancia.
+
+    PostgreSQL: LIKE sobre name_search con índice GIN pg_trgm y orden por similarity().
+    SQLite: primero coincidencias por prefijo (rango sobre el índice de name_search)
+    y solo si faltan resultados, coincidencias parciales.
+    """
+    term = normalize_search_text(q)
+    if not term:
+        return []
+    col = model.name_search
+    contains = col.like(f'%{_like_escape(term)}%', escape='\\')
+    prefix = col.like(f'{_like_escape(term)}%', escape='\\')
+
+    if db.engine.dialect.name == 'postgresql':
+        return model.query.options(*options).filter(contains).order_by(
+            db.case((prefix, 0), else_=1),
+            db.func.similarity(col, term).desc(),
+            model.name
+        ).limit(limit).all()
+
+    # Prefijo: predicado de rango, aprovecha el índice B-tree de name_search
+    results = model.query.options(*options).filter(
+        col >= term, col < term + '\uffff'
+    ).order_by(col, model.name).limit(limit).all()
+    if len(results) < limit:
+        seen = [r.id for r in results]
+        more = model.query.options(*options).filter(contains)
+        if seen:
+            more = more.filter(model.id.notin_(seen))
+        results += more.order_by(col, model.name).limit(limit - len(results)).all()
+    return results
+
+# --- CACHÉS POR WORKER (regiones versionadas) ---
+# Cada región depende de uno o varios conjuntos de data_version y se vacía cuando alguno
+# cambia. Las versiones se leen de una vez para todas las regiones: tras un commit propio,
+# al recibir el aviso de otro worker (NOTIFY en PostgreSQL) o, como respaldo, por sondeo.
+DATA_VERSION_CHECK_SECONDS = 5          # sondeo de data_version (SQLite o sin LISTEN activo)
+DATA_VERSION_NOTIFY_CHECK_SECONDS = 60  # con LISTEN/NOTIFY activo el sondeo es solo de respaldo
+AUTOCOMPLETE_CACHE_SIZE = 256           # prefijos más frecuentes con respuesta cacheada
+
+class DataVersionWatcher:
+    """Versiones de data_version vistas por este worker, compartidas por todas las regiones"""
+
+    def __init__(self):
+        self._versions = {}
+        self._seen_local = {}
+        self._checked_at = None
+        self._stale = True
+        self.refreshes = 0
+
+    def mark_stale(self):
+        self._stale = True
+
+    def _on_event(self, ev):
+        if ev.get('type') == 'data_version':
+            self.mark_stale()
+
+    def current(self, names):
+        """Tupla con la versión actual de cada conjunto de names"""
+        if live_events is not None:
+            live_events.start()  # en PostgreSQL arranca la escucha de avisos de otros workers
+        listening = getattr(live_events, 'listening', False)
+        interval = DATA_VERSION_NOTIFY_CHECK_SECONDS if listening else DATA_VERSION_CHECK_SECONDS
+        now = time.monotonic()
+        if (self._stale or self._checked_at is None or now - self._checked_at >= interval
+                or any(_local_versions.get(n, 0) != self._seen_local.get(n, 0) for n in names)):
+            self._stale = False
+            self._seen_local = dict(_local_versions)
+            self._versions = dict(db.session.query(DataVersion.name, DataVersion.version).all())
+            self._checked_at = now
+            self.refreshes += 1
+        return tuple(self._versions.get(n, 0) for n in names)
+
+    def stats(self):
+        return {'versions': dict(self._versions), 'refreshes': self.refreshes,
+                'notify': bool(getattr(live_events, 'listening', False))}
+
+data_versions = DataVersionWatcher()
+live_broker.add_listener(data_versions._on_event)
+
+CACHE_REGIONS = {}
+_MISSING = object()
+
+class CacheRegion:
+    """Región de caché con nombre: valores por clave, válidos mientras no cambie la
+    versión de sus conjuntos de datos. Lleva métricas de aciertos y fallos.
+
+    Los valores se comparten entre peticiones e hilos: deben ser inmutables
+    (tuplas/snapshots o estructuras que nadie modifica), nunca objetos ORM.
+    """
+
+    def __init__(self, name, datasets, max_entries=None):
+        if name in CACHE_REGIONS:
+            raise ValueError(f'Región de caché duplicada: {name}')
+        self.name = name
+        self.datasets = tuple(datasets)
+        self.max_entries = max_entries
+        self._version = None
+        self._entries = OrderedDict()   # clave -> (caduca_en o None, valor)
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.invalidations = 0
+        self.load_seconds = 0.0
+        CACHE_REGIONS[name] = self
+
+    def versions(self):
+        return data_versions.current(self.datasets)
+
+    def _sync(self, version):
+        # Llamar con el lock tomado
+        if self._version != version:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self._version = version
+
+    def get(self, key, loader, ttl=None):
+        """Valor de key; si falta, ha caducado (ttl en segundos) o cambió la versión, llama a loader()"""
+        version = self.versions()
+        now = time.monotonic()
+        with self._lock:
+            self._sync(version)
+            entry = self._entries.get(key, _MISSING)
+            if entry is not _MISSING and (entry[0] is None or entry[0] > now):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        started = time.perf_counter()
+        value = loader()
+        with self._lock:
+            self.load_seconds += time.perf_counter() - started
+            if self._version == version:
+                self._entries[key] = (now + ttl if ttl else None, value)
+                if self.max_entries and len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'name': self.name,
+            'datasets': list(self.datasets),
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / total, 3) if total else None,
+            'invalidations': self.invalidations,
+            'load_ms': round(self.load_seconds * 1000, 1),
+        }
+
+class VersionedCache(CacheRegion):
+    """Región con un único valor, recalculado con loader() cuando cambia su versión"""
+
+    def __init__(self, name, loader, datasets=None):
+        super().__init__(name, datasets or (name,), max_entries=1)
+        self.loader = loader
+
+    def get(self):
+        return super().get(None, self.loader)
+
+class AutocompleteIndex(CacheRegion):
+    """Índice de prefijos en memoria (uno por worker) para el autocompletado.
+
+    Mantiene dos arrays ordenados: nombres normalizados completos y el sufijo que
+    empieza en cada palabra, de modo que "pepe" encuentra "Bar Pepe". Se carga de
+    forma perezosa y se reconstruye en segundo plano cuando cambia data_version;
+    mientras tanto search() devuelve None y el endpoint responde con SQL. Las
+    respuestas por prefijo se guardan como entradas de la región.
+    """
+
+    def __init__(self, name, dataset, loader):
+        super().__init__(name, (dataset,), max_entries=AUTOCOMPLETE_CACHE_SIZE)
+        self.loader = loader  # loader() -> [(id, name_search, payload)]
+        self._state = None    # (version, full_keys, word_keys, payloads)
+        self._rebuilding = False
+
+    def _build(self, version):
+        full_keys, word_keys, payloads = [], [], {}
+        for row_id, key, payload in self.loader():
+            key = key or ''
+            payloads[row_id] = payload
+            full_keys.append((key, row_id))
+            for i, ch in enumerate(key):
+                if i > 0 and ch != ' ' and key[i - 1] == ' ':
+                    word_keys.append((key[i:], row_id))
+        full_keys.sort()
+        word_keys.sort()
+        self._state = (version, full_keys, word_keys, payloads)
+
+    def _rebuild_async(self, version):
+        with self._lock:
+            if self._rebuilding:
+                return
+            self._rebuilding = True
+        flask_app = app
+
+        def run():
+            try:
+                with flask_app.app_context():
+                    self._build(version)
+            except Exception as e:
+                print(f"Error reconstruyendo índice {self.name}: {e}")
+            finally:
+                self._rebuilding = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+    @staticmethod
+    def _lookup(state, term, limit):
+        _, full_keys, word_keys, payloads = state
+        ids = []
+        for keys in (full_keys, word_keys):
+            i = bisect.bisect_left(keys, (term,))
+            while i < len(keys) and len(ids) < limit and keys[i][0].startswith(term):
+                if keys[i][1] not in ids:
+                    ids.append(keys[i][1])
+                i += 1
+            if len(ids) >= limit:
+                break
+        return [payloads[row_id] for row_id in ids]
+
+    def search(self, q, limit):
+        """Devuelve la lista de payloads o None si el índice no está al día"""
+        term = normalize_search_text(q)
+        if not term:
+            return []
+        version = self.versions()
+        state = self._state
+        if state is None:
+            self._build(version)
+            state = self._state
+        elif state[0] != version:
+            self._rebuild_async(version)
+            self.misses += 1
+            return None
+        return self.get((term, limit), lambda: self._lookup(state, term, limit))
+
+def _client_search_payload(c):
+    return {
+        'id': c.id,
+        'name': c.name,
+        'phone': c.phone,
+        'email': c.email,
+        'address': c.address,
+        'link': c.link,
+        'has_support': c.has_support
+    }
+
+def _stock_search_payload(item):
+    return {
+        'id': item.id,
+        'name': item.name,
+        'quantity': item.quantity,
+        'category': item.category.name if item.category else None
+    }
+
+def _load_client_autocomplete():
+    rows = db.session.query(
+        Client.id, Client.name, Client.name_search, Client.phone, Client.email,
+        Client.address, Client.link, Client.has_support
+    ).all()
+    return [(r.id, r.name_search, _client_search_payload(r)) for r in rows]
+
+def _load_stock_autocomplete():
+    items = Stock.query.options(joinedload(Stock.category)).all()
+    return [(item.id, item.name_search, _stock_search_payload(item)) for item in items]
+
+client_autocomplete = AutocompleteIndex('client_autocomplete', 'clients', _load_client_autocomplete)
+stock_autocomplete = AutocompleteIndex('stock_autocomplete', 'stock', _load_stock_autocomplete)
+
+# --- BÚSQUEDA DE TEXTO COMPLETO EN PARTES ---
+# PostgreSQL: columna generada task.search_tsv (tsvector) con índice GIN.
+# SQLite: tabla FTS5 task_fts (external content) mantenida por triggers.
+# Ambas se crean en initialize_database() y se sincronizan en la propia BD.
+FTS_PG_CONFIG = 'spanish'  # se sustituye por 'oslaprint_es' (con unaccent) si existe
+FTS_MARK_START, FTS_MARK_END = '\x02', '\x03'
+FTS_DEFAULT_PER_PAGE = 50
+FTS_MAX_PER_PAGE = 200
+
+def _fulltext_terms(q):
+    """Palabras de la consulta, sin operadores ni signos (evita errores de sintaxis FTS)"""
+    return re.findall(r'[^\W_]+', q or '')[:8]
+
+def task_fulltext_match(q):
+    """Subconsulta (task_id, rank) de partes que contienen todas las palabras (como prefijo).
+
+    rank es ascendente: cuanto menor, más relevante. Devuelve None si no hay términos.
+    """
+    terms = _fulltext_terms(q)
+    if not terms:
+        return None
+    if db.engine.dialect.name == 'postgresql':
+        stmt = db.text(
+            f"SELECT id AS task_id, -ts_rank(search_tsv, to_tsquery('{FTS_PG_CONFIG}', :tsq)) AS rank "
+            f"FROM task WHERE search_tsv @@ to_tsquery('{FTS_PG_CONFIG}', :tsq)"
+        ).bindparams(tsq=' & '.join(f'{t}:*' for t in terms))
+    else:
+        stmt = db.text(
+            "SELECT rowid AS task_id, bm25(task_fts, 4.0, 2.0, 1.0, 2.0) AS rank "
+            "FROM task_fts WHERE task_fts MATCH :match"
+        ).bindparams(match=' '.join(f'"{t}"*' for t in terms))
+    return stmt.columns(task_id=db.Integer, rank=db.Float).subquery('fts')
+
+def task_fulltext_snippets(q, task_ids):
+    """Fragmentos resaltados ({id: html}) solo para la página de resultados ya obtenida"""
+    terms = _fulltext_terms(q)
+    if not terms or not task_ids:
+        return {}
+    ids_param = db.bindparam('ids', expanding=True)
+    if db.engine.dialect.name == 'postgresql':
+        stmt = db.text(
+            f"SELECT id, ts_headline('{FTS_PG_CONFIG}', "
+            "concat_ws(' · ', client_name, description, parts_text, signature_client_name), "
+            f"to_tsquery('{FTS_PG_CONFIG}', :tsq), :opts) FROM task WHERE id IN :ids"
+        ).bindparams(ids_param, tsq=' & '.join(f'{t}:*' for t in terms),
+                     opts=f'StartSel={FTS_MARK_START}, StopSel={FTS_MARK_END}, MaxWords=25, MinWords=8')
+    else:
+        stmt = db.text(
+            "SELECT rowid, snippet(task_fts, -1, :start, :end, '…', 16) "
+            "FROM task_fts WHERE task_fts MATCH :match AND rowid IN :ids"
+        ).bindparams(ids_param, match=' '.join(f'"{t}"*' for t in terms),
+                     start=FTS_MARK_START, end=FTS_MARK_END)
+    snippets = {}
+    for task_id, fragment in db.session.execute(stmt, {'ids': list(task_ids)}):
+        # Escapar el contenido y convertir solo los marcadores en <mark>
+        snippets[task_id] = html.escape(fragment or '').replace(
+            FTS_MARK_START, '<mark>').replace(FTS_MARK_END, '</mark>')
+    return snippets
+
+def paginate_fulltext(query, q):
+    """Aplica la búsqueda q= a una consulta de Task: resultados por relevancia y paginados.
+
+    Devuelve (tasks, snippets, total, page, per_page).
+    """
+    page = max(request.args.get('page', 1, type=int) or 1, 1)
+    per_page = request.args.get('per_page', FTS_DEFAULT_PER_PAGE, type=int) or FTS_DEFAULT_PER_PAGE
+    per_page = min(max(per_page, 1), FTS_MAX_PER_PAGE)
+    fts = task_fulltext_match(q)
+    if fts is None:
+        return [], {}, 0, page, per_page
+    query = query.join(fts, fts.c.task_id == Task.id)
+    total = query.order_by(None).count()
+    tasks = query.order_by(fts.c.rank, Task.date.desc(), Task.id.desc()) \
+        .offset((page - 1) * per_page).limit(per_page).all()
+    return tasks, task_fulltext_snippets(q, [t.id for t in tasks]), total, page, per_page
+
+# Capacidades sobre una tarea según la relación del usuario con ella
+TASK_CAPS_ALL = frozenset({'view', 'complete', 'edit', 'delete'})
+TASK_CAPS_SECONDARY = frozenset({'view', 'complete'})   # técnico secundario
+TASK_CAPS_UNASSIGNED = frozenset({'view', 'complete'})  # cualquier técnico en citas sin asignar
+
+def task_access(task_id, options=()):
+    """Carga la tarea y los permisos del usuario actual sobre ella en una sola consulta.
+
+    Devuelve (task, caps) con caps ⊆ {'view', 'complete', 'edit', 'delete'}:
+    admin y técnico principal: todo; técnico secundario y citas sin asignar
+    (solo técnicos): ver y completar. (None, frozenset()) si la tarea no existe.
+    options: opciones de carga (p. ej. task_load_options) para traer solo lo necesario.
+    """
+    if current_user.role == 'admin':
+        task = db.session.get(Task, task_id, options=options)
+        return task, (TASK_CAPS_ALL if task else frozenset())
+
+    is_secondary = db.session.query(TaskTechnician.id).filter(
+        TaskTechnician.task_id == Task.id,
+        TaskTechnician.user_id == current_user.id
+    ).exists()
+    row = db.session.query(Task, is_secondary).options(*options).filter(Task.id == task_id).first()
+    if row is None:
+        return None, frozenset()
+    task, secondary = row
+    if task.tech_id == current_user.id:
+        return task, TASK_CAPS_ALL
+    if current_user.role == 'tech':
+        if secondary:
+            return task, TASK_CAPS_SECONDARY
+        if task.tech_id is None:
+            return task, TASK_CAPS_UNASSIGNED
+    return task, frozenset()
+
+# --- SERIALIZACIÓN DE TAREAS ---
+# Una única representación de Task para todos los endpoints de detalle. Cada endpoint
+# define una vista por defecto (TASK_VIEWS) y el cliente puede pedir solo lo que usa con
+# ?fields=a,b,c y ?include=client_info,attachments,... La consulta carga únicamente las
+# columnas y relaciones que necesita la selección.
+
+def task_transport_duration(transport_start, arrival):
+    """Tiempo de transporte legible ('1h 05min', '40min') a partir de dos horas HH:MM"""
+    if not transport_start or not arrival:
+        return ''
+    try:
+        diff_min = int((datetime.strptime(arrival, '%H:%M') -
+                        datetime.strptime(transport_start, '%H:%M')).total_seconds() / 60)
+    except ValueError:
+        return ''
+    if diff_min <= 0:
+        return ''
+    h, m = divmod(diff_min, 60)
+    return f'{h}h {m:02d}min' if h else f'{m}min'
+
+def task_attachment_list(task):
+    """Lista de adjuntos tal como se guarda en Task.attachments (JSON); [] si no hay o es inválido"""
+    if not task.attachments:
+        return []
+    try:
+        atts = json.loads(task.attachments)
+    except (TypeError, ValueError):
+        return []
+    return atts if isinstance(atts, list) else []
+
+def _task_attachment_files(task):
+    """Adjuntos normalizados a {name, filename} (formato antiguo: lista de nombres)"""
+    files = []
+    for a in task_attachment_list(task):
+        if isinstance(a, dict):
+            files.append({'name': a.get('original_name', a.get('filename', '')), 'filename': a.get('filename', '')})
+        else:
+            files.append({'name': str(a), 'filename': str(a)})
+    return {'attachments': files}
+
+def _task_client_info(task):
+    c = task.client
+    return {'client_info': {
+        'name': c.name,
+        'phone': c.phone,
+        'email': c.email,
+        'address': c.address,
+        'link': c.link,
+        'notes': c.notes,
+        'has_support': c.has_support
+    } if c else None}
+
+def _fmt_dt(value, fmt):
+    return value.strftime(fmt) if value else None
+
+# Relaciones: nombre -> (relación, FK en Task, columnas que se cargan del destino)
+TASK_RELATIONS = {
+    'client': (Task.client, 'client_id', None),
+    'tech': (Task.tech, 'tech_id', (User.id, User.username)),
+    'service_type': (Task.service_type, 'service_type_id', (ServiceType.id, ServiceType.name)),
+    'stock_item': (Task.stock_item, 'stock_item_id', (Stock.id, Stock.name)),
+}
+
+# Campos de ?fields= : nombre -> (atributos de Task necesarios, valor)
+TASK_FIELDS = {
+    'id': (('id',), lambda t: t.id),
+    'client_name': (('client_name',), lambda t: t.client_name),
+    'date': (('date',), lambda t: _fmt_dt(t.date, '%Y-%m-%d')),
+    'date_display': (('date',), lambda t: _fmt_dt(t.date, '%d/%m/%Y')),
+    'start_time': (('start_time',), lambda t: t.start_time),
+    'end_time': (('end_time',), lambda t: t.end_time),
+    'time': (('start_time',), lambda t: t.start_time),
+    'description': (('description',), lambda t: t.description),
+    'notes': (('description',), lambda t: t.description),
+    'parts_text': (('parts_text',), lambda t: t.parts_text),
+    'status': (('status',), lambda t: t.status),
+    'tech_id': (('tech_id',), lambda t: t.tech_id),
+    'tech_name': (('tech',), lambda t: t.tech.username if t.tech else None),
+    'service_type_id': (('service_type_id',), lambda t: t.service_type_id),
+    'service_type': (('service_type',), lambda t: t.service_type.name if t.service_type else None),
+    # Nombre del servicio tal como se muestra en informes (remota sin tipo -> 'Asistencia Remota')
+    'service_label': (('service_type', 'is_remote'),
+                      lambda t: t.service_type.name if t.service_type else ('Asistencia Remota' if t.is_remote else None)),
+    'is_remote': (('is_remote',), lambda t: bool(t.is_remote)),
+    'remote_support_hours': (('remote_support_hours',), lambda t: t.remote_support_hours),
+}
+
+# Bloques de ?include= : nombre -> (atributos de Task necesarios, dict con las claves que añade)
+TASK_INCLUDES = {
+    'client_info': (('client',), _task_client_info),
+    'attachments': (('attachments',), lambda t: {'attachments': task_attachment_list(t)}),
+    'attachment_files': (('attachments',), _task_attachment_files),
+    'stock': (('stock_item', 'stock_quantity_used', 'stock_action'), lambda t: {'stock_info': {
+        'item_name': t.stock_item.name,
+        'quantity': t.stock_quantity_used,
+        'action': t.stock_action
+    } if t.stock_item else None}),
+    'signature': (('has_signature', 'signature_client_name', 'signature_timestamp'), lambda t: {
+        'has_signature': bool(t.has_signature),
+        'signature_client_name': t.signature_client_name,
+        'signature_timestamp': _fmt_dt(t.signature_timestamp, '%d/%m/%Y %H:%M'),
+    }),
+    'timings': (('work_start_time', 'work_end_time', 'work_duration', 'parte_transport_start',
+                 'parte_arrival', 'parte_work_start', 'parte_work_end'), lambda t: {
+        'work_start_time': _fmt_dt(t.work_start_time, '%H:%M'),
+        'work_end_time': _fmt_dt(t.work_end_time, '%H:%M'),
+        'work_duration': t.work_duration or None,
+        'parte_transport_start': t.parte_transport_start,
+        'parte_arrival': t.parte_arrival,
+        'parte_work_start': t.parte_work_start,
+        'parte_work_end': t.parte_work_end,
+        'transport_duration': task_transport_duration(t.parte_transport_start, t.parte_arrival),
+    }),
+}
+
+# Vistas por defecto de cada endpoint (mantienen el formato que ya consumen los paneles).
+# aliases renombra claves y defaults sustituye valores vacíos.
+TASK_VIEWS = {
+    'get_task_full': {
+        'fields': ('id', 'client_name', 'date', 'start_time', 'end_time', 'service_type', 'description'),
+        'include': ('client_info',),
+        'defaults': {'start_time': '', 'end_time': '', 'service_type': '', 'description': ''},
+    },
+    'task': {
+        'fields': ('id', 'client_name', 'date', 'start_time', 'end_time', 'service_type', 'service_type_id',
+                   'description', 'parts_text', 'status', 'tech_name', 'tech_id'),
+        'include': ('client_info', 'attachments', 'signature', 'timings', 'stock'),
+        'defaults': {'service_type': 'Sin tipo', 'tech_name': 'SIN TÉCNICO'},
+    },
+    'get_task': {
+        'fields': ('id', 'client_name', 'date', 'time', 'service_type', 'notes', 'tech_id'),
+        'include': (),
+        'defaults': {'time': '', 'service_type': '', 'notes': ''},
+    },
+    'task_details': {
+        'fields': ('id', 'client_name', 'tech_name', 'date', 'start_time', 'end_time', 'service_type',
+                   'status', 'description', 'parts_text'),
+        'include': ('signature', 'attachments', 'stock', 'timings'),
+        'defaults': {'tech_name': 'Sin asignar', 'start_time': '', 'end_time': '', 'service_type': 'Sin tipo',
+                     'description': '', 'parts_text': ''},
+    },
+    'report_detail': {
+        'fields': ('id', 'is_remote', 'client_name', 'service_label', 'date_display', 'tech_name',
+                   'start_time', 'end_time', 'remote_support_hours', 'description', 'parts_text'),
+        'include': ('timings', 'signature', 'attachment_files'),
+        'aliases': {'service_label': 'service_type', 'date_display': 'date', 'tech_name': 'tech'},
+        'defaults': {'client_name': '—', 'service_type': '—', 'date': '—', 'tech': 'Sin técnico',
+                     'start_time': '', 'end_time': '', 'remote_support_hours': 0,
+                     'description': '', 'parts_text': '', 'work_duration': '',
+                     'parte_transport_start': '', 'parte_arrival': '', 'parte_work_start': '',
+                     'parte_work_end': '', 'signature_client_name': '', 'signature_timestamp': ''},
+    },
+}
+
+def _selection_arg(name, known):
+    """Nombres válidos de un parámetro CSV (?fields=a,b); None si no se ha enviado"""
+    raw = request.args.get(name)
+    if raw is None:
+        return None
+    return tuple(n for n in (p.strip() for p in raw.split(',')) if n in known)
+
+def task_selection(view):
+    """(fields, include) a serializar: los de ?fields=/?include= o los de la vista.
+
+    Si se indica fields= sin include= no se añade ningún bloque (selección mínima).
+    """
+    spec = TASK_VIEWS[view]
+    fields = _selection_arg('fields', TASK_FIELDS)
+    include = _selection_arg('include', TASK_INCLUDES)
+    if fields is None:
+        return spec['fields'], (spec['include'] if include is None else include)
+    return fields, (include or ())
+
+def task_load_options(fields, include):
+    """Opciones de carga con solo las columnas y relaciones que usa la selección.
+
+    id y tech_id se cargan siempre (los necesita task_access para los permisos).
+    """
+    attrs = {'id', 'tech_id'}
+    for name in fields:
+        attrs.update(TASK_FIELDS[name][0])
+    for name in include:
+        attrs.update(TASK_INCLUDES[name][0])
+    columns, options = set(), []
+    for attr in attrs:
+        if attr in TASK_RELATIONS:
+            rel, fk, target_cols = TASK_RELATIONS[attr]
+            columns.add(fk)
+            loader = joinedload(rel)
+            options.append(loader.load_only(*target_cols) if target_cols else loader)
+        else:
+            columns.add(attr)
+    return [load_only(*(getattr(Task, c) for c in sorted(columns))), *options]
+
+def serialize_task(task, fields, include, view=None):
+    """Diccionario de la tarea con los campos e includes pedidos, en el formato de la vista"""
+    data = {name: TASK_FIELDS[name][1](task) for name in fields}
+    for name in include:
+        data.update(TASK_INCLUDES[name][1](task))
+    spec = TASK_VIEWS.get(view, {})
+    for src, dst in spec.get('aliases', {}).items():
+        if src in data:
+            data[dst] = data.pop(src)
+    for key, default in spec.get('defaults', {}).items():
+        if key in data and not data[key]:
+            data[key] = default
+    return data
+
+def task_view(task_id, view):
+    """Carga la tarea con la selección pedida y comprueba el permiso de ver.
+
+    Devuelve (data, None) o (None, respuesta de error).
+    """
+    fields, include = task_selection(view)
+    task, caps = task_access(task_id, options=task_load_options(fields, include))
+    if not task:
+        abort(404)
+    if 'view' not in caps:
+        return None, (jsonify({'success': False, 'msg': 'No autorizado'}), 403)
+    return serialize_task(task, fields, include, view), None
+
+def tech_agenda_query(user_id, pending_only=False, date_from=None, date_to=None):
+    """Agenda de un técnico en una sola consulta ordenada por fecha y hora.
+
+    Incluye las tareas donde es técnico principal, las que tiene como técnico
+    secundario (EXISTS sobre task_technician) y las citas sin asignar.
+    pending_only=True limita a 'Pendiente' (propias) y 'Sin asignar'.
+    """
+    is_secondary = db.session.query(TaskTechnician.id).filter(
+        TaskTechnician.task_id == Task.id,
+        TaskTechnician.user_id == user_id
+    ).exists()
+    mine = db.or_(Task.tech_id == user_id, is_secondary)
+    unassigned = db.and_(Task.tech_id == None, Task.status == 'Sin asignar')
+    if pending_only:
+        mine = db.and_(mine, Task.status == 'Pendiente')
+
+    query = Task.query.options(joinedload(Task.service_type)).filter(db.or_(mine, unassigned))
+    if date_from:
+        query = query.filter(Task.date >= date_from)
+    if date_to:
+        query = query.filter(Task.date <= date_to)
+    return query.order_by(Task.date.asc(), db.func.coalesce(Task.start_time, ''), Task.id)
+
+def _date_arg(args, name):
+    """Fecha AAAA-MM-DD de los parámetros de la petición; None si falta o no es válida"""
+    try:
+        return datetime.strptime(args.get(name, '').strip(), '%Y-%m-%d').date()
+    except ValueError:
+        return None
+
+def period_bounds(year, month=None):
+    """[inicio, fin) del año o del mes: comparar Task.date con rangos aprovecha los índices
+    sobre date, extract('year'/'month', ...) no"""
+    if month:
+        start = date(year, month, 1)
+        return start, date(year + (month == 12), month % 12 + 1, 1)
+    return date(year, 1, 1), date(year + 1, 1, 1)
+
+def task_filters(query, args):
+    """Filtros de /api/tasks/filter (y su exportación): service_type (nombre), status,
+    tech_id, client_name, date_from, date_to"""
+    service_type = args.get('service_type', '').strip()
+    if service_type:
+        service = ServiceType.query.filter_by(name=service_type).first()
+        if service:
+            query = query.filter(Task.service_type_id == service.id)
+    status = args.get('status', '').strip()
+    if status:
+        query = query.filter(Task.status == status)
+    tech_id = args.get('tech_id', type=int)
+    if tech_id:
+        query = query.filter(Task.tech_id == tech_id)
+    client_name = args.get('client_name', '').strip()
+    if client_name:
+        query = query.filter(Task.client_name.ilike(f'%{client_name}%'))
+    date_from, date_to = _date_arg(args, 'date_from'), _date_arg(args, 'date_to')
+    if date_from:
+        query = query.filter(Task.date >= date_from)
+    if date_to:
+        query = query.filter(Task.date <= date_to)
+    return query
+
+def report_filters(query, args):
+    """Filtros de /api/reports (y sus exportaciones): partes completados, client, date_from, date_to"""
+    query = query.filter(Task.status == 'Completado')
+    client_filter = args.get('client', '').strip().lower()
+    if client_filter:
+        query = query.filter(Task.client_name.ilike(f'%{client_filter}%'))
+    date_from, date_to = _date_arg(args, 'date_from'), _date_arg(args, 'date_to')
+    if date_from:
+        query = query.filter(Task.date >= date_from)
+    if date_to:
+        query = query.filter(Task.date <= date_to)
+    return query
+
+# --- TABLAS PAGINADAS DEL PANEL DE ADMINISTRACIÓN ---
+TABLE_DEFAULT_PER_PAGE = 50
+TABLE_MAX_PER_PAGE = 200
+
+def paginate_table(query, sort_columns, default_sort, id_column, default_dir='asc'):
+    """Ordena y pagina una consulta según page, per_page, sort y dir de la petición.
+
+    sort_columns: {'valor de sort': columna}. id_column desempata para un orden estable
+    entre páginas. Devuelve (items, meta) con meta listo para la respuesta JSON.
+    """
+    page = max(request.args.get('page', 1, type=int) or 1, 1)
+    per_page = request.args.get('per_page', TABLE_DEFAULT_PER_PAGE, type=int) or TABLE_DEFAULT_PER_PAGE
+    per_page = min(max(per_page, 1), TABLE_MAX_PER_PAGE)
+    sort = request.args.get('sort', default_sort)
+    if sort not in sort_columns:
+        sort = default_sort
+    direction = request.args.get('dir', default_dir).lower()
+    if direction not in ('asc', 'desc'):
+        direction = default_dir
+
+    total = query.order_by(None).count()
+    column = sort_columns[sort]
+    order = (column.desc(), id_column.desc()) if direction == 'desc' else (column.asc(), id_column.asc())
+    items = query.order_by(*order).offset((page - 1) * per_page).limit(per_page).all()
+    return items, {
+        'total': total,
+        'page': page,
+        'per_page': per_page,
+        'pages': max((total + per_page - 1) // per_page, 1),
+        'sort': sort,
+        'dir': direction,
+    }
+
+# Listados largos (partes, informes): paginación por cursor en vez de OFFSET. Cada página
+# continúa justo después de la última fila de la anterior (valor de orden + id), así pedir
+# la página 200 cuesta lo mismo que la primera y las altas nuevas no desplazan filas.
+KEYSET_EXACT_COUNT_LIMIT = 20000  # PostgreSQL: por encima, total estimado por el planificador
+
+def _encode_cursor(value, row_id):
+    if isinstance(value, (date, datetime)):
+        value = value.isoformat()
+    raw = json.dumps([value, row_id], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def _decode_cursor(cursor, column):
+    """(valor, id) del cursor; None si falta o no es válido (se empieza por el principio)"""
+    if not cursor:
+        return None
+    try:
+        value, row_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if value is not None and isinstance(column.type, db.Date):
+            value = date.fromisoformat(value)
+        return value, int(row_id)
+    except (ValueError, TypeError):
+        return None
+
+def count_rows(query):
+    """Total de filas de la consulta. En PostgreSQL, si el planificador estima más de
+    KEYSET_EXACT_COUNT_LIMIT filas se devuelve esa estimación en vez de recorrerlas todas.
+
+    Devuelve (total, estimado).
+    """
+    query = query.order_by(None)
+    if db.engine.dialect.name == 'postgresql':
+        try:
+            compiled = query.statement.compile(dialect=db.engine.dialect)
+            with db.session.begin_nested():  # si falla no deja abortada la transacción
+                plan = db.session.connection().exec_driver_sql(
+                    'EXPLAIN (FORMAT JSON) ' + str(compiled), compiled.params).scalar()
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            estimate = int(plan[0]['Plan']['Plan Rows'])
+            if estimate > KEYSET_EXACT_COUNT_LIMIT:
+                return estimate, True
+        except (SQLAlchemyError, LookupError, ValueError, TypeError) as e:
+            print(f"Error estimando total, se cuenta: {e}")
+    return query.count(), False
+
+def paginate_keyset(query, sort_columns, default_sort, id_column, default_dir='desc'):
+    """Como paginate_table pero por cursor: la petición trae cursor (next_cursor de la página
+    anterior; vacío para la primera), per_page, sort y dir. Los NULL del orden van detrás en
+    ascendente y delante en descendente, el orden natural de un índice B-tree en PostgreSQL.
+
+    El total solo se calcula en la primera página (count_rows); el cliente lo conserva.
+    page es solo informativo: el cliente lo envía para que vuelva en meta.
+    """
+    per_page = request.args.get('per_page', TABLE_DEFAULT_PER_PAGE, type=int) or TABLE_DEFAULT_PER_PAGE
+    per_page = min(max(per_page, 1), TABLE_MAX_PER_PAGE)
+    sort = request.args.get('sort', default_sort)
+    if sort not in sort_columns:
+        sort = default_sort
+    direction = request.args.get('dir', default_dir).lower()
+    if direction not in ('asc', 'desc'):
+        direction = default_dir
+    column = sort_columns[sort]
+    after = _decode_cursor(request.args.get('cursor', '').strip(), column)
+
+    meta = {'per_page': per_page, 'sort': sort, 'dir': direction,
+            'page': max(request.args.get('page', 1, type=int) or 1, 1) if after else 1}
+    if after is None:
+        total, estimated = count_rows(query)
+        meta.update(total=total, total_estimated=estimated,
+                    pages=max((total + per_page - 1) // per_page, 1))
+
+    desc = direction == 'desc'
+    if after is not None:
+        value, row_id = after
+        if column is id_column:
+            query = query.filter(id_column < row_id if desc else id_column > row_id)
+        elif value is None:
+            # Dentro del bloque de NULL; en descendente detrás vienen todos los no nulos
+            tail = id_column < row_id if desc else id_column > row_id
+            query = query.filter(db.or_(db.and_(column.is_(None), tail), column.isnot(None)) if desc
+                                 else db.and_(column.is_(None), tail))
+        elif desc:
+            query = query.filter(db.tuple_(column, id_column) < db.tuple_(value, row_id))
+        else:
+            query = query.filter(db.or_(db.tuple_(column, id_column) > db.tuple_(value, row_id),
+                                        column.is_(None)))
+    if column is id_column:
+        order = (id_column.desc(),) if desc else (id_column.asc(),)
+    elif desc:
+        order = (column.desc().nulls_first(), id_column.desc())
+    else:
+        order = (column.asc().nulls_last(), id_column.asc())
+
+    rows = query.order_by(*order).limit(per_page + 1).all()
+    has_more = len(rows) > per_page
+    items = rows[:per_page]
+    last = items[-1] if items else None
+    meta['has_more'] = has_more
+    meta['next_cursor'] = _encode_cursor(getattr(last, column.key), getattr(last, id_column.key)) if has_more else None
+    return items, meta
+
+# Acciones de parte que cuentan como consumo (devolver lo resta)
+STOCK_CONSUMPTION_ACTIONS = ('usar', 'retirar', 'devolver')
+
+def record_stock_movement(stock_item, delta, action, task=None):
+    """Registra un movimiento de stock en la sesión actual (se guarda con el commit del llamador)"""
+    if not delta:
+        return
+    db.session.add(StockMovement(
+        stock_id=stock_item.id,
+        task=task,
+        user_id=current_user.id if current_user and current_user.is_authenticated else None,
+        quantity=delta,
+        action=action,
+    ))
+
+# --- TRABAJOS EN SEGUNDO PLANO ---
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '2'))  # hilos por proceso
+JOB_POLL_SECONDS = 5          # cada cuánto se miran trabajos encolados por otros workers
+JOB_STALE_SECONDS = 600       # running sin latido durante este tiempo = proceso caído
+JOB_MAX_ATTEMPTS = 3          # un trabajo interrumpido vuelve a la cola hasta este número de intentos
+JOB_RETENTION_DAYS = 7
+JOB_FILES_DIR = os.path.join(basedir, 'job_files')  # entradas y salidas (fuera de uploads)
+JOB_HANDLERS = {}
+
+def job_handler(kind):
+    """Registra fn(ctx, **params) como manejador de los trabajos de tipo kind.
+    Lo que devuelva (serializable a JSON) queda en Job.result."""
+    def register(fn):
+        JOB_HANDLERS[kind] = fn
+        return fn
+    return register
+
+def job_file(job_id, suffix=''):
+    """Ruta de un archivo de entrada o salida del trabajo (se borra con la limpieza)"""
+    os.makedirs(JOB_FILES_DIR, exist_ok=True)
+    return os.path.join(JOB_FILES_DIR, f'{job_id}{suffix}')
+
+def _owned_job(job_id, worker_id):
+    """Condición de las escrituras de un trabajo en curso: solo si sigue siendo de este proceso
+    (si se dio por caído y lo reclamó otro worker, esta copia ya no debe tocarlo)"""
+    return db.and_(Job.id == job_id, Job.worker == worker_id, Job.status == 'running')
+
+class JobContext:
+    """Lo que recibe el manejador: id, usuario y un progress() que escribe en su propia
+    conexión, así no depende de la transacción del trabajo y se ve al momento."""
+
+    def __init__(self, job, worker_id):
+        self.id = job.id
+        self.user_id = job.user_id
+        self.worker_id = worker_id
+
+    def progress(self, done, total=None, message=None):
+        values = {'progress': done, 'heartbeat_at': datetime.now()}
+        if total is not None:
+            values['total'] = total
+        if message is not None:
+            values['message'] = message[:200]
+        with db.engine.begin() as conn:
+            owned = conn.execute(db.update(Job).where(_owned_job(self.id, self.worker_id)).values(**values)).rowcount
+        if not owned:
+            raise RuntimeError('El trabajo ya no pertenece a este proceso: se abandona esta copia')
+
+    def file(self, suffix=''):
+        return job_file(self.id, suffix)
+
+class JobRunner:
+    """Pool de hilos por worker de gunicorn, sin broker externo. Arranca en cada worker tras
+    el fork (post_worker_init en gunicorn.conf.py, o la primera petición con otro servidor),
+    así recoge lo encolado o interrumpido aunque nadie consulte trabajos."""
+
+    def __init__(self, workers):
+        self.workers = workers
+        self._executor = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._running = set()  # ids de los trabajos que ejecuta este proceso
+        self._cleaned_at = 0.0
+        self.worker_id = None
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                from concurrent.futures import ThreadPoolExecutor
+                self.worker_id = f'{socket.gethostname()}:{os.getpid()}'
+                self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='job')
+                self._thread = threading.Thread(target=self._loop, name='job-runner', daemon=True)
+                self._thread.start()
+
+    def wake(self):
+        self._wake.set()
+
+    def _loop(self):
+        while True:
+            self._wake.wait(JOB_POLL_SECONDS)
+            self._wake.clear()
+            try:
+                with app.app_context():
+                    self._beat()
+                    self._recover_stale()
+                    self._claim()
+                    if time.monotonic() - self._cleaned_at > 3600:
+                        self._cleaned_at = time.monotonic()
+                        cleanup_jobs()
+            except Exception as e:
+                print(f"⚠  Error en el gestor de trabajos: {e}")
+            finally:
+                with app.app_context():
+                    db.session.remove()
+
+    def _beat(self):
+        """Latido de los trabajos en curso de este proceso, avancen o no (una consulta lenta o
+        un wb.save() grande no llaman a progress()): sin él otro worker los daría por caídos"""
+        with self._lock:
+            running = list(self._running)
+        if running:
+            with db.engine.begin() as conn:
+                conn.execute(db.update(Job).where(
+                    Job.id.in_(running), Job.worker == self.worker_id, Job.status == 'running',
+                ).values(heartbeat_at=datetime.now()))
+
+    def _recover_stale(self):
+        """Trabajos cuyo proceso dejó de latir: vuelven a la cola si conservan su archivo de
+        entrada y les quedan intentos; si no, quedan en error."""
+        cutoff = datetime.now() - timedelta(seconds=JOB_STALE_SECONDS)
+        stale = db.session.query(Job.id, Job.params, Job.attempts).filter(
+            Job.status == 'running', Job.heartbeat_at < cutoff).all()
+        for job_id, params, attempts in stale:
+            path = json.loads(params or '{}').get('path')
+            if attempts < JOB_MAX_ATTEMPTS and (not path or os.path.exists(path)):
+                values = {'status': 'queued', 'worker': None, 'started_at': None, 'heartbeat_at': None,
+                          'progress': 0, 'message': 'En cola (reintento tras una interrupción)'}
+            else:
+                values = {'status': 'error', 'finished_at': datetime.now(),
+                          'error': 'Interrumpido: el proceso que lo ejecutaba dejó de responder'}
+            # Condicional: otro worker puede estar recuperándolo a la vez
+            db.session.execute(db.update(Job).where(
+                Job.id == job_id, Job.status == 'running', Job.heartbeat_at < cutoff).values(**values))
+        if stale:
+            db.session.commit()
+
+    def _claim(self):
+        free = self.workers - len(self._running)
+        if free <= 0:
+            return
+        ids = [job_id for (job_id,) in db.session.query(Job.id).filter(Job.status == 'queued')
+               .order_by(Job.created_at).limit(free)]
+        db.session.rollback()
+        for job_id in ids:
+            now = datetime.now()
+            claimed = db.session.execute(db.update(Job).where(Job.id == job_id, Job.status == 'queued').values(
+                status='running', worker=self.worker_id, started_at=now, heartbeat_at=now,
+                attempts=Job.attempts + 1)).rowcount
+            db.session.commit()
+            if claimed:  # otro worker puede haberlo reclamado antes
+                with self._lock:
+                    self._running.add(job_id)
+                self._executor.submit(self._run, job_id)
+
+    def _run(self, job_id):
+        with app.app_context():
+            try:
+                job = db.session.get(Job, job_id)
+                handler = JOB_HANDLERS.get(job.kind)
+                if handler is None:
+                    raise ValueError(f'Tipo de trabajo desconocido: {job.kind}')
+                params = json.loads(job.params or '{}')
+                ctx = JobContext(job, self.worker_id)
+                db.session.rollback()
+                result = handler(ctx, **params)
+                self._finish(job_id, status='done', result=json.dumps(result, default=str))
+            except Exception as e:
+                db.session.rollback()
+                print(f"Error en trabajo {job_id}: {e}")
+                self._finish(job_id, status='error', error=str(e)[:2000])
+            finally:
+                db.session.remove()
+                with self._lock:
+                    self._running.discard(job_id)
+                self.wake()
+
+    def _finish(self, job_id, **values):
+        with db.engine.begin() as conn:
+            conn.execute(db.update(Job).where(_owned_job(job_id, self.worker_id)).values(
+                finished_at=datetime.now(), **values))
+
+job_runner = JobRunner(JOB_WORKERS)
+
+@app.before_request
+def _start_job_runner():
+    job_runner.start()  # respaldo de post_worker_init: no-op si ya está en marcha
+
+def submit_job(kind, params=None, user_id=None, job_id=None, message=None):
+    """Encola un trabajo (commit incluido) y avisa al pool de este worker. Devuelve el Job."""
+    if kind not in JOB_HANDLERS:
+        raise ValueError(f'Tipo de trabajo desconocido: {kind}')
+    job = Job(id=job_id or secrets.token_hex(16), kind=kind, params=json.dumps(params or {}),
+              user_id=user_id, message=message)
+    db.session.add(job)
+    db.session.commit()
+    job_runner.start()
+    job_runner.wake()
+    return job
+
+def cleanup_jobs(retention_days=JOB_RETENTION_DAYS):
+    """Borra trabajos terminados más antiguos que retention_days y sus archivos"""
+    cutoff = datetime.now() - timedelta(days=retention_days)
+    old = [job_id for (job_id,) in db.session.query(Job.id).filter(
+        Job.status.in_(('done', 'error')), Job.finished_at < cutoff)]
+    for job_id in old:
+        prefix = f'{job_id}'
+        if os.path.isdir(JOB_FILES_DIR):
+            for name in os.listdir(JOB_FILES_DIR):
+                if name.startswith(prefix):
+                    os.remove(os.path.join(JOB_FILES_DIR, name))
+    if old:
+        Job.query.filter(Job.id.in_(old)).delete(synchronize_session=False)
+        db.session.commit()
+    return len(old)
+
+def job_to_dict(job):
+    return {
+        'id': job.id,
+        'kind': job.kind,
+        'status': job.status,
+        'progress': job.progress,
+        'total': job.total,
+        'message': job.message or '',
+        'result': json.loads(job.result) if job.result else None,
+        'error': job.error,
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'started_at': job.started_at.isoformat() if job.started_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+def _visible_job(job_id):
+    job = db.session.get(Job, job_id)
+    if not job or (current_user.role != 'admin' and job.user_id != current_user.id):
+        return None
+    return job
+
+@app.route('/api/jobs/<job_id>')
+@login_required
+def api_job_status(job_id):
+    """Estado y progreso de un trabajo (del propio usuario, o cualquiera si es admin)"""
+    job = _visible_job(job_id)
+    if not job:
+        return jsonify({'success': False, 'msg': 'Trabajo no encontrado'}), 404
+    return jsonify({'success': True, 'job': job_to_dict(job)})
+
+@app.route('/api/jobs/<job_id>/download')
+@login_required
+def api_job_download(job_id):
+    """Archivo generado por un trabajo terminado (result con file y filename)"""
+    job = _visible_job(job_id)
+    result = json.loads(job.result) if job and job.status == 'done' and job.result else {}
+    path = job_file(job.id, result['file']) if result.get('file') else None
+    if not path or not os.path.exists(path):
+        return jsonify({'success': False, 'msg': 'Archivo no disponible'}), 404
+    return send_file(path, as_attachment=True, download_name=result.get('filename') or os.path.basename(path))
+
 # --- CONTEXT PROCESSOR ---
+# Snapshots inmutables para las cachés de proceso (no se comparten objetos ORM entre peticiones)
+ServiceTypeSnapshot = namedtuple('ServiceTypeSnapshot', 'id name color')
+TechSnapshot = namedtuple('TechSnapshot', 'id username email')
+
+service_types_cache = VersionedCache('service_types', lambda: tuple(
+    ServiceTypeSnapshot(s.id, s.name, s.color)
+    for s in ServiceType.query.order_by(ServiceType.name)))
+techs_cache = VersionedCache('techs', lambda: tuple(
+    TechSnapshot(u.id, u.username, u.email)
+    for u in User.query.filter_by(role='tech').order_by(User.id)), datasets=('users',))
+unread_alarms_cache = VersionedCache('unread_alarms', lambda: Alarm.query.filter_by(is_read=False).count(),
+                                     datasets=('alarms',))
+
+# Identidad de sesión: snapshot (id, username, role) cacheado por worker. La caché entera se
+# descarta cuando cambia la versión 'users' (alta, edición, borrado o cambio de contraseña).
+USER_IDENTITY_TTL = 60  # segundos
+
+class UserSnapshot(UserMixin, namedtuple('UserSnapshotBase', 'id username role')):
+    """Usuario autenticado sin estado ORM. Para modificarlo hay que cargar User desde la BD."""
+    __slots__ = ()
+
+user_identity_cache = CacheRegion('user_identity', ('users',))
+
+def _load_user_identity(user_id):
+    user = db.session.get(User, user_id)
+    return UserSnapshot(user.id, user.username, user.role) if user else None
+
+def cached_user_identity(user_id):
+    """Devuelve el UserSnapshot del usuario o None si ya no existe"""
+    return user_identity_cache.get(user_id, lambda: _load_user_identity(user_id), ttl=USER_IDENTITY_TTL)
+
+def cached_service_types():
+    """Tipos de servicio ordenados por nombre (una comprobación de versión por petición)"""
+    if '_service_types' not in g:
+        g._service_types = service_types_cache.get()
+    return g._service_types
+
+def cached_techs():
+    """Técnicos (role='tech') como snapshots inmutables"""
+    if '_techs' not in g:
+        g._techs = techs_cache.get()
+    return g._techs
+
+def cached_unread_alarms():
+    if '_unread_alarms' not in g:
+        g._unread_alarms = unread_alarms_cache.get()
+    return g._unread_alarms
+
 @app.context_processor
 def inject_globals():
     try:
@@ -283,14 +1903,14 @@ def inject_globals():
 
         if current_user.is_authenticated:
             try:
-                service_types = ServiceType.query.order_by(ServiceType.name).all()
+                service_types = cached_service_types()
             except Exception as e:
                 print(f"Error service types: {e}")
 
             if current_user.role == 'admin':
                 try:
-                    unread_alarms = Alarm.query.filter_by(is_read=False).count()
-                    employees = User.query.filter_by(role='tech').all()
+                    unread_alarms = cached_unread_alarms()
+                    employees = cached_techs()
                 except Exception as e:
                     print(f"Error admin data: {e}")
 
@@ -465,66 +2085,31 @@ def reset_password(token):
 @login_required
 def dashboard():
     if current_user.role == 'admin':
-        empleados = User.query.filter_by(role='tech').all()
-        clients = Client.query.order_by(Client.name).all()
-        services = ServiceType.query.all()
-        informes = Task.query.filter_by(status='Completado').order_by(Task.date.desc()).limit(50).all()
-        stock_items = Stock.query.order_by(Stock.name).all()
-        # ✅ Obtener categorías para el panel de stock
-        stock_categories = StockCategory.query.filter_by(parent_id=None).all()
+        # Mismas listas que inject_globals: caché de proceso, sin consultas repetidas
+        empleados = cached_techs()
+        services = cached_service_types()
         # ✅ NUEVO: todas las categorías (incluidas subcategorías) para el selector de edición
         all_categories = StockCategory.query.order_by(StockCategory.name).all()
+        # Clientes, stock e informes se cargan al abrir su pestaña (/api/admin/clients,
+        # /api/admin/stock y /api/reports), paginados en el servidor
         
         return render_template('admin_panel.html', 
                              empleados=empleados,
-                             clients=clients,
                              services=services,
-                             informes=informes,
-                             stock_items=stock_items,
-                             stock_categories=stock_categories,
                              all_categories=all_categories,
                              today_date=date.today().strftime('%Y-%m-%d'))
     else:
         # ✅ Solo mostrar tareas pendientes cercanas: desde ayer hasta 3 días adelante
         yesterday = date.today() - timedelta(days=1)
         three_days_ahead = date.today() + timedelta(days=3)
-        primary_pending = Task.query.filter(
-            Task.tech_id == current_user.id,
-            Task.status == 'Pendiente',
-            Task.date >= yesterday,
-            Task.date <= three_days_ahead
-        ).order_by(Task.date.asc()).all()
-        
-        # Incluir tareas donde es técnico secundario
-        extra_task_ids = db.session.query(TaskTechnician.task_id).filter_by(user_id=current_user.id).all()
-        extra_task_ids = [r[0] for r in extra_task_ids]
-        if extra_task_ids:
-            extra_pending = Task.query.filter(
-                Task.id.in_(extra_task_ids),
-                Task.tech_id != current_user.id,
-                Task.status == 'Pendiente',
-                Task.date >= yesterday,
-                Task.date <= three_days_ahead
-            ).order_by(Task.date.asc()).all()
-        else:
-            extra_pending = []
-        
-        # Incluir tareas sin técnico asignado (cualquier técnico puede verlas y completarlas)
-        unassigned_pending = Task.query.filter(
-            Task.tech_id == None,
-            Task.status == 'Sin asignar',
-            Task.date >= yesterday,
-            Task.date <= three_days_ahead
-        ).order_by(Task.date.asc()).all()
-
-        # Combinar y ordenar
-        pending_tasks_all = sorted(
-            primary_pending + extra_pending + unassigned_pending,
-            key=lambda t: (t.date, t.start_time or '')
-        )
+        # Propias, como técnico secundario y sin asignar: una sola consulta ordenada en SQL
+        pending_tasks_all = tech_agenda_query(
+            current_user.id, pending_only=True, date_from=yesterday, date_to=three_days_ahead
+        ).all()
         
         stock_items = Stock.query.filter(Stock.quantity > 0).order_by(Stock.name).all()
-        stock_categories = StockCategory.query.filter_by(parent_id=None).order_by(StockCategory.name).all()
+        stock_categories = StockCategory.query.filter_by(parent_id=None).options(
+            selectinload(StockCategory.subcategories)).order_by(StockCategory.name).all()
         
         return render_template('tech_panel.html',
                              pending_tasks=pending_tasks_all,
@@ -538,8 +2123,10 @@ def change_password():
     try:
         current_password = request.form.get('current_password')
         new_password = request.form.get('new_password')
+        # current_user es un snapshot de la caché de identidad: cargar el usuario real
+        user = db.session.get(User, current_user.id)
         
-        if not check_password_hash(current_user.password_hash, current_password):
+        if not user or not check_password_hash(user.password_hash, current_password):
             flash('Contraseña actual incorrecta', 'danger')
             return redirect(url_for('dashboard'))
         
@@ -548,7 +2135,7 @@ def change_password():
             flash(message, 'danger')
             return redirect(url_for('dashboard'))
         
-        current_user.password_hash = generate_password_hash(new_password)
+        user.password_hash = generate_password_hash(new_password)
         db.session.commit()
         
         flash('✅ Contraseña actualizada correctamente', 'success')
@@ -728,6 +2315,52 @@ def _task_duration_minutes(task):
     return 0
 
 
+# --- EXPORTACIONES CSV EN STREAMING ---
+CSV_CHUNK_BYTES = 64 * 1024   # tamaño aproximado de cada trozo enviado
+CSV_YIELD_PER = 1000          # filas por lote leído de la BD (cursor de servidor en PostgreSQL)
+SUPPORT_SCHEDULE_LABELS = {'lv': 'L-V', 'ls': 'L-S', 'ld': 'L-D'}
+
+def stream_csv(filename, header, make_rows):
+    """Respuesta CSV (';') que se escribe en el socket a trozos mientras se lee la BD.
+
+    make_rows() se llama ya durante el envío, cuando el contexto de la petición ha
+    terminado: por eso recibe uno de aplicación propio y no puede usar request.
+    La memoria no depende del tamaño de la tabla: solo un lote de filas y un trozo.
+    """
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, delimiter=';', lineterminator='\n')
+        writer.writerow(header)
+        with app.app_context():
+            try:
+                for row in make_rows():
+                    writer.writerow(row)
+                    if buffer.tell() >= CSV_CHUNK_BYTES:
+                        yield buffer.getvalue().encode('utf-8')
+                        buffer.seek(0)
+                        buffer.truncate()
+            except Exception as e:
+                print(f"Error generando {filename}: {e}")
+                raise
+            finally:
+                db.session.remove()
+        yield buffer.getvalue().encode('utf-8')
+
+    return Response(generate(), mimetype='text/csv', headers={
+        'Content-Disposition': f'attachment; filename="{filename}"',
+        'X-Accel-Buffering': 'no',  # que el proxy no acumule la respuesta entera
+    })
+
+def _csv_timestamp():
+    return datetime.now().strftime("%Y%m%d_%H%M%S")
+
+def _fulltext_filter(query, q):
+    """Limita una consulta de Task a los partes que coinciden con q (sin ordenar por relevancia)"""
+    fts = task_fulltext_match(q)
+    if fts is None:
+        return query.filter(db.false())
+    return query.join(fts, fts.c.task_id == Task.id)
+
 @app.route('/api/export_clients_csv')
 @login_required
 def export_clients_csv():
@@ -735,54 +2368,241 @@ def export_clients_csv():
     if current_user.role != 'admin':
         flash('No autorizado', 'danger')
         return redirect(url_for('dashboard'))
-    
-    try:
-        import csv
-        from io import StringIO
-        
-        # Obtener todos los clientes
-        clients = Client.query.order_by(Client.name).all()
-        
-        # Crear CSV en memoria
-        output = StringIO()
-        writer = csv.writer(output, delimiter=';', lineterminator='\n')
-        
-        # Encabezados
-        writer.writerow([
-            'Nombre', 'Teléfono', 'Email', 'Dirección', 
-            'Enlace', 'Tiene Soporte', 'Horario Soporte', 'Notas'
+
+    def rows():
+        query = db.session.query(
+            Client.name, Client.phone, Client.email, Client.address, Client.link,
+            Client.has_support, Client.support_schedule, Client.notes,
+        ).order_by(Client.name).yield_per(CSV_YIELD_PER)
+        for name, phone, email, address, link, has_support, schedule, notes in query:
+            yield [
+                name or '', phone or '', email or '', address or '', link or '',
+                'Sí' if has_support else 'No',
+                SUPPORT_SCHEDULE_LABELS.get(schedule, '—') if has_support else '—',
+                notes or '',
+            ]
+
+    return stream_csv(
+        f'clientes_oslaprint_{_csv_timestamp()}.csv',
+        ['Nombre', 'Teléfono', 'Email', 'Dirección', 'Enlace', 'Tiene Soporte', 'Horario Soporte', 'Notas'],
+        rows)
+
+def _task_export_query(*columns):
+    """Consulta solo de columnas (sin firma ni objetos ORM) con técnico y tipo de servicio"""
+    return db.session.query(*columns) \
+        .outerjoin(User, Task.tech_id == User.id) \
+        .outerjoin(ServiceType, Task.service_type_id == ServiceType.id)
+
+@app.route('/api/tasks/export.csv')
+@login_required
+def export_tasks_csv():
+    """Tareas en CSV con los mismos filtros que /api/tasks/filter (incluido q=)"""
+    if current_user.role != 'admin':
+        return jsonify({'success': False, 'msg': 'No autorizado'}), 403
+    args = request.args.copy()
+
+    def rows():
+        query = task_filters(_task_export_query(
+            Task.id, Task.date, Task.start_time, Task.end_time, Task.client_name, ServiceType.name,
+            Task.status, User.username, Task.is_remote, Task.description), args)
+        q = args.get('q', '').strip()
+        if q:
+            query = _fulltext_filter(query, q)
+        for (task_id, day, start, end, client_name, service, status, tech,
+             is_remote, description) in query.order_by(Task.date.desc(), Task.id.desc()).yield_per(CSV_YIELD_PER):
+            yield [
+                task_id, day.strftime('%d/%m/%Y') if day else '', start or '', end or '',
+                client_name or '', service or '', status or '', tech or 'Sin asignar',
+                'Sí' if is_remote else 'No', description or '',
+            ]
+
+    return stream_csv(
+        f'tareas_{_csv_timestamp()}.csv',
+        ['ID', 'Fecha', 'Inicio', 'Fin', 'Cliente', 'Servicio', 'Estado', 'Técnico', 'Remota', 'Descripción'],
+        rows)
+
+@app.route('/api/reports/export.csv')
+@login_required
+def export_reports_csv():
+    """Partes completados en CSV con los mismos filtros que /api/reports (incluido q=)"""
+    if current_user.role != 'admin':
+        return jsonify({'success': False, 'msg': 'No autorizado'}), 403
+    args = request.args.copy()
+
+    def rows():
+        query = report_filters(_task_export_query(
+            Task.id, Task.date, Task.client_name, ServiceType.name, Task.is_remote, User.username,
+            Task.parte_transport_start, Task.parte_arrival, Task.parte_work_start, Task.parte_work_end,
+            Task.work_duration, Task.remote_support_hours, Task.description, Task.parts_text), args)
+        q = args.get('q', '').strip()
+        if q:
+            query = _fulltext_filter(query, q)
+        for (task_id, day, client_name, service, is_remote, tech, transport_start, arrival,
+             work_start, work_end, duration, remote_hours, description, parts) in \
+                query.order_by(Task.date.desc(), Task.id.desc()).yield_per(CSV_YIELD_PER):
+            yield [
+                task_id, day.strftime('%d/%m/%Y') if day else '', client_name or '',
+                service or ('Asistencia Remota' if is_remote else ''), tech or 'Sin técnico',
+                transport_start or '', arrival or '', work_start or '', work_end or '',
+                duration or '', task_transport_duration(transport_start, arrival),
+                remote_hours or 0, description or '', parts or '',
+            ]
+
+    return stream_csv(
+        f'informes_{_csv_timestamp()}.csv',
+        ['ID', 'Fecha', 'Cliente', 'Servicio', 'Técnico', 'Salida', 'Llegada', 'Inicio trabajo',
+         'Fin trabajo', 'Duración', 'Desplazamiento', 'Horas remotas', 'Descripción', 'Piezas'],
+        rows)
+
+
+# --- EXPORTACIÓN XLSX DE PARTES (openpyxl en modo write_only) ---
+REPORT_XLSX_INLINE_ROWS = 2000   # por encima se genera como trabajo en segundo plano
+REPORT_XLSX_GROUPS = {
+    # group → (columna de agrupación, título de la columna "contraria" en cada hoja)
+    'tech': (User.username, 'Cliente'),
+    'client': (Task.client_name, 'Técnico'),
+}
+REPORT_XLSX_HEADER = ['Fecha', None, 'Servicio', 'Salida', 'Llegada', 'Inicio trabajo', 'Fin trabajo',
+                      'Duración', 'Desplazamiento', 'Horas remotas', 'Descripción', 'Piezas']
+
+def _xlsx_sheet_title(name, used):
+    """Título de hoja válido para Excel (31 caracteres, sin []:*?/\\ ni comillas en los
+    extremos) y sin repetir"""
+    from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+    base = re.sub(r'[\[\]:*?/\\]', ' ', ILLEGAL_CHARACTERS_RE.sub('', name or ''))
+    base = base.strip().strip("'").strip()[:31] or 'Sin nombre'
+    title, n = base, 2
+    while title.lower() in used:
+        suffix = f' ({n})'
+        title, n = base[:31 - len(suffix)] + suffix, n + 1
+    used.add(title.lower())
+    return title
+
+def _xlsx_text(sheet, value):
+    """Celda de texto literal: un valor que empiece por '=' no se convierte en fórmula y se
+    quitan los caracteres de control que openpyxl rechaza (texto libre: partes, clientes)"""
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+    cell = WriteOnlyCell(sheet, value=ILLEGAL_CHARACTERS_RE.sub('', str(value or '')))
+    cell.data_type = 's'
+    return cell
+
+def report_xlsx_query(args, group):
+    """Partes completados solo con las columnas del Excel (nunca la firma), en orden de hoja"""
+    group_col = REPORT_XLSX_GROUPS[group][0]
+    other_col = Task.client_name if group == 'tech' else User.username
+    query = report_filters(_task_export_query(
+        group_col, other_col, Task.date, ServiceType.name, Task.is_remote,
+        Task.parte_transport_start, Task.parte_arrival, Task.parte_work_start, Task.parte_work_end,
+        Task.work_duration, Task.remote_support_hours, Task.description, Task.parts_text), args)
+    q = args.get('q', '').strip()
+    if q:
+        query = _fulltext_filter(query, q)
+    return query.order_by(group_col, Task.date, Task.id)
+
+def build_reports_xlsx(target, args, group, progress=None):
+    """Escribe el Excel de partes en target (ruta o archivo) con una hoja por técnico o cliente
+    y una hoja Resumen. Filas leídas por lotes y volcadas al momento: la memoria no crece
+    con el rango. Devuelve el número de partes escritos."""
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font
+
+    wb = Workbook(write_only=True)
+    summary = wb.create_sheet('Resumen')
+    summary.append(['Técnico' if group == 'tech' else 'Cliente', 'Partes', 'Horas remotas'])
+    header = [title or REPORT_XLSX_GROUPS[group][1] for title in REPORT_XLSX_HEADER]
+    used, totals = {'resumen'}, []
+    sheet, current, count = None, _MISSING, 0
+    for (key, other, day, service, is_remote, transport_start, arrival, work_start, work_end,
+         duration, remote_hours, description, parts) in report_xlsx_query(args, group).yield_per(CSV_YIELD_PER):
+        if key != current:
+            if sheet is not None:
+                sheet.close()  # una sola hoja abierta a la vez
+            current = key
+            name = key or ('Sin técnico' if group == 'tech' else 'Sin cliente')
+            sheet = wb.create_sheet(_xlsx_sheet_title(name, used))
+            sheet.freeze_panes = 'A2'
+            sheet.column_dimensions['B'].width = 30
+            sheet.column_dimensions['K'].width = 60
+            bold = []
+            for title in header:
+                cell = WriteOnlyCell(sheet, value=title)
+                cell.font = Font(bold=True)
+                bold.append(cell)
+            sheet.append(bold)
+            totals.append([name, 0, 0.0])
+        sheet.append([
+            day, *(_xlsx_text(sheet, v) for v in (
+                other, service or ('Asistencia Remota' if is_remote else ''),
+                transport_start, arrival, work_start, work_end, duration)),
+            task_transport_duration(transport_start, arrival), remote_hours or 0,
+            _xlsx_text(sheet, description), _xlsx_text(sheet, parts),
         ])
-        
-        # Datos de clientes
-        for client in clients:
-            support_schedule_map = {'lv': 'L-V', 'ls': 'L-S', 'ld': 'L-D'}
-            schedule_display = support_schedule_map.get(client.support_schedule, '—') if client.has_support else '—'
-            
-            writer.writerow([
-                client.name or '',
-                client.phone or '',
-                client.email or '',
-                client.address or '',
-                client.link or '',
-                'Sí' if client.has_support else 'No',
-                schedule_display,
-                client.notes or ''
-            ])
-        
-        # Crear respuesta con descarga
-        output.seek(0)
-        return send_file(
-            io.BytesIO(output.getvalue().encode('utf-8')),
-            mimetype='text/csv',
-            as_attachment=True,
-            download_name=f'clientes_oslaprint_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv'
-        )
-    except Exception as e:
-        print(f"Error exporting clients: {str(e)}")
-        flash('Error al exportar clientes', 'danger')
-        return redirect(url_for('dashboard'))
+        totals[-1][1] += 1
+        totals[-1][2] += remote_hours or 0
+        count += 1
+        if progress and count % CSV_YIELD_PER == 0:
+            progress(count)
+    if sheet is None:
+        wb.create_sheet('Partes').append(header)
+    for name, partes, hours in totals:
+        summary.append([_xlsx_text(summary, name), partes, round(hours, 2)])
+    summary.append(['TOTAL', count, round(sum(t[2] for t in totals), 2)])
+    wb.save(target)
+    return count
+
+def _reports_xlsx_filename(args, group):
+    span = '_'.join(v.replace('-', '') for v in (args.get('date_from', ''), args.get('date_to', '')) if v)
+    return f'partes_por_{"tecnico" if group == "tech" else "cliente"}{"_" + span if span else ""}.xlsx'
+
+@job_handler('reports_xlsx')
+def reports_xlsx_job(ctx, args, group, total):
+    filename = _reports_xlsx_filename(args, group)
+    ctx.progress(0, total=total, message='Generando Excel...')
+    count = build_reports_xlsx(ctx.file('.xlsx'), MultiDict(args), group,
+                               progress=lambda done: ctx.progress(done, message=f'{done} de {total} partes'))
+    ctx.progress(count, total=count, message=f'{count} partes exportados')
+    return {'file': '.xlsx', 'filename': filename, 'rows': count}
+
+@app.route('/api/reports/export.xlsx')
+@login_required
+def export_reports_xlsx():
+    """Partes completados en Excel, una hoja por técnico (group=tech) o cliente (group=client),
+    con los filtros de /api/reports. Rangos grandes: 202 con job_id y descarga en
+    /api/jobs/<id>/download cuando termine."""
+    if current_user.role != 'admin':
+        return jsonify({'success': False, 'msg': 'No autorizado'}), 403
+    group = request.args.get('group', 'tech')
+    if group not in REPORT_XLSX_GROUPS:
+        return jsonify({'success': False, 'msg': 'Agrupación no válida (tech o client)'}), 400
+
+    total = report_xlsx_query(request.args, group).order_by(None).count()
+    if total > REPORT_XLSX_INLINE_ROWS:
+        job = submit_job('reports_xlsx', {'args': request.args.to_dict(), 'group': group, 'total': total},
+                         user_id=current_user.id, message='En cola')
+        return jsonify({'success': True, 'job_id': job.id, 'total': total,
+                        'msg': f'Generando el Excel de {total} partes'}), 202
+
+    output = io.BytesIO()
+    build_reports_xlsx(output, request.args, group)
+    output.seek(0)
+    return send_file(
+        output,
+        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        as_attachment=True,
+        download_name=_reports_xlsx_filename(request.args, group)
+    )
 
 
+def _remote_hours_limit_arg(form):
+    """Límite mensual de soporte remoto del formulario de cliente; vacío o no válido = por defecto"""
+    try:
+        value = float(form.get('remote_hours_limit', '').strip().replace(',', '.'))
+    except ValueError:
+        return None
+    return value if 0 <= value <= 744 else None
+
 @app.route('/manage_clients', methods=['POST'])
 @login_required
 def manage_clients():
@@ -801,6 +2621,7 @@ def manage_clients():
         notes = request.form.get('notes', '')
         has_support = request.form.get('has_support') == 'on'
         support_schedule = request.form.get('support_schedule', '').strip() if has_support else None
+        remote_hours_limit = _remote_hours_limit_arg(request.form)
 
         # Validaciones básicas
         if not name:
@@ -824,7 +2645,8 @@ def manage_clients():
             link=link,
             notes=notes,
             has_support=has_support,
-            support_schedule=support_schedule if has_support else None
+            support_schedule=support_schedule if has_support else None,
+            remote_hours_limit=remote_hours_limit
         )
         db.session.add(new_client)
         db.session.commit()
@@ -858,6 +2680,7 @@ def manage_clients():
                 client.support_schedule = sched if sched in ('lv', 'ls', 'ld') else 'lv'
             else:
                 client.support_schedule = None
+            client.remote_hours_limit = _remote_hours_limit_arg(request.form)
             
             db.session.commit()
             flash('Cliente actualizado correctamente', 'success')
@@ -1024,6 +2847,7 @@ def manage_stock():
                 return jsonify({'success': False, 'msg': f'Stock insuficiente. Stock actual: {item.quantity}'})
 
             item.quantity = new_qty
+            record_stock_movement(item, adjustment, 'ajuste')
             db.session.commit()
             check_low_stock()
             return jsonify({'success': True, 'msg': 'Stock ajustado', 'new_quantity': item.quantity})
@@ -1039,6 +2863,8 @@ def manage_stock():
             item = Stock.query.get(int(item_id))
             if not item:
                 return jsonify({'success': False, 'msg': 'Artículo no encontrado'})
+            StockMovement.query.filter_by(stock_id=item.id).delete()
+            StockForecast.query.filter_by(stock_id=item.id).delete()
             db.session.delete(item)
             db.session.commit()
             return jsonify({'success': True, 'msg': 'Artículo eliminado'})
@@ -1118,6 +2944,416 @@ def manage_stock_categories():
         print(f"Error inesperado en manage_stock_categories: {str(e)}")
         return jsonify({'success': False, 'msg': f'Error: {str(e)}'})
 
+# --- IMPORTACIÓN / AJUSTE MASIVO DE STOCK ---
+STOCK_IMPORT_MAX_ROWS = 5000
+# Cabeceras aceptadas (normalizadas) → campo interno
+STOCK_IMPORT_COLUMNS = {
+    'id': 'id',
+    'nombre': 'name', 'name': 'name', 'articulo': 'name', 'producto': 'name',
+    'cantidad': 'quantity', 'quantity': 'quantity', 'unidades': 'quantity',
+    'minimo': 'min_stock', 'stock minimo': 'min_stock', 'min_stock': 'min_stock',
+    'proveedor': 'supplier', 'supplier': 'supplier',
+    'categoria': 'category', 'category': 'category',
+    'descripcion': 'description', 'description': 'description',
+}
+
+def _read_import_rows(stream, filename):
+    """Lee un CSV (',' o ';') o XLSX y devuelve (cabeceras, iterador de filas como listas)"""
+    if (filename or '').lower().endswith('.xlsx'):
+        from openpyxl import load_workbook
+        wb = load_workbook(stream, read_only=True, data_only=True)
+        rows = wb.active.iter_rows(values_only=True)
+        header = next(rows, None) or []
+        return list(header), rows
+    import csv
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    first_line = text.readline()
+    delimiter = ';' if first_line.count(';') > first_line.count(',') else ','
+    header = next(csv.reader([first_line], delimiter=delimiter), [])
+    return header, csv.reader(text, delimiter=delimiter)
+
+def _parse_int_cell(value, field, errors, allow_negative=False):
+    if value is None or str(value).strip() == '':
+        return None
+    try:
+        number = int(float(str(value).strip().replace(',', '.')))
+    except (ValueError, TypeError):
+        errors.append(f'{field} debe ser un número entero')
+        return None
+    if number < 0 and not allow_negative:
+        errors.append(f'{field} no puede ser negativo')
+    return number
+
+@app.route('/api/stock/import', methods=['POST'])
+@login_required
+def import_stock():
+    """Alta/ajuste masivo de stock desde CSV o XLSX en una sola transacción.
+
+    mode=adjust (por defecto): la cantidad se suma al stock actual (albarán de proveedor).
+    mode=set: la cantidad sustituye al stock actual (inventario).
+    Si alguna fila es inválida no se aplica nada; dry_run=1 solo valida.
+    """
+    if current_user.role != 'admin':
+        return jsonify({'success': False, 'msg': 'No autorizado'}), 403
+
+    file = request.files.get('file')
+    if not file or not file.filename:
+        return jsonify({'success': False, 'msg': 'No se envió ningún archivo'}), 400
+    if not file.filename.lower().endswith(('.csv', '.txt', '.xlsx')):
+        return jsonify({'success': False, 'msg': 'Solo se aceptan archivos CSV o XLSX'}), 400
+    mode = request.form.get('mode', 'adjust')
+    if mode not in ('adjust', 'set'):
+        return jsonify({'success': False, 'msg': 'Modo no válido (adjust o set)'}), 400
+    dry_run = request.form.get('dry_run') in ('1', 'true', 'on')
+
+    try:
+        header, raw_rows = _read_import_rows(file.stream, file.filename)
+        columns = [STOCK_IMPORT_COLUMNS.get(normalize_search_text(str(h or ''))) for h in header]
+        if 'name' not in columns and 'id' not in columns:
+            return jsonify({'success': False, 'msg': 'El archivo necesita una columna "nombre" o "id"'}), 400
+
+        # 1. Parseo y validación de formato (sin tocar la BD)
+        parsed = []
+        for line_no, raw in enumerate(raw_rows, start=2):
+            values = {col: raw[i] for i, col in enumerate(columns) if col and i < len(raw)}
+            if not any(v not in (None, '') for v in values.values()):
+                continue
+            if len(parsed) >= STOCK_IMPORT_MAX_ROWS:
+                return jsonify({'success': False, 'msg': f'Máximo {STOCK_IMPORT_MAX_ROWS} filas por importación'}), 400
+            errors = []
+            row = {
+                'line': line_no,
+                'id': _parse_int_cell(values.get('id'), 'id', errors),
+                'name': str(values.get('name') or '').strip(),
+                'quantity': _parse_int_cell(values.get('quantity'), 'cantidad', errors, allow_negative=(mode == 'adjust')),
+                'min_stock': _parse_int_cell(values.get('min_stock'), 'mínimo', errors),
+                'supplier': str(values['supplier']).strip() if values.get('supplier') not in (None, '') else None,
+                'category': str(values['category']).strip() if values.get('category') not in (None, '') else None,
+                'description': str(values['description']).strip() if values.get('description') not in (None, '') else None,
+                'errors': errors,
+            }
+            if not row['id'] and not row['name']:
+                errors.append('Falta el nombre o el id del artículo')
+            if len(row['name']) > 100:
+                errors.append('El nombre supera los 100 caracteres')
+            parsed.append(row)
+
+        # 2. Resolver artículos y categorías existentes con consultas por lotes. Al aplicar, las
+        # filas quedan bloqueadas hasta el commit: las cantidades se calculan sobre item.quantity
+        # y un parte que consumiera stock entretanto se perdería al escribirlas.
+        ids = {r['id'] for r in parsed if r['id']}
+        keys = {normalize_search_text(r['name']) for r in parsed if not r['id'] and r['name']}
+        # Primero los ids (sin bloquear) y después una sola pasada en orden de id: dos
+        # importaciones (o una importación y un parte) bloquean siempre en el mismo orden
+        id_list, key_list = list(ids), list(keys)
+        stock_ids = set()
+        for i in range(0, len(id_list), 500):
+            stock_ids.update(item_id for (item_id,) in db.session.query(Stock.id).filter(
+                Stock.id.in_(id_list[i:i + 500])))
+        for i in range(0, len(key_list), 500):
+            stock_ids.update(item_id for (item_id,) in db.session.query(Stock.id).filter(
+                Stock.name_search.in_(key_list[i:i + 500])))
+        stock_query = Stock.query.order_by(Stock.id)
+        if not dry_run:
+            stock_query = stock_query.with_for_update().populate_existing()
+        by_id, by_key = {}, {}
+        stock_ids = sorted(stock_ids)
+        for i in range(0, len(stock_ids), 500):
+            for item in stock_query.filter(Stock.id.in_(stock_ids[i:i + 500])):
+                if item.id in ids:
+                    by_id[item.id] = item
+                if item.name_search in keys:
+                    by_key.setdefault(item.name_search, []).append(item)
+        categories = {normalize_search_text(c.name): c.id for c in StockCategory.query.all()}
+
+        # 3. Validación contra la BD y cálculo del resultado por artículo
+        updates, inserts, seen, original_qty, stock_items = {}, {}, set(), {}, {}
+        for row in parsed:
+            errors = row['errors']
+            category_id = None
+            if row['category']:
+                category_id = categories.get(normalize_search_text(row['category']))
+                if category_id is None:
+                    errors.append(f'La categoría "{row["category"]}" no existe')
+
+            item = None
+            if row['id']:
+                item = by_id.get(row['id'])
+                if not item:
+                    errors.append(f'No existe ningún artículo con id {row["id"]}')
+            elif row['name']:
+                matches = by_key.get(normalize_search_text(row['name']), [])
+                if len(matches) > 1:
+                    errors.append('Hay varios artículos con ese nombre; indica la columna id')
+                elif matches:
+                    item = matches[0]
+
+            target = ('id', item.id) if item else ('new', normalize_search_text(row['name']))
+            if target in seen and mode == 'set':
+                errors.append('Artículo repetido en el archivo')
+            seen.add(target)
+            if errors:
+                row['status'] = 'error'
+                continue
+
+            if item:
+                original_qty.setdefault(item.id, item.quantity or 0)
+                stock_items[item.id] = item
+                change = updates.setdefault(item.id, {'id': item.id, 'quantity': item.quantity or 0})
+                if row['quantity'] is not None:
+                    change['quantity'] = (change['quantity'] + row['quantity']) if mode == 'adjust' else row['quantity']
+                for field in ('min_stock', 'supplier', 'description'):
+                    if row[field] is not None:
+                        change[field] = row[field]
+                if category_id:
+                    change['category_id'] = category_id
+                if change['quantity'] < 0:
+                    errors.append(f'El ajuste deja el stock en negativo (actual: {item.quantity})')
+                    row['status'] = 'error'
+                    continue
+                row['status'] = 'updated'
+                row['stock_id'] = item.id
+            else:
+                if not row['name']:
+                    errors.append('Falta el nombre para crear el artículo')
+                    row['status'] = 'error'
+                    continue
+                new = inserts.setdefault(target[1], {
+                    'name': row['name'], 'name_search': target[1][:100], 'quantity': 0,
+                    'min_stock': 5, 'supplier': '', 'description': '', 'category_id': None,
+                })
+                qty = row['quantity'] or 0
+                if qty < 0:
+                    errors.append('No se puede crear un artículo con cantidad negativa')
+                    row['status'] = 'error'
+                    continue
+                new['quantity'] += qty
+                for field in ('min_stock', 'supplier', 'description'):
+                    if row[field] is not None:
+                        new[field] = row[field]
+                if category_id:
+                    new['category_id'] = category_id
+                row['status'] = 'created'
+
+        report = [{
+            'line': r['line'],
+            'name': r['name'] or (by_id[r['id']].name if r['id'] in by_id else ''),
+            'status': r['status'],
+            'errors': r['errors'],
+        } for r in parsed]
+        error_count = sum(1 for r in parsed if r['status'] == 'error')
+        summary = {
+            'rows': len(parsed),
+            'created': len(inserts),
+            'updated': len(updates),
+            'errors': error_count,
+        }
+
+        if error_count or dry_run or not parsed:
+            ok = not error_count and bool(parsed)
+            if not parsed:
+                msg = 'El archivo no contiene filas'
+            elif error_count:
+                msg = f'{error_count} filas con errores: no se ha aplicado ningún cambio'
+            else:
+                msg = 'Validación correcta (simulación, sin cambios)'
+            return jsonify({'success': ok, 'applied': False, 'msg': msg, 'summary': summary, 'rows': report})
+
+        # 4. Aplicar en una sola transacción con operaciones masivas. Las actualizaciones
+        # masivas no pasan por los eventos del ORM: los avisos de stock bajo se preparan aquí
+        low_events = []
+        for item_id, change in updates.items():
+            item = stock_items[item_id]
+            min_stock = change.get('min_stock', item.min_stock) or 0
+            if original_qty[item_id] > min_stock >= change['quantity']:
+                low_events.append({'type': 'stock.low', 'id': item_id, 'name': item.name,
+                                   'quantity': change['quantity'], 'min_stock': min_stock})
+        if updates:
+            db.session.execute(db.update(Stock), list(updates.values()))
+            now = datetime.now()
+            movements = [{
+                'stock_id': item_id, 'user_id': current_user.id, 'action': 'importacion',
+                'quantity': change['quantity'] - original_qty[item_id], 'created_at': now,
+            } for item_id, change in updates.items() if change['quantity'] != original_qty[item_id]]
+            if movements:
+                db.session.execute(db.insert(StockMovement), movements)
+        if inserts:
+            db.session.execute(db.insert(Stock), list(inserts.values()))
+        bump_data_versions(db.session, ['stock'])
+        db.session.commit()
+        check_low_stock()
+        publish_live_events(low_events)
+
+        return jsonify({
+            'success': True,
+            'applied': True,
+            'msg': f'{summary["created"]} artículos creados y {summary["updated"]} actualizados',
+            'summary': summary,
+            'rows': report,
+        })
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        print(f"Error SQLAlchemy en import_stock: {e}")
+        return jsonify({'success': False, 'msg': 'Error al guardar en la base de datos'}), 500
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error en import_stock: {e}")
+        return jsonify({'success': False, 'msg': f'Error al procesar el archivo: {str(e)}'}), 500
+
+# --- PREVISIÓN DE CONSUMO DE STOCK ---
+FORECAST_WINDOW_DAYS = 90     # histórico usado para calcular el consumo diario
+FORECAST_MIN_DAYS = 14        # artículos con menos historia: se usa al menos este periodo
+FORECAST_LEAD_DAYS = 7        # plazo de entrega habitual del proveedor
+FORECAST_SAFETY_DAYS = 7      # margen de seguridad sobre el plazo de entrega
+FORECAST_TARGET_DAYS = 30     # cobertura objetivo tras recibir el pedido
+FORECAST_MAX_AGE_HOURS = 24   # la API recalcula si la última previsión es más antigua
+
+def refresh_stock_forecast(full=False):
+    """Recalcula la previsión de consumo de stock con una única agregación SQL.
+
+    Incremental (por defecto): solo los artículos con movimientos desde la última
+    ejecución, con movimientos que han salido de la ventana o sin previsión.
+    full=True recalcula todos. Devuelve el número de artículos actualizados.
+    """
+    now = datetime.now()
+    since = now - timedelta(days=FORECAST_WINDOW_DAYS)
+    consumption = StockMovement.action.in_(STOCK_CONSUMPTION_ACTIONS)
+
+    query = db.session.query(
+        Stock.id, Stock.quantity,
+        db.func.coalesce(db.func.sum(db.case((consumption, -StockMovement.quantity), else_=0)), 0),
+        db.func.min(StockMovement.created_at),
+    ).outerjoin(StockMovement, db.and_(
+        StockMovement.stock_id == Stock.id,
+        StockMovement.created_at >= since,
+    )).group_by(Stock.id, Stock.quantity)
+
+    last_run = db.session.query(db.func.max(StockForecast.computed_at)).scalar()
+    if not full and last_run:
+        dropped_since = last_run - timedelta(days=FORECAST_WINDOW_DAYS)
+        changed = db.session.query(StockMovement.stock_id).filter(db.or_(
+            StockMovement.created_at >= last_run,
+            db.and_(StockMovement.created_at >= dropped_since, StockMovement.created_at < since),
+        ))
+        missing = db.session.query(Stock.id).filter(
+            ~db.session.query(StockForecast.stock_id).filter(StockForecast.stock_id == Stock.id).exists())
+        query = query.filter(db.or_(Stock.id.in_(changed), Stock.id.in_(missing)))
+
+    rows = []
+    for stock_id, quantity, consumed, first_movement in query:
+        consumed = max(consumed or 0, 0)
+        days = FORECAST_WINDOW_DAYS
+        if first_movement:
+            days = min(days, max((now - first_movement).days, FORECAST_MIN_DAYS))
+        rate = consumed / days
+        quantity = quantity or 0
+        reorder_point = math.ceil(rate * (FORECAST_LEAD_DAYS + FORECAST_SAFETY_DAYS))
+        suggested = 0
+        if rate > 0 and quantity <= reorder_point:
+            suggested = max(math.ceil(rate * (FORECAST_LEAD_DAYS + FORECAST_TARGET_DAYS)) - quantity, 0)
+        rows.append({
+            'stock_id': stock_id,
+            'daily_rate': round(rate, 4),
+            'days_of_cover': round(quantity / rate, 1) if rate > 0 else None,
+            'reorder_point': reorder_point,
+            'suggested_qty': suggested,
+            'computed_at': now,
+        })
+
+    if rows:
+        existing = set()
+        ids = [r['stock_id'] for r in rows]
+        for i in range(0, len(ids), 500):
+            existing.update(row[0] for row in db.session.query(StockForecast.stock_id).filter(
+                StockForecast.stock_id.in_(ids[i:i + 500])))
+        updates = [r for r in rows if r['stock_id'] in existing]
+        inserts = [r for r in rows if r['stock_id'] not in existing]
+        if updates:
+            db.session.execute(db.update(StockForecast), updates)
+        if inserts:
+            db.session.execute(db.insert(StockForecast), inserts)
+    db.session.commit()
+    return len(rows)
+
+@app.cli.command('forecast-stock')
+@click.option('--full', is_flag=True, help='Recalcular todos los artículos, no solo los modificados')
+def forecast_stock_command(full):
+    """Recalcula la previsión de consumo de stock (pensado para un cron nocturno)."""
+    count = refresh_stock_forecast(full=full)
+    print(f"✓ Previsión de stock actualizada: {count} artículos")
+
+@app.route('/api/stock/forecast')
+@login_required
+def stock_forecast():
+    """Previsión de consumo agrupada por proveedor: días de cobertura y cantidad sugerida a pedir.
+
+    ?reorder=1 devuelve solo los artículos que conviene pedir ya.
+    """
+    if current_user.role != 'admin':
+        return jsonify({'success': False, 'msg': 'No autorizado'}), 403
+    try:
+        last_run = db.session.query(db.func.max(StockForecast.computed_at)).scalar()
+        if not last_run or last_run < datetime.now() - timedelta(hours=FORECAST_MAX_AGE_HOURS):
+            refresh_stock_forecast()
+            last_run = db.session.query(db.func.max(StockForecast.computed_at)).scalar()
+
+        query = db.session.query(Stock, StockForecast).join(
+            StockForecast, StockForecast.stock_id == Stock.id)
+        if request.args.get('reorder') == '1':
+            query = query.filter(StockForecast.suggested_qty > 0)
+
+        suppliers = {}
+        for item, forecast in query.order_by(Stock.supplier, Stock.name):
+            supplier = item.supplier or 'Sin proveedor'
+            group = suppliers.setdefault(supplier, {
+                'supplier': supplier, 'suggested_qty': 0, 'items_to_order': 0,
+                'min_days_of_cover': None, 'items': [],
+            })
+            group['items'].append({
+                'id': item.id,
+                'name': item.name,
+                'quantity': item.quantity,
+                'min_stock': item.min_stock,
+                'daily_rate': forecast.daily_rate,
+                'days_of_cover': forecast.days_of_cover,
+                'reorder_point': forecast.reorder_point,
+                'suggested_qty': forecast.suggested_qty,
+            })
+            if forecast.suggested_qty:
+                group['suggested_qty'] += forecast.suggested_qty
+                group['items_to_order'] += 1
+            if forecast.days_of_cover is not None and (
+                    group['min_days_of_cover'] is None or forecast.days_of_cover < group['min_days_of_cover']):
+                group['min_days_of_cover'] = forecast.days_of_cover
+
+        return jsonify({
+            'success': True,
+            'computed_at': last_run.isoformat() if last_run else None,
+            'window_days': FORECAST_WINDOW_DAYS,
+            'lead_days': FORECAST_LEAD_DAYS + FORECAST_SAFETY_DAYS,
+            'suppliers': sorted(suppliers.values(),
+                                key=lambda grp: (-grp['items_to_order'], grp['min_days_of_cover'] is None,
+                                                 grp['min_days_of_cover'] or 0)),
+        })
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        print(f"Error en stock_forecast: {e}")
+        return jsonify({'success': False, 'msg': 'Error al calcular la previsión'}), 500
+
+@app.route('/api/stock/forecast/refresh', methods=['POST'])
+@login_required
+def refresh_stock_forecast_route():
+    """Fuerza el recálculo de la previsión (full=1 para todos los artículos)"""
+    if current_user.role != 'admin':
+        return jsonify({'success': False, 'msg': 'No autorizado'}), 403
+    try:
+        count = refresh_stock_forecast(full=request.form.get('full') == '1')
+        return jsonify({'success': True, 'msg': f'Previsión actualizada ({count} artículos)', 'updated': count})
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        print(f"Error en refresh_stock_forecast: {e}")
+        return jsonify({'success': False, 'msg': 'Error al calcular la previsión'}), 500
+
 @app.route('/save_report', methods=['POST'])
 @login_required
 def save_report():
@@ -1197,24 +3433,15 @@ def save_report():
                             'id': stock_item.id,
                             'name': stock_item.name,
                             'quantity': qty,
-                            'action': action
+                            'action': action,
+                            'item': stock_item
                         })
         
         # Si hay una cita vinculada, actualizar esa tarea
         if linked_task_id and linked_task_id != 'none':
-            task = Task.query.get(int(linked_task_id))
             # Permitir completar si: técnico asignado, técnico secundario, admin, o tarea sin asignar
-            _is_extra = task and db.session.query(TaskTechnician).filter_by(
-                task_id=task.id, user_id=current_user.id).first()
-            _can_complete = (
-                task and (
-                    current_user.role == 'admin'
-                    or task.tech_id == current_user.id
-                    or bool(_is_extra)
-                    or task.tech_id is None
-                )
-            )
-            if _can_complete:
+            task, caps = task_access(int(linked_task_id))
+            if 'complete' in caps:
                 # Si la tarea estaba sin asignar, registrar al técnico que la completa
                 if task.tech_id is None and current_user.role == 'tech':
                     task.tech_id = current_user.id
@@ -1239,6 +3466,9 @@ def save_report():
                 if parte_work_end:        task.parte_work_end        = parte_work_end
                 
                 # Guardar items de stock
+                for used in stock_items_used:
+                    delta = used['quantity'] if used['action'] == 'devolver' else -used['quantity']
+                    record_stock_movement(used['item'], delta, used['action'], task=task)
                 if stock_items_used:
                     task.stock_item_id = stock_items_used[0]['id']
                     task.stock_quantity_used = stock_items_used[0]['quantity']
@@ -1319,6 +3549,9 @@ def save_report():
         )
         
         # Guardar items de stock
+        for used in stock_items_used:
+            delta = used['quantity'] if used['action'] == 'devolver' else -used['quantity']
+            record_stock_movement(used['item'], delta, used['action'], task=new_task)
         if stock_items_used:
             new_task.stock_item_id = stock_items_used[0]['id']
             new_task.stock_quantity_used = stock_items_used[0]['quantity']
@@ -1368,9 +3601,11 @@ def save_report():
 @app.route('/upload_task_file/<int:task_id>', methods=['POST'])
 @login_required
 def upload_task_file(task_id):
-    task = Task.query.get_or_404(task_id)
-    
-    if current_user.role != 'admin' and current_user.id != task.tech_id:
+    task, caps = task_access(task_id)
+    if not task:
+        abort(404)
+    # Solo admin o técnico principal (como antes de task_access), no secundarios ni sin asignar
+    if 'edit' not in caps:
         return jsonify({'success': False, 'msg': 'No autorizado'}), 403
     
     if 'file' not in request.files:
@@ -1444,6 +3679,226 @@ def parte_draft():
 
 # --- API ENDPOINTS ---
 
+# Peticiones agrupadas: varias lecturas GET de la API en una sola ida y vuelta
+BATCH_MAX_REQUESTS = 20
+BATCH_EXCLUDED_PATHS = {'/api/batch', '/api/events/stream'}
+
+def _batch_subrequest(path, query_string):
+    """Ejecuta un GET interno reutilizando el contexto de aplicación, la sesión y el usuario.
+
+    El contexto de aplicación (y con él g, la sesión de BD y current_user) es el de la
+    petición /api/batch, así que load_user y las cachés de g se resuelven una sola vez.
+    """
+    environ = dict(request.environ)
+    environ.pop('werkzeug.request', None)
+    environ.update({
+        'REQUEST_METHOD': 'GET',
+        'PATH_INFO': path,
+        'QUERY_STRING': query_string,
+        'CONTENT_LENGTH': '0',
+        'wsgi.input': io.BytesIO(b''),
+    })
+    ctx = app.request_context(environ)
+    ctx.session = session._get_current_object()
+    with ctx:
+        response = app.full_dispatch_request()
+    try:
+        body = response.get_json(silent=True) if response.is_json else None
+    finally:
+        response.close()
+    return response.status_code, body
+
+@app.route('/api/batch', methods=['POST'])
+@login_required
+def api_batch():
+    """Resuelve varias peticiones GET de la API y devuelve sus respuestas JSON juntas.
+
+    Cuerpo: {"requests": ["/api/admin/tech_colors", {"id": "cats", "url": "/api/stock_categories?items=0"}]}
+    Respuesta: {"success": true, "responses": [{"id", "url", "status", "body"}, ...]} en el mismo orden.
+    Cada subpetición aplica sus propios permisos; solo se admiten rutas /api/ de lectura.
+    """
+    payload = request.get_json(silent=True) or {}
+    items = payload.get('requests')
+    if not isinstance(items, list) or not items:
+        return jsonify({'success': False, 'msg': 'Lista de peticiones vacía'}), 400
+    if len(items) > BATCH_MAX_REQUESTS:
+        return jsonify({'success': False, 'msg': f'Máximo {BATCH_MAX_REQUESTS} peticiones por lote'}), 400
+
+    responses = []
+    for i, item in enumerate(items):
+        if isinstance(item, str):
+            item = {'url': item}
+        url = item.get('url') if isinstance(item, dict) else None
+        entry = {'id': item.get('id', i) if isinstance(item, dict) else i, 'url': url}
+        path, _, query_string = (url or '').partition('?')
+        if not path.startswith('/api/') or path in BATCH_EXCLUDED_PATHS:
+            entry.update(status=400, body={'success': False, 'msg': 'URL no permitida'})
+        else:
+            try:
+                entry['status'], entry['body'] = _batch_subrequest(path, query_string)
+            except Exception as e:
+                print(f"Error en api_batch ({url}): {e}")
+                db.session.rollback()
+                entry.update(status=500, body={'success': False, 'msg': 'Error interno'})
+        responses.append(entry)
+    return jsonify({'success': True, 'responses': responses})
+
+def _live_event_visible(ev, user_id, role):
+    """Admin recibe todo; un técnico, las tareas que son o eran suyas (principal o secundario,
+    también si se las acaban de quitar) y las que están o estaban sin asignar"""
+    if role == 'admin' or ev['type'] == 'resync':
+        return True
+    if ev['type'].startswith('task.'):
+        return ev['unassigned'] or user_id in ev['audience']
+    return False
+
+@app.route('/api/events/stream')
+@login_required
+def live_events_stream():
+    """Server-Sent Events con los cambios en tareas, alarmas y stock bajo.
+
+    Cada evento lleva su tipo (task.created/updated/deleted, alarm.created, stock.low,
+    resync) y un JSON compacto; el panel decide qué refrescar. La conexión se cierra
+    tras SSE_MAX_STREAM_SECONDS y EventSource reconecta automáticamente.
+
+    Necesita workers con hilos (gunicorn.conf.py): con workers síncronos cada stream
+    bloquearía un worker entero y el master lo mataría al superar su timeout.
+    """
+    user_id, role = current_user.id, current_user.role
+    live_events.start()
+    q = live_broker.subscribe()
+    # El stream no usa la BD ni el contexto de la petición: liberar la conexión ya
+    db.session.remove()
+    if q is None:
+        # Worker lleno: respuesta inmediata, el navegador reintenta pasado SSE_BUSY_RETRY_MS
+        return Response(f'retry: {SSE_BUSY_RETRY_MS}\n\n', mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache'})
+
+    def stream():
+        deadline = time.monotonic() + SSE_MAX_STREAM_SECONDS
+        try:
+            yield 'retry: 3000\n\n'
+            while time.monotonic() < deadline:
+                try:
+                    ev = q.get(timeout=SSE_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                if ev['type'] not in INTERNAL_EVENT_TYPES and _live_event_visible(ev, user_id, role):
+                    yield f"event: {ev['type']}\ndata: {json.dumps(ev)}\n\n"
+        finally:
+            live_broker.unsubscribe(q)
+
+    return Response(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',  # sin buffer en nginx / proxy de Render
+    })
+
+# Registro de cambios (change_log): lectura incremental y compactación
+CHANGES_DEFAULT_LIMIT = 200
+CHANGES_MAX_LIMIT = 1000
+CHANGE_LOG_RETENTION_DAYS = 7
+TECH_CHANGE_DATASETS = ('tasks', 'service_types')  # lo que un técnico puede seguir
+
+def change_log_floor():
+    """Primer seq a partir del cual el registro está completo (sube al compactar por antigüedad)"""
+    return db.session.query(DataVersion.version).filter_by(name='change_log').scalar() or 0
+
+def compact_change_log(retention_days=CHANGE_LOG_RETENTION_DAYS):
+    """Compacta change_log. Devuelve el número de filas borradas.
+
+    1) Deja solo la última fila de cada entidad (y de cada técnico que dejó de verla): quien
+       lea desde cualquier seq sigue viendo el cambio más reciente de lo modificado después.
+    2) Borra las filas más antiguas que retention_days y sube el suelo; los clientes
+       con un seq anterior reciben reset y recargan completo.
+    """
+    head = db.session.query(db.func.max(ChangeLog.seq)).scalar() or 0
+    latest = db.session.query(db.func.max(ChangeLog.seq)).group_by(
+        ChangeLog.dataset, ChangeLog.entity, ChangeLog.entity_id, ChangeLog.user_id)
+    removed = ChangeLog.query.filter(ChangeLog.seq <= head, ChangeLog.seq.notin_(latest)) \
+        .delete(synchronize_session=False)
+
+    cutoff = datetime.now() - timedelta(days=retention_days)
+    expired = db.session.query(db.func.max(ChangeLog.seq)).filter(ChangeLog.created_at < cutoff).scalar()
+    if expired:
+        removed += ChangeLog.query.filter(ChangeLog.seq <= expired).delete(synchronize_session=False)
+        # Las filas borradas antes eran todas <= suelo anterior, así que el suelo solo sube
+        db.session.query(DataVersion).filter_by(name='change_log').update(
+            {'version': expired}, synchronize_session=False)
+    db.session.commit()
+    return removed
+
+@app.cli.command('compact-changes')
+@click.option('--days', default=CHANGE_LOG_RETENTION_DAYS, show_default=True, help='Días de historial a conservar')
+def compact_changes_command(days):
+    """Compacta el registro de cambios (pensado para un cron nocturno)."""
+    print(f"✓ Registro de cambios compactado: {compact_change_log(days)} filas borradas")
+
+@app.route('/api/admin/cache_stats')
+@login_required
+def cache_stats():
+    """Métricas de las cachés de este worker (aciertos, fallos, invalidaciones) y versiones vistas"""
+    if current_user.role != 'admin':
+        return jsonify({'success': False, 'msg': 'No autorizado'}), 403
+    return jsonify({
+        'success': True,
+        'pid': os.getpid(),
+        'regions': [region.stats() for region in CACHE_REGIONS.values()],
+        **data_versions.stats(),
+    })
+
+@app.route('/api/changes')
+@login_required
+def api_changes():
+    """Cambios posteriores a ?since=<seq>, en orden. Sin since devuelve solo el seq actual.
+
+    ?dataset=tasks,clients filtra por conjunto. Si since es anterior al suelo del
+    registro (compactado por antigüedad) responde reset=true: recargar y seguir desde head.
+    Un técnico solo ve las tareas que vería en su calendario (como en los eventos en vivo),
+    los borrados, que solo llevan el id, y las tareas que ha dejado de ver (reasignadas).
+    """
+    datasets = [d for d in request.args.get('dataset', '').split(',') if d]
+    if current_user.role != 'admin':
+        datasets = [d for d in datasets if d in TECH_CHANGE_DATASETS] or list(TECH_CHANGE_DATASETS)
+    limit = min(max(request.args.get('limit', CHANGES_DEFAULT_LIMIT, type=int) or 1, 1), CHANGES_MAX_LIMIT)
+    since = request.args.get('since', type=int)
+
+    # Los seq se hacen visibles en orden de commit (_write_change_log): max(seq) es seguro
+    floor = change_log_floor()
+    head = max(db.session.query(db.func.max(ChangeLog.seq)).scalar() or 0, floor)
+    if since is None:
+        return jsonify({'success': True, 'head': head, 'changes': []})
+    if since < floor:
+        return jsonify({'success': True, 'reset': True, 'head': head, 'changes': []})
+
+    query = ChangeLog.query.filter(ChangeLog.seq > since, ChangeLog.seq <= head)
+    if datasets:
+        query = query.filter(ChangeLog.dataset.in_(datasets))
+    if current_user.role != 'admin':
+        extra_task_ids = db.select(TaskTechnician.task_id).where(TaskTechnician.user_id == current_user.id)
+        visible_task_ids = db.select(Task.id).where(db.or_(
+            Task.tech_id.is_(None), Task.tech_id == current_user.id, Task.id.in_(extra_task_ids)))
+        query = query.filter(db.or_(
+            ChangeLog.user_id == current_user.id,
+            db.and_(ChangeLog.user_id.is_(None), db.or_(
+                ChangeLog.entity.is_(None), ChangeLog.entity != 'task', ChangeLog.op == 'delete',
+                ChangeLog.entity_id.in_(visible_task_ids)))))
+    else:
+        query = query.filter(ChangeLog.user_id.is_(None))
+    rows = query.order_by(ChangeLog.seq).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return jsonify({
+        'success': True,
+        'changes': [{
+            'seq': r.seq, 'dataset': r.dataset, 'entity': r.entity, 'id': r.entity_id,
+            'op': r.op, 'version': r.version,
+        } for r in rows],
+        # Sin más páginas el cursor avanza hasta head aunque el filtro no devuelva filas
+        'head': rows[-1].seq if has_more else max(head, since),
+        'has_more': has_more,
+    })
+
 @app.route('/api/tasks/filter')
 @login_required
 def filter_tasks():
@@ -1452,44 +3907,17 @@ def filter_tasks():
         return jsonify({'success': False, 'msg': 'No autorizado'}), 403
     
     try:
-        service_type = request.args.get('service_type', '').strip()
-        status = request.args.get('status', '').strip()
-        tech_id = request.args.get('tech_id', '').strip()
-        client_name = request.args.get('client_name', '').strip()
-        date_from = request.args.get('date_from', '').strip()
-        date_to = request.args.get('date_to', '').strip()
-        
-        query = Task.query
-        
-        if service_type:
-            service = ServiceType.query.filter_by(name=service_type).first()
-            if service:
-                query = query.filter_by(service_type_id=service.id)
-        
-        if status:
-            query = query.filter_by(status=status)
-        
-        if tech_id:
-            query = query.filter_by(tech_id=int(tech_id))
+        q = request.args.get('q', '').strip()
+        query = task_filters(Task.query, request.args)
         
-        if client_name:
-            query = query.filter(Task.client_name.ilike(f'%{client_name}%'))
-        
-        if date_from:
-            try:
-                df = datetime.strptime(date_from, '%Y-%m-%d').date()
-                query = query.filter(Task.date >= df)
-            except:
-                pass
-        
-        if date_to:
-            try:
-                dt = datetime.strptime(date_to, '%Y-%m-%d').date()
-                query = query.filter(Task.date <= dt)
-            except:
-                pass
-        
-        tasks = query.order_by(Task.date.desc()).limit(500).all()
+        # ✅ Búsqueda de texto completo (descripción, piezas, cliente, firmante)
+        if q:
+            tasks, snippets, total, page, per_page = paginate_fulltext(query, q)
+            meta = {'total': total, 'page': page, 'per_page': per_page}
+        else:
+            tasks, meta = paginate_keyset(query.options(joinedload(Task.tech), joinedload(Task.service_type)),
+                                          {'date': Task.date, 'id': Task.id}, 'date', Task.id)
+            snippets = {}
         
         results = []
         for task in tasks:
@@ -1501,16 +3929,26 @@ def filter_tasks():
                 'date': task.date.strftime('%d/%m/%Y') if task.date else '—',
                 'time': task.start_time or '—',
                 'tech': task.tech.username if task.tech else 'Sin asignar',
-                'description': task.description or ''
+                'description': task.description or '',
+                'snippet': snippets.get(task.id, '')
             })
         
-        return jsonify({'success': True, 'data': results, 'total': len(results)})
+        return jsonify({'success': True, 'data': results, **meta})
     
     except Exception as e:
         print(f"Error filtering tasks: {str(e)}")
         return jsonify({'success': False, 'msg': str(e)}), 500
 
 
+def calendar_task_query():
+    """Task.query limitado a ?ids=1,2,3 si viene: tras un evento en vivo los calendarios
+    piden solo las citas afectadas con el mismo endpoint que usan para cargarse"""
+    raw = request.args.get('ids', '').strip()
+    if not raw:
+        return Task.query
+    ids = [int(x) for x in raw.split(',') if x.strip().isdigit()][:100]
+    return Task.query.filter(Task.id.in_(ids))
+
 @app.route('/api/tasks')
 @login_required
 def get_all_tasks():
@@ -1520,20 +3958,20 @@ def get_all_tasks():
             tech_id = request.args.get('tech_id')
             if tech_id:
                 try:
-                    tasks = Task.query.filter_by(tech_id=int(tech_id)).all()
+                    tasks = calendar_task_query().filter_by(tech_id=int(tech_id)).all()
                 except Exception as e:
                     print(f"Error filtrando tareas por técnico: {e}")
                     tasks = []
             else:
                 try:
-                    tasks = Task.query.all()
+                    tasks = calendar_task_query().all()
                 except Exception as e:
                     print(f"Error cargando todas las tareas: {e}")
                     tasks = []
         else:
             # Incluir tareas donde el usuario es técnico principal O secundario
             try:
-                primary_tasks = Task.query.filter_by(tech_id=current_user.id).all()
+                primary_tasks = calendar_task_query().filter_by(tech_id=current_user.id).all()
             except Exception as e:
                 print(f"Error cargando tareas primarias: {e}")
                 primary_tasks = []
@@ -1541,7 +3979,7 @@ def get_all_tasks():
             try:
                 extra_task_ids = db.session.query(TaskTechnician.task_id).filter_by(user_id=current_user.id).all()
                 extra_task_ids = [r[0] for r in extra_task_ids]
-                extra_tasks = Task.query.filter(Task.id.in_(extra_task_ids), Task.tech_id != current_user.id).all() if extra_task_ids else []
+                extra_tasks = calendar_task_query().filter(Task.id.in_(extra_task_ids), Task.tech_id != current_user.id).all() if extra_task_ids else []
             except Exception as e:
                 print(f"Error cargando tareas secundarias: {e}")
                 extra_tasks = []
@@ -1624,13 +4062,12 @@ def stock_search():
     q = request.args.get('q', '').strip()
     if len(q) < 1:
         return jsonify([])
-    items = Stock.query.filter(Stock.name.ilike(f'%{q}%')).order_by(Stock.name).limit(15).all()
-    return jsonify([{
-        'id': item.id,
-        'name': item.name,
-        'quantity': item.quantity,
-        'category': item.category.name if item.category else None
-    } for item in items])
+    results = stock_autocomplete.search(q, 15)
+    if results is None:
+        # Índice en memoria desactualizado: responder desde BD mientras se reconstruye
+        items = search_by_name(Stock, q, 15, options=(joinedload(Stock.category),))
+        results = [_stock_search_payload(item) for item in items]
+    return jsonify(results)
 
 @app.route('/api/clients_search')
 @login_required
@@ -1641,19 +4078,12 @@ def api_clients_search():
     if len(query) < 2:
         return jsonify([])
     
-    clients = Client.query.filter(
-        Client.name.ilike(f'%{query}%')
-    ).order_by(Client.name).limit(10).all()
+    results = client_autocomplete.search(query, 10)
+    if results is None:
+        # Índice en memoria desactualizado: responder desde BD mientras se reconstruye
+        results = [_client_search_payload(c) for c in search_by_name(Client, query, 10)]
     
-    return jsonify([{
-        'id': c.id,
-        'name': c.name,
-        'phone': c.phone,
-        'email': c.email,
-        'address': c.address,
-        'link': c.link,
-        'has_support': c.has_support
-    } for c in clients])
+    return jsonify(results)
 
 @app.route('/api/clients')
 @login_required
@@ -1661,6 +4091,76 @@ def get_clients():
     """API para autocompletado de clientes (alias)"""
     return api_clients_search()
 
+@app.route('/api/admin/clients')
+@login_required
+def admin_clients_table():
+    """Listado paginado de clientes para el panel (q=, support=1/0, sort=name|support, dir=)"""
+    if current_user.role != 'admin':
+        return jsonify({'success': False, 'msg': 'No autorizado'}), 403
+    query = Client.query
+    q = request.args.get('q', '').strip()
+    if q:
+        like = f'%{_like_escape(q)}%'
+        query = query.filter(db.or_(
+            Client.name_search.like(f'%{_like_escape(normalize_search_text(q))}%', escape='\\'),
+            Client.phone.like(like, escape='\\'),
+            Client.email.ilike(like, escape='\\'),
+        ))
+    support = request.args.get('support', '')
+    if support in ('0', '1'):
+        query = query.filter(Client.has_support == (support == '1'))
+
+    clients, meta = paginate_table(query, {
+        'name': Client.name_search,
+        'support': Client.has_support,
+    }, 'name', Client.id)
+    return jsonify({'success': True, 'data': [{
+        'id': c.id,
+        'name': c.name,
+        'phone': c.phone or '',
+        'email': c.email or '',
+        'address': c.address or '',
+        'link': c.link or '',
+        'notes': c.notes or '',
+        'has_support': bool(c.has_support),
+        'support_schedule': c.support_schedule or '',
+    } for c in clients], **meta})
+
+@app.route('/api/admin/stock')
+@login_required
+def admin_stock_table():
+    """Listado paginado de artículos de stock (q=, category_id=, low=1, sort=name|quantity|min_stock|supplier, dir=)"""
+    if current_user.role != 'admin':
+        return jsonify({'success': False, 'msg': 'No autorizado'}), 403
+    query = Stock.query.options(joinedload(Stock.category))
+    q = request.args.get('q', '').strip()
+    if q:
+        query = query.filter(db.or_(
+            Stock.name_search.like(f'%{_like_escape(normalize_search_text(q))}%', escape='\\'),
+            Stock.supplier.ilike(f'%{_like_escape(q)}%', escape='\\'),
+        ))
+    category_id = request.args.get('category_id', type=int)
+    if category_id:
+        query = query.filter(Stock.category_id == category_id)
+    if request.args.get('low') == '1':
+        query = query.filter(Stock.quantity <= Stock.min_stock)
+
+    items, meta = paginate_table(query, {
+        'name': Stock.name_search,
+        'quantity': Stock.quantity,
+        'min_stock': Stock.min_stock,
+        'supplier': Stock.supplier,
+    }, 'name', Stock.id)
+    return jsonify({'success': True, 'data': [{
+        'id': item.id,
+        'name': item.name,
+        'quantity': item.quantity,
+        'min_stock': item.min_stock,
+        'supplier': item.supplier or '',
+        'category_id': item.category_id,
+        'category': item.category.name if item.category else '',
+    } for item in items], **meta})
+
 @app.route('/api/get_task_full/<int:task_id>')
 @login_required
 def get_task_full(task_id):
@@ -1668,105 +4168,20 @@ def get_task_full(task_id):
     API para obtener datos completos de una tarea
     Usado cuando se selecciona una cita en el formulario de parte
     """
-    task = Task.query.get_or_404(task_id)
-    
-    # Verificar permisos: admin, técnico asignado, técnico secundario, o tarea sin asignar
-    _extra = db.session.query(TaskTechnician).filter_by(task_id=task_id, user_id=current_user.id).first()
-    if (current_user.role != 'admin'
-            and current_user.id != task.tech_id
-            and not _extra
-            and task.tech_id is not None):
-        return jsonify({'success': False, 'msg': 'No autorizado'}), 403
-    
-    service_type = ServiceType.query.get(task.service_type_id) if task.service_type_id else None
-    
-    # ✅ INCLUIR INFORMACIÓN COMPLETA DEL CLIENTE
-    client_info = None
-    if task.client:
-        client_info = {
-            'name': task.client.name,
-            'phone': task.client.phone,
-            'email': task.client.email,
-            'address': task.client.address,
-            'link': task.client.link,
-            'notes': task.client.notes,
-            'has_support': task.client.has_support
-        }
-    
-    return jsonify({
-        'success': True,
-        'data': {
-            'id': task.id,
-            'client_name': task.client_name,
-            'client_info': client_info,  # ✅ AÑADIDO
-            'date': task.date.strftime('%Y-%m-%d') if task.date else None,
-            'start_time': task.start_time or '',
-            'end_time': task.end_time or '',
-            'service_type': service_type.name if service_type else '',
-            'description': task.description or ''
-        }
-    })
+    # Permisos: admin, técnico asignado, técnico secundario, o tarea sin asignar
+    data, error = task_view(task_id, 'get_task_full')
+    if error:
+        return error
+    return jsonify({'success': True, 'data': data})
 
 @app.route('/api/task/<int:task_id>')
 @login_required
 def get_task_details(task_id):
-    task = Task.query.get_or_404(task_id)
-    
-    if current_user.role != 'admin' and current_user.id != task.tech_id:
-        return jsonify({'success': False, 'msg': 'No autorizado'}), 403
-    
-    attachments_list = []
-    if task.attachments:
-        try:
-            attachments_list = json.loads(task.attachments)
-        except:
-            pass
-    
-    service_type = ServiceType.query.get(task.service_type_id) if task.service_type_id else None
-    
-    # ✅ INCLUIR INFORMACIÓN COMPLETA DEL CLIENTE
-    client_info = None
-    if task.client:
-        client_info = {
-            'name': task.client.name,
-            'phone': task.client.phone,
-            'email': task.client.email,
-            'address': task.client.address,
-            'link': task.client.link,
-            'notes': task.client.notes,
-            'has_support': task.client.has_support
-        }
-    
-    return jsonify({
-        'success': True,
-        'data': {
-            'id': task.id,
-            'client_name': task.client_name,
-            'client_info': client_info,  # ✅ AÑADIDO
-            'date': task.date.strftime('%Y-%m-%d') if task.date else None,
-            'start_time': task.start_time,
-            'end_time': task.end_time,
-            'service_type': service_type.name if service_type else 'Sin tipo',
-            'service_type_id': task.service_type_id,
-            'description': task.description,
-            'parts_text': task.parts_text,
-            'status': task.status,
-            'tech_name': task.tech.username if task.tech else 'SIN TÉCNICO',
-            'tech_id': task.tech_id,
-            'attachments': attachments_list,
-            'has_signature': bool(task.signature_data),
-            'signature_client_name': task.signature_client_name,
-            'signature_timestamp': task.signature_timestamp.strftime('%d/%m/%Y %H:%M') if task.signature_timestamp else None,
-            'work_start_time': task.work_start_time.strftime('%H:%M') if task.work_start_time else None,
-            'work_end_time': task.work_end_time.strftime('%H:%M') if task.work_end_time else None,
-            'work_duration': task.work_duration or None,
-            'stock_info': {
-                'item_name': task.stock_item.name if task.stock_item else None,
-                'quantity': task.stock_quantity_used,
-                'action': task.stock_action
-            } if task.stock_item else None
-        }
-    })
+    """Detalle de una tarea. Admite ?fields= e ?include= para pedir solo lo necesario"""
+    data, error = task_view(task_id, 'task')
+    if error:
+        return error
+    return jsonify({'success': True, 'data': data})
 
 # ====== NUEVA RUTA: TECH_ANALYTICS (CORREGIDA - SIN INGRESOS NI TOP CLIENTES) ======
 @app.route('/api/tech_analytics')
@@ -2054,24 +4469,47 @@ def save_tech_profile(user_id):
         print(f"Error guardando perfil técnico: {e}")
         return jsonify({'success': False, 'msg': 'Error al guardar el perfil'})
 
-@app.route('/api/stock_categories')
-@login_required
-def get_stock_categories():
-    """Obtener categorías de stock en formato jerárquico"""
+stock_categories_cache = CacheRegion('stock_categories', ('stock',))
+
+def _build_stock_category_tree(with_items):
+    """Árbol de categorías (listas y dicts que no se modifican: se comparte desde la caché)"""
+    categories = StockCategory.query.order_by(StockCategory.name).all()
+    children = {}
+    for cat in categories:
+        children.setdefault(cat.parent_id, []).append(cat)
+
+    items_by_cat, counts = {}, {}
+    if with_items:
+        for item in Stock.query.filter(Stock.category_id != None).order_by(Stock.name):
+            items_by_cat.setdefault(item.category_id, []).append(item)
+    else:
+        counts = dict(db.session.query(Stock.category_id, db.func.count(Stock.id))
+                      .filter(Stock.category_id != None).group_by(Stock.category_id).all())
+
     def build_tree(parent_id=None):
-        categories = StockCategory.query.filter_by(parent_id=parent_id).all()
         result = []
-        for cat in categories:
-            result.append({
-                'id': cat.id,
-                'name': cat.name,
-                'children': build_tree(cat.id),
-                'items': [{'id': item.id, 'name': item.name, 'quantity': item.quantity, 'min_stock': item.min_stock, 'supplier': item.supplier or 'N/A'} 
-                         for item in cat.items]
-            })
+        for cat in children.get(parent_id, []):
+            node = {'id': cat.id, 'name': cat.name, 'parent_id': cat.parent_id, 'children': build_tree(cat.id)}
+            if with_items:
+                node['items'] = [{'id': item.id, 'name': item.name, 'quantity': item.quantity, 'min_stock': item.min_stock, 'supplier': item.supplier or 'N/A'}
+                                 for item in items_by_cat.get(cat.id, [])]
+            else:
+                node['item_count'] = counts.get(cat.id, 0)
+            result.append(node)
         return result
-    
-    return jsonify(build_tree())
+
+    return build_tree()
+
+@app.route('/api/stock_categories')
+@login_required
+def get_stock_categories():
+    """Obtener categorías de stock en formato jerárquico.
+
+    ?items=0 devuelve solo el número de artículos por categoría (item_count);
+    el panel carga los artículos bajo demanda desde /api/admin/stock.
+    """
+    with_items = request.args.get('items', '1') != '0'
+    return jsonify(stock_categories_cache.get(with_items, lambda: _build_stock_category_tree(with_items)))
 
 # ✅ NUEVA RUTA: Obtener info de un item de stock para editar
 @app.route('/api/stock_item/<int:item_id>')
@@ -2159,68 +4597,10 @@ def api_report_detail(task_id):
     if current_user.role != 'admin':
         return jsonify({'success': False, 'msg': 'No autorizado'}), 403
     try:
-        t = Task.query.get_or_404(task_id)
-        svc_name = t.service_type.name if t.service_type else ('Asistencia Remota' if t.is_remote else '—')
-        tech_name = t.tech.username if t.tech else 'Sin técnico'
-        date_str = t.date.strftime('%d/%m/%Y') if t.date else '—'
-
-        # Calcular tiempo de transporte
-        transport_duration = ''
-        if t.parte_transport_start and t.parte_arrival:
-            try:
-                from datetime import datetime as _dt2
-                t0 = _dt2.strptime(t.parte_transport_start, '%H:%M')
-                t1 = _dt2.strptime(t.parte_arrival, '%H:%M')
-                diff_min = int((t1 - t0).total_seconds() / 60)
-                if diff_min > 0:
-                    h, m = divmod(diff_min, 60)
-                    transport_duration = f'{h}h {m:02d}min' if h else f'{m}min'
-            except Exception:
-                pass
-
-        # Adjuntos
-        attachments = []
-        if t.attachments:
-            try:
-                atts = json.loads(t.attachments)
-                if isinstance(atts, list):
-                    for a in atts:
-                        if isinstance(a, dict):
-                            attachments.append({'name': a.get('original_name', a.get('filename', '')), 'filename': a.get('filename', '')})
-                        else:
-                            attachments.append({'name': str(a), 'filename': str(a)})
-            except Exception:
-                pass
-
-        return jsonify({
-            'success':               True,
-            'id':                    t.id,
-            'is_remote':             bool(t.is_remote),
-            'client_name':           t.client_name or '—',
-            'service_type':          svc_name,
-            'date':                  date_str,
-            'tech':                  tech_name,
-            # Tiempos del parte presencial
-            'parte_transport_start': t.parte_transport_start or '',
-            'parte_arrival':         t.parte_arrival or '',
-            'parte_work_start':      t.parte_work_start or '',
-            'parte_work_end':        t.parte_work_end or '',
-            'transport_duration':    transport_duration,
-            'work_duration':         t.work_duration or '',
-            # Tiempos asistencia remota
-            'start_time':            t.start_time or '',
-            'end_time':              t.end_time or '',
-            'remote_support_hours':  t.remote_support_hours or 0,
-            # Contenido
-            'description':           t.description or '',
-            'parts_text':            t.parts_text or '',
-            # Firma
-            'has_signature':         bool(t.signature_data),
-            'signature_client_name': t.signature_client_name or '',
-            'signature_timestamp':   t.signature_timestamp.strftime('%d/%m/%Y %H:%M') if t.signature_timestamp else '',
-            # Adjuntos
-            'attachments':           attachments,
-        })
+        data, error = task_view(task_id, 'report_detail')
+        if error:
+            return error
+        return jsonify({'success': True, **data})
     except Exception as e:
         print(f"Error en api_report_detail: {e}")
         return jsonify({'success': False, 'msg': str(e)}), 500
@@ -2234,28 +4614,22 @@ def api_reports():
         return jsonify({'success': False, 'msg': 'No autorizado'}), 403
     
     try:
-        client_filter  = request.args.get('client', '').strip().lower()
-        date_from_str  = request.args.get('date_from', '')
-        date_to_str    = request.args.get('date_to', '')
-
-        query = Task.query.filter_by(status='Completado')
-
-        if client_filter:
-            query = query.filter(Task.client_name.ilike(f'%{client_filter}%'))
-        if date_from_str:
-            try:
-                df = datetime.strptime(date_from_str, '%Y-%m-%d').date()
-                query = query.filter(Task.date >= df)
-            except Exception:
-                pass
-        if date_to_str:
-            try:
-                dt = datetime.strptime(date_to_str, '%Y-%m-%d').date()
-                query = query.filter(Task.date <= dt)
-            except Exception:
-                pass
-
-        tasks = query.order_by(Task.date.desc()).limit(200).all()
+        q = request.args.get('q', '').strip()
+        query = report_filters(Task.query, request.args).options(
+            joinedload(Task.tech), joinedload(Task.service_type), defer(Task.signature_data))
+
+        # ✅ Búsqueda de texto completo (descripción, piezas, cliente, firmante)
+        if q:
+            tasks, snippets, total, page, per_page = paginate_fulltext(query, q)
+            meta = {'total': total, 'page': page, 'per_page': per_page,
+                    'pages': max((total + per_page - 1) // per_page, 1), 'sort': 'relevance', 'dir': 'asc'}
+        else:
+            tasks, meta = paginate_keyset(query, {
+                'date': Task.date,
+                'client': Task.client_name,
+                'id': Task.id,
+            }, 'date', Task.id)
+            snippets = {}
 
         results = []
         for t in tasks:
@@ -2263,31 +4637,7 @@ def api_reports():
             tech_name = t.tech.username if t.tech else 'Sin técnico'
             date_str = t.date.strftime('%d/%m/%Y') if t.date else '—'
 
-            # Adjuntos
-            has_attachments = False
-            att_count = 0
-            if t.attachments:
-                try:
-                    atts = json.loads(t.attachments)
-                    if isinstance(atts, list) and len(atts) > 0:
-                        has_attachments = True
-                        att_count = len(atts)
-                except Exception:
-                    pass
-
-            # Calcular tiempo de transporte si hay datos
-            transport_duration = ''
-            if t.parte_transport_start and t.parte_arrival:
-                try:
-                    from datetime import datetime as _dt2
-                    t0 = _dt2.strptime(t.parte_transport_start, '%H:%M')
-                    t1 = _dt2.strptime(t.parte_arrival, '%H:%M')
-                    diff_min = int((t1 - t0).total_seconds() / 60)
-                    if diff_min > 0:
-                        h, m = divmod(diff_min, 60)
-                        transport_duration = f'{h}h {m:02d}min' if h else f'{m}min'
-                except Exception:
-                    pass
+            att_count = len(task_attachment_list(t))
 
             results.append({
                 'id':                    t.id,
@@ -2296,7 +4646,7 @@ def api_reports():
                 'date':                  date_str,
                 'tech':                  tech_name,
                 'work_duration':         t.work_duration or '',
-                'has_attachments':       has_attachments,
+                'has_attachments':       att_count > 0,
                 'attachments_count':     att_count,
                 'is_remote':             bool(t.is_remote),
                 # Timestamps del parte
@@ -2304,16 +4654,17 @@ def api_reports():
                 'parte_arrival':         t.parte_arrival or '',
                 'parte_work_start':      t.parte_work_start or '',
                 'parte_work_end':        t.parte_work_end or '',
-                'transport_duration':    transport_duration,
+                'transport_duration':    task_transport_duration(t.parte_transport_start, t.parte_arrival),
                 # Datos adicionales para el detalle
                 'start_time':            t.start_time or '',
                 'end_time':              t.end_time or '',
                 'description':           t.description or '',
                 'parts_text':            t.parts_text or '',
                 'remote_support_hours':  t.remote_support_hours or 0,
+                'snippet':               snippets.get(t.id, ''),
             })
 
-        return jsonify({'success': True, 'data': results, 'total': len(results)})
+        return jsonify({'success': True, 'data': results, **meta})
     except Exception as e:
         print(f"Error en api_reports: {e}")
         return jsonify({'success': False, 'msg': str(e)}), 500
@@ -2324,10 +4675,12 @@ def api_reports():
 def print_report(report_id):
     """Endpoint para imprimir/exportar reporte de trabajo"""
     try:
-        task = Task.query.get_or_404(report_id)
+        task, caps = task_access(report_id)
+        if not task:
+            abort(404)
         
         # Verificar permisos
-        if current_user.role != 'admin' and task.tech_id != current_user.id:
+        if 'view' not in caps:
             flash('No tienes permiso para ver este reporte', 'danger')
             return redirect(url_for('dashboard'))
         
@@ -2364,12 +4717,12 @@ def print_report(report_id):
 def complete_task(task_id):
     """Completar una tarea desde el panel técnico vía JSON (firma, stock, descripción)"""
     try:
-        task = Task.query.get_or_404(task_id)
-        _is_extra = db.session.query(TaskTechnician).filter_by(task_id=task_id, user_id=current_user.id).first()
-        _is_unassigned = (task.tech_id is None)
-        _allowed = (current_user.role == 'admin' or task.tech_id == current_user.id or bool(_is_extra) or _is_unassigned)
-        if not _allowed:
+        task, caps = task_access(task_id)
+        if not task:
+            abort(404)
+        if 'complete' not in caps:
             return jsonify({'success': False, 'msg': 'No autorizado'}), 403
+        _is_unassigned = (task.tech_id is None)
 
         data = request.get_json() or {}
         description     = data.get('description', task.description or '')
@@ -2404,6 +4757,9 @@ def complete_task(task_id):
                         return jsonify({'success': False, 'msg': f'Stock insuficiente de {stock_item.name}'}), 400
                 elif stock_action_val == 'devolver':
                     stock_item.quantity += stock_quantity
+                if stock_action_val in STOCK_CONSUMPTION_ACTIONS:
+                    delta = stock_quantity if stock_action_val == 'devolver' else -stock_quantity
+                    record_stock_movement(stock_item, delta, stock_action_val, task=task)
                 task.stock_item_id       = stock_item.id
                 task.stock_quantity_used = stock_quantity
                 task.stock_action        = stock_action_val
@@ -2420,21 +4776,16 @@ def complete_task(task_id):
 @login_required
 def task_action(task_id, action):
     """Endpoint para acciones sobre tareas (completar, eliminar, cancelar, toggle)"""
-    task = Task.query.get_or_404(task_id)
+    task, caps = task_access(task_id)
+    if not task:
+        abort(404)
     
     # Verificar permisos:
-    # - Admin: acceso total
-    # - Técnico asignado o secundario: acceso a sus tareas
-    # - Técnico con tarea sin asignar (tech_id=None): puede ver, completar y hacer toggle
-    # - Ningún otro rol puede actuar
-    _is_extra_tech = (current_user.role == 'tech' and
-                      db.session.query(TaskTechnician).filter_by(
-                          task_id=task_id, user_id=current_user.id).first() is not None)
+    # - Admin y técnico asignado: todas las acciones
+    # - Técnico secundario o con tarea sin asignar (tech_id=None): completar, toggle y cancelar
+    # - Eliminar: solo admin o técnico asignado
     _is_unassigned = (task.tech_id is None)
-    _tech_allowed = (current_user.role == 'tech' and
-                     (task.tech_id == current_user.id or _is_extra_tech or _is_unassigned))
-
-    if current_user.role != 'admin' and not _tech_allowed:
+    if ('delete' if action == 'delete' else 'complete') not in caps:
         return jsonify({'success': False, 'msg': 'No autorizado'}), 403
 
     try:
@@ -2486,71 +4837,87 @@ def task_action(task_id, action):
 @login_required
 def get_task(task_id):
     """Obtener datos de una tarea específica"""
-    task = Task.query.get_or_404(task_id)
-    
-    if current_user.role != 'admin' and task.tech_id != current_user.id:
-        return jsonify({'success': False, 'msg': 'No autorizado'}), 403
-    
-    service_type = ServiceType.query.get(task.service_type_id) if task.service_type_id else None
-    
-    return jsonify({
-        'success': True,
-        'data': {
-            'id': task.id,
-            'client_name': task.client_name,
-            'date': task.date.strftime('%Y-%m-%d') if task.date else None,
-            'time': task.start_time or '',
-            'service_type': service_type.name if service_type else '',
-            'notes': task.description or '',
-            'tech_id': task.tech_id
-        }
-    })
+    data, error = task_view(task_id, 'get_task')
+    if error:
+        return error
+    return jsonify({'success': True, 'data': data})
 
 @app.route('/api/task_details/<int:task_id>')
 @login_required
 def api_task_details(task_id):
     """Obtener detalles completos de una tarea"""
-    task = Task.query.get_or_404(task_id)
-    
-    if current_user.role != 'admin' and task.tech_id != current_user.id:
-        return jsonify({'success': False, 'msg': 'No autorizado'}), 403
-    
-    service_type = ServiceType.query.get(task.service_type_id) if task.service_type_id else None
-    
-    # Parsear attachments
-    attachments_list = []
-    if task.attachments:
-        try:
-            attachments_list = json.loads(task.attachments)
-        except:
-            pass
-    
-    return jsonify({
-        'success': True,
-        'data': {
-            'id': task.id,
-            'client_name': task.client_name,
-            'tech_name': task.tech.username if task.tech else 'Sin asignar',
-            'date': task.date.strftime('%Y-%m-%d') if task.date else None,
-            'start_time': task.start_time or '',
-            'end_time': task.end_time or '',
-            'service_type': service_type.name if service_type else 'Sin tipo',
-            'status': task.status,
-            'description': task.description or '',
-            'parts_text': task.parts_text or '',
-            'has_signature': bool(task.signature_data),
-            'attachments': attachments_list,
-            'stock_info': {
-                'item_name': task.stock_item.name if task.stock_item else None,
-                'quantity': task.stock_quantity_used,
-                'action': task.stock_action
-            } if task.stock_item else None
-        }
-    })
+    data, error = task_view(task_id, 'task_details')
+    if error:
+        return error
+    return jsonify({'success': True, 'data': data})
 
 
 
 # --- RUTAS DE PAGOS ---
+# --- SALDO MATERIALIZADO DE PAGOS ---
+def client_balance(payment):
+    """Calcula (paid_total, pending_total, status) desde el libro de cobros en una consulta"""
+    records_sum, records_count, all_paid = db.session.query(
+        db.func.coalesce(db.func.sum(PaymentRecord.amount), 0),
+        db.func.count(PaymentRecord.id),
+        db.func.min(db.case((PaymentRecord.is_paid == True, 1), else_=0)),
+    ).filter(PaymentRecord.client_payment_id == payment.id).one()
+    total_amount = payment.total_amount or 0
+    paid = round((payment.first_payment or 0) + records_sum, 2)
+    pending = round(max(0, total_amount - paid), 2)
+    if not records_count:
+        # Sin cobros parciales: pendiente si hay importe total, neutro si no
+        status = 'pending' if total_amount > 0 else 'none'
+    elif all_paid == 1:
+        status = 'paid'
+    else:
+        status = 'pending'
+    return paid, pending, status
+
+def refresh_client_balance(payment):
+    """Recalcula el saldo materializado dentro de la transacción del llamador.
+
+    Los escritores bloquean antes la fila de ClientPayment (locked_client_payment), así
+    que dos cobros simultáneos del mismo cliente no pueden dejar un saldo desfasado.
+    """
+    db.session.flush()
+    payment.paid_total, payment.pending_total, payment.status = client_balance(payment)
+
+def locked_client_payment(client_id):
+    """ClientPayment del cliente con la fila bloqueada hasta el commit (FOR UPDATE en PostgreSQL).
+    populate_existing: si ya estaba en la sesión (record.client_payment) se relee tras el
+    bloqueo, con lo que haya confirmado quien lo tenía."""
+    return ClientPayment.query.filter_by(client_id=client_id).with_for_update().populate_existing().first()
+
+def reconcile_client_balances(fix=False):
+    """Compara el saldo materializado con el libro de cobros. Devuelve la lista de
+    (payment, guardado, calculado) que no cuadran; con fix=True los corrige."""
+    mismatches = []
+    for payment in ClientPayment.query.order_by(ClientPayment.id):
+        stored = (payment.paid_total, payment.pending_total, payment.status)
+        expected = client_balance(payment)
+        if stored[2] != expected[2] or any(abs((a or 0) - b) > 0.005 for a, b in zip(stored[:2], expected[:2])):
+            mismatches.append((payment, stored, expected))
+            if fix:
+                payment.paid_total, payment.pending_total, payment.status = expected
+    if fix and mismatches:
+        db.session.commit()
+    return mismatches
+
+@app.cli.command('reconcile-balances')
+@click.option('--fix', is_flag=True, help='Corregir los saldos que no cuadren')
+def reconcile_balances_command(fix):
+    """Verifica paid_total/pending_total/status de cada cliente contra sus cobros."""
+    mismatches = reconcile_client_balances(fix)
+    for payment, stored, expected in mismatches:
+        print(f"✗ Cliente {payment.client_id}: guardado {stored} ≠ calculado {expected}")
+    if not mismatches:
+        print("✓ Todos los saldos cuadran con el libro de cobros")
+    elif fix:
+        print(f"✓ {len(mismatches)} saldos corregidos")
+    else:
+        print(f"⚠️ {len(mismatches)} saldos no cuadran (usa --fix para corregirlos)")
+
 @app.route('/api/payments/client/<int:client_id>', methods=['GET'])
 @login_required
 def get_client_payment(client_id):
@@ -2570,13 +4937,12 @@ def get_client_payment(client_id):
     records = [{'id': r.id, 'amount': r.amount, 'date': r.date.strftime('%Y-%m-%d'),
                 'notes': r.notes or '', 'is_paid': bool(getattr(r, 'is_paid', False))}
                for r in sorted(payment.records, key=lambda r: r.date)]
-    total_paid = payment.first_payment + sum(r.amount for r in payment.records)
-    pending = max(0, payment.total_amount - total_paid)
     return jsonify({'success': True, 'data': {
         'id': payment.id, 'client_id': client_id, 'client_name': client.name,
         'total_amount': payment.total_amount, 'budget_number': payment.budget_number or '',
         'first_payment': payment.first_payment, 'records': records,
-        'total_paid': round(total_paid, 2), 'pending': round(pending, 2)
+        'total_paid': payment.paid_total, 'pending': payment.pending_total,
+        'status': payment.status or 'none'
     }})
 
 
@@ -2591,7 +4957,7 @@ def save_client_payment(client_id):
         return jsonify({'success': False, 'msg': 'Cliente no encontrado'}), 404
     try:
         data = request.get_json()
-        payment = ClientPayment.query.filter_by(client_id=client_id).first()
+        payment = locked_client_payment(client_id)
         if not payment:
             payment = ClientPayment(client_id=client_id)
             db.session.add(payment)
@@ -2599,6 +4965,7 @@ def save_client_payment(client_id):
         payment.budget_number = data.get('budget_number', '').strip()
         payment.first_payment = float(data.get('first_payment', 0))
         payment.updated_at = datetime.now()
+        refresh_client_balance(payment)
         db.session.commit()
         return jsonify({'success': True, 'payment_id': payment.id})
     except Exception as e:
@@ -2618,7 +4985,7 @@ def add_payment_record():
         amount = float(data.get('amount', 0))
         date_str = data.get('date', date.today().strftime('%Y-%m-%d'))
         notes = data.get('notes', '').strip()
-        payment = ClientPayment.query.filter_by(client_id=client_id).first()
+        payment = locked_client_payment(client_id)
         if not payment:
             client = Client.query.get(client_id)
             if not client:
@@ -2630,6 +4997,7 @@ def add_payment_record():
         is_paid = bool(data.get('is_paid', False))
         record = PaymentRecord(client_payment_id=payment.id, amount=amount, date=record_date, notes=notes, is_paid=is_paid)
         db.session.add(record)
+        refresh_client_balance(payment)
         db.session.commit()
         return jsonify({'success': True, 'record_id': record.id})
     except Exception as e:
@@ -2647,7 +5015,9 @@ def delete_payment_record(record_id):
         record = PaymentRecord.query.get(record_id)
         if not record:
             return jsonify({'success': False, 'msg': 'Registro no encontrado'}), 404
+        payment = locked_client_payment(record.client_payment.client_id)
         db.session.delete(record)
+        refresh_client_balance(payment)
         db.session.commit()
         return jsonify({'success': True})
     except Exception as e:
@@ -2665,7 +5035,9 @@ def toggle_payment_record_paid(record_id):
         record = PaymentRecord.query.get(record_id)
         if not record:
             return jsonify({'success': False, 'msg': 'Registro no encontrado'}), 404
+        payment = locked_client_payment(record.client_payment.client_id)
         record.is_paid = not bool(getattr(record, 'is_paid', False))
+        refresh_client_balance(payment)
         db.session.commit()
         return jsonify({'success': True, 'is_paid': bool(record.is_paid)})
     except Exception as e:
@@ -2676,45 +5048,148 @@ def toggle_payment_record_paid(record_id):
 @app.route('/api/payments/summary')
 @login_required
 def payments_summary():
-    """Resumen de pagos de todos los clientes (mismo listado que CLIENTES, siempre actualizado)"""
+    """Resumen paginado de pagos por cliente (q=, status=all|active|pending|paid|none,
+    sort=name|total|paid|pending, dir=). Lee el saldo materializado de ClientPayment."""
     if current_user.role != 'admin':
         return jsonify({'success': False, 'msg': 'No autorizado'}), 403
     try:
-        clients = Client.query.order_by(Client.name).all()
-        result = []
-        for client in clients:
-            payment = client.payment
-            if payment:
-                total_paid = payment.first_payment + sum(r.amount for r in payment.records)
-                pending = max(0, payment.total_amount - total_paid)
-                records = list(payment.records)  # materializar para evitar lazy-load repetido
-                if not records:
-                    # Sin cobros parciales: pendiente si hay importe total, neutro si no
-                    status = 'pending' if payment.total_amount > 0 else 'none'
-                elif all(getattr(r, 'is_paid', False) for r in records):
-                    status = 'paid'
-                else:
-                    status = 'pending'
-            else:
-                total_paid = 0
-                pending = 0
-                status = 'none'
-            result.append({
-                'id': client.id,
-                'name': client.name,
-                'phone': client.phone,
-                'has_support': client.has_support,
-                'total_amount': payment.total_amount if payment else 0,
-                'budget_number': payment.budget_number if payment else '',
-                'total_paid': round(total_paid, 2),
-                'pending': round(pending, 2),
-                'status': status
-            })
-        return jsonify({'success': True, 'data': result})
+        total_amount = db.func.coalesce(ClientPayment.total_amount, 0)
+        total_paid = db.func.coalesce(ClientPayment.paid_total, 0)
+        pending = db.func.coalesce(ClientPayment.pending_total, 0)
+        status = db.func.coalesce(ClientPayment.status, 'none')
+
+        query = db.session.query(
+            Client.id, Client.name, Client.phone, Client.has_support,
+            total_amount.label('total_amount'),
+            ClientPayment.budget_number,
+            total_paid.label('total_paid'),
+            pending.label('pending'),
+            status.label('status'),
+        ).outerjoin(ClientPayment, ClientPayment.client_id == Client.id)
+
+        q = request.args.get('q', '').strip()
+        if q:
+            query = query.filter(db.or_(
+                Client.name_search.like(f'%{_like_escape(normalize_search_text(q))}%', escape='\\'),
+                Client.phone.like(f'%{_like_escape(q)}%', escape='\\'),
+            ))
+        status_filter = request.args.get('status', 'all')
+        if status_filter == 'active':
+            query = query.filter(ClientPayment.status.in_(('paid', 'pending')))
+        elif status_filter in ('pending', 'paid'):
+            query = query.filter(ClientPayment.status == status_filter)
+        elif status_filter == 'none':
+            query = query.filter(status == 'none')
+
+        rows, meta = paginate_table(query, {
+            'name': Client.name_search,
+            'total': total_amount,
+            'paid': total_paid,
+            'pending': pending,
+        }, 'name', Client.id)
+        return jsonify({'success': True, 'data': [{
+            'id': row.id,
+            'name': row.name,
+            'phone': row.phone,
+            'has_support': row.has_support,
+            'total_amount': row.total_amount,
+            'budget_number': row.budget_number or '',
+            'total_paid': round(row.total_paid, 2),
+            'pending': round(row.pending, 2),
+            'status': row.status
+        } for row in rows], **meta})
     except Exception as e:
         print(f"Error en payments_summary: {e}")
         return jsonify({'success': False, 'msg': f'Error interno: {str(e)}'}), 500
 
+# --- ANTIGÜEDAD DE DEUDA (cobros no pagados por tramos de días) ---
+AGING_BUCKETS = ('current', 'd30', 'd60', 'd90')  # <30, 30-59, 60-89 y 90+ días
+AgingRow = namedtuple('AgingRow', 'client_id name phone current d30 d60 d90 total records oldest')
+payments_aging_cache = CacheRegion('payments_aging', ('payments', 'clients'), max_entries=8)
+
+def _load_payments_aging(as_of):
+    """Una consulta agrupada por cliente. Los límites de cada tramo son fechas calculadas
+    aquí (as_of - 30/60/90 días), así la comparación es igual en SQLite y PostgreSQL."""
+    c30, c60, c90 = (as_of - timedelta(days=d) for d in (30, 60, 90))
+    amount = PaymentRecord.amount
+    bucket = lambda cond: db.func.coalesce(db.func.sum(db.case((cond, amount), else_=0)), 0)
+    rows = db.session.query(
+        Client.id, Client.name, Client.phone,
+        bucket(db.or_(PaymentRecord.date == None, PaymentRecord.date > c30)),
+        bucket(db.and_(PaymentRecord.date <= c30, PaymentRecord.date > c60)),
+        bucket(db.and_(PaymentRecord.date <= c60, PaymentRecord.date > c90)),
+        bucket(PaymentRecord.date <= c90),
+        db.func.sum(amount),
+        db.func.count(PaymentRecord.id),
+        db.func.min(PaymentRecord.date),
+    ).join(ClientPayment, PaymentRecord.client_payment_id == ClientPayment.id) \
+     .join(Client, ClientPayment.client_id == Client.id) \
+     .filter(PaymentRecord.is_paid == False) \
+     .group_by(Client.id, Client.name, Client.phone) \
+     .order_by(db.func.sum(amount).desc(), Client.id).all()
+    return tuple(AgingRow(cid, name, phone or '', *(round(v or 0, 2) for v in values), count, oldest)
+                 for cid, name, phone, *values, count, oldest in rows)
+
+def payments_aging(as_of=None):
+    """Filas de antigüedad a fecha as_of (hoy por defecto), cacheadas hasta el próximo cambio en pagos"""
+    as_of = as_of or date.today()
+    return payments_aging_cache.get(as_of, lambda: _load_payments_aging(as_of))
+
+def _aging_as_of():
+    try:
+        return datetime.strptime(request.args.get('date', ''), '%Y-%m-%d').date()
+    except ValueError:
+        return date.today()
+
+@app.route('/api/payments/aging')
+@login_required
+def api_payments_aging():
+    """Antigüedad de los cobros no pagados por cliente (?date=AAAA-MM-DD para otra fecha de corte)"""
+    if current_user.role != 'admin':
+        return jsonify({'success': False, 'msg': 'No autorizado'}), 403
+    as_of = _aging_as_of()
+    rows = payments_aging(as_of)
+    totals = {key: round(sum(getattr(r, key) for r in rows), 2) for key in AGING_BUCKETS + ('total',)}
+    return jsonify({'success': True, 'date': as_of.isoformat(), 'totals': totals, 'data': [{
+        **r._asdict(),
+        'oldest': r.oldest.isoformat() if r.oldest else None,
+    } for r in rows]})
+
+@app.route('/api/payments/aging/export')
+@login_required
+def export_payments_aging():
+    """Descarga la antigüedad de deuda en XLSX"""
+    if current_user.role != 'admin':
+        return jsonify({'success': False, 'msg': 'No autorizado'}), 403
+    from openpyxl import Workbook
+    as_of = _aging_as_of()
+    rows = payments_aging(as_of)
+    wb = Workbook()
+    ws = wb.active
+    ws.title = 'Antigüedad'
+    ws.append(['Cliente', 'Teléfono', '< 30 días', '30-59 días', '60-89 días', '90+ días',
+               'Total pendiente', 'Cobros', 'Más antiguo'])
+    for r in rows:
+        ws.append([_xlsx_text(ws, r.name), _xlsx_text(ws, r.phone), r.current, r.d30, r.d60, r.d90,
+                   r.total, r.records, r.oldest])
+    ws.append(['TOTAL', ''] + [round(sum(getattr(r, key) for r in rows), 2) for key in AGING_BUCKETS + ('total',)])
+    for col in 'CDEFG':
+        for cell in ws[col][1:]:
+            cell.number_format = '#,##0.00 €'
+    for cell in ws['I'][1:]:
+        cell.number_format = 'DD/MM/YYYY'
+    ws.column_dimensions['A'].width = 35
+    ws.freeze_panes = 'A2'
+    output = io.BytesIO()
+    wb.save(output)
+    output.seek(0)
+    return send_file(
+        output,
+        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        as_attachment=True,
+        download_name=f'antiguedad_deuda_{as_of.strftime("%Y%m%d")}.xlsx'
+    )
+
 @app.route('/api/admin/tech_colors')
 @login_required
 def get_tech_colors():
@@ -2727,9 +5202,8 @@ def get_tech_colors():
         '#06b6d4', '#ec4899', '#84cc16', '#f97316', '#14b8a6',
     ]
     
-    techs = User.query.filter_by(role='tech').order_by(User.id).all()
     result = []
-    for i, tech in enumerate(techs):
+    for i, tech in enumerate(cached_techs()):
         result.append({
             'id': tech.id,
             'username': tech.username,
@@ -2747,7 +5221,7 @@ def admin_all_tasks():
             return jsonify([])
         
         try:
-            tasks = Task.query.all()
+            tasks = calendar_task_query().all()
         except Exception as e:
             print(f"Error cargando tareas: {e}")
             return jsonify([]), 500
@@ -2991,12 +5465,12 @@ def assign_tech_to_task(task_id):
 def delete_task(task_id):
     """Eliminar una tarea (admin o técnico asignado)"""
     try:
-        task = Task.query.get(task_id)
+        task, caps = task_access(task_id)
         if not task:
             return jsonify({'success': False, 'msg': 'Tarea no encontrada'}), 404
         
         # Verificar permisos: admin o técnico asignado a la tarea
-        if current_user.role != 'admin' and task.tech_id != current_user.id:
+        if 'delete' not in caps:
             return jsonify({'success': False, 'msg': 'No tienes permiso para eliminar esta tarea'}), 403
         
         db.session.delete(task)
@@ -3170,19 +5644,154 @@ def create_remote_assistance():
         return jsonify({'success': False, 'msg': str(e)}), 500
 
 
+# --- CONSUMO MENSUAL DE SOPORTE REMOTO ---
+# client_remote_usage lleva horas y sesiones por cliente y mes de las asistencias remotas
+# completadas: comprobar la cuota es leer una fila por clave primaria en lugar de sumar
+# las tareas del mes en cada edición.
+REMOTE_HOURS_DEFAULT_LIMIT = 5.0  # h/mes para clientes sin límite propio
+REMOTE_USAGE_FIELDS = ('client_id', 'date', 'status', 'is_remote', 'remote_support_hours')
+
+def year_month(value):
+    """'AAAA-MM' de una fecha (o de la cadena ISO con que algunas altas asignan Task.date)"""
+    if isinstance(value, str):
+        value = value.strip()[:7]
+        return value if re.fullmatch(r'\d{4}-\d{2}', value) else None
+    return value.strftime('%Y-%m') if value else None
+
+def _remote_usage_entry(values):
+    """((client_id, 'AAAA-MM'), horas) con que cuenta una tarea en el consumo, o None"""
+    if not (values['is_remote'] and values['status'] == 'Completado' and values['client_id']):
+        return None
+    month = year_month(values['date'])
+    if not month:
+        return None
+    return (int(values['client_id']), month), float(values['remote_support_hours'] or 0)
+
+def _task_usage_values(task, previous=False):
+    """Campos de consumo de la tarea: actuales o, con previous=True, los de antes del flush"""
+    if not previous:
+        return {field: getattr(task, field) for field in REMOTE_USAGE_FIELDS}
+    attrs = db.inspect(task).attrs
+    values = {}
+    for field in REMOTE_USAGE_FIELDS:
+        history = attrs[field].history
+        old = history.deleted or history.unchanged
+        values[field] = old[0] if old else None
+    return values
+
+# Guardar el valor anterior al asignar (sin esto, un atributo no cargado no tiene historial)
+for _field in REMOTE_USAGE_FIELDS:
+    event.listen(getattr(Task, _field), 'set', lambda target, value, oldvalue, initiator: value,
+                 active_history=True, retval=True)
+
+def apply_remote_usage_deltas(conn, deltas):
+    """Suma {(client_id, 'AAAA-MM'): (horas, sesiones)} al registro mensual con un upsert
+    (INSERT ... ON CONFLICT DO UPDATE): si dos transacciones crean a la vez la fila del mes,
+    la segunda suma sobre la de la primera en lugar de fallar por clave duplicada."""
+    table = ClientRemoteUsage.__table__
+    insert = postgresql.insert if conn.dialect.name == 'postgresql' else sqlite.insert
+    for (client_id, month), (hours, sessions) in deltas.items():
+        if not sessions and abs(hours) < 1e-9:
+            continue
+        stmt = insert(table).values(client_id=client_id, year_month=month, hours=hours, sessions=sessions)
+        conn.execute(stmt.on_conflict_do_update(
+            index_elements=[table.c.client_id, table.c.year_month],
+            set_={'hours': table.c.hours + stmt.excluded.hours,
+                  'sessions': table.c.sessions + stmt.excluded.sessions}))
+        if sessions < 0:
+            conn.execute(table.delete().where(
+                table.c.client_id == client_id, table.c.year_month == month, table.c.sessions <= 0))
+
+@event.listens_for(Session, 'after_flush')
+def _track_remote_usage(session, flush_context):
+    """Traslada al registro mensual los cambios de asistencias remotas del flush"""
+    deltas = {}
+
+    def add(entry, sign):
+        if entry:
+            key, hours = entry
+            total, count = deltas.get(key, (0.0, 0))
+            deltas[key] = (total + sign * hours, count + sign)
+
+    for task in session.new:
+        if isinstance(task, Task):
+            add(_remote_usage_entry(_task_usage_values(task)), 1)
+    for task in session.deleted:
+        if isinstance(task, Task):
+            add(_remote_usage_entry(_task_usage_values(task, previous=True)), -1)
+    for task in session.dirty:
+        if isinstance(task, Task) and session.is_modified(task):
+            before = _remote_usage_entry(_task_usage_values(task, previous=True))
+            after = _remote_usage_entry(_task_usage_values(task))
+            if before != after:
+                add(before, -1)
+                add(after, 1)
+    if deltas:
+        apply_remote_usage_deltas(session.connection(), deltas)
+
+def client_remote_limit(client):
+    return client.remote_hours_limit if client.remote_hours_limit is not None else REMOTE_HOURS_DEFAULT_LIMIT
+
+def client_remote_usage(client_id, day=None):
+    """(horas, sesiones) de soporte remoto del cliente en el mes de day (hoy si no se indica)"""
+    row = db.session.get(ClientRemoteUsage, (client_id, year_month(day or date.today())))
+    return (row.hours, row.sessions) if row else (0.0, 0)
+
+def reconcile_remote_usage(fix=False):
+    """Compara client_remote_usage con las asistencias remotas completadas. Devuelve la
+    lista de (clave, guardado, calculado) que no cuadran; con fix=True los corrige."""
+    expected = {}
+    rows = db.session.query(Task.client_id, Task.date, Task.remote_support_hours).filter(
+        Task.is_remote == True, Task.status == 'Completado',
+        Task.client_id != None, Task.date != None)
+    for client_id, day, hours in rows.yield_per(1000):
+        total, count = expected.get((client_id, year_month(day)), (0.0, 0))
+        expected[(client_id, year_month(day))] = (total + (hours or 0), count + 1)
+    stored = {(u.client_id, u.year_month): (u.hours, u.sessions) for u in ClientRemoteUsage.query}
+
+    mismatches = []
+    for key in expected.keys() | stored.keys():
+        have, want = stored.get(key, (0.0, 0)), expected.get(key, (0.0, 0))
+        if have[1] != want[1] or abs(have[0] - want[0]) > 0.005:
+            mismatches.append((key, have, want))
+    if fix and mismatches:
+        table = ClientRemoteUsage.__table__
+        for (client_id, month), _, (hours, sessions) in mismatches:
+            key = db.and_(table.c.client_id == client_id, table.c.year_month == month)
+            db.session.execute(table.delete().where(key))
+            if sessions:
+                db.session.execute(table.insert().values(client_id=client_id, year_month=month,
+                                                         hours=hours, sessions=sessions))
+        db.session.commit()
+    return mismatches
+
+@app.cli.command('reconcile-remote-usage')
+@click.option('--fix', is_flag=True, help='Corregir los meses que no cuadren')
+def reconcile_remote_usage_command(fix):
+    """Verifica el consumo mensual de soporte remoto contra las asistencias completadas."""
+    mismatches = reconcile_remote_usage(fix)
+    for (client_id, month), stored, expected in mismatches:
+        print(f"✗ Cliente {client_id} {month}: guardado {stored} ≠ calculado {expected}")
+    if not mismatches:
+        print("✓ El consumo de soporte remoto cuadra con las asistencias")
+    elif fix:
+        print(f"✓ {len(mismatches)} meses corregidos")
+    else:
+        print(f"⚠️ {len(mismatches)} meses no cuadran (usa --fix para corregirlos)")
+
 @app.route('/api/remote_task/<int:task_id>/update', methods=['POST'])
 @login_required
 def update_remote_task(task_id):
     """Actualizar una asistencia remota (hora inicio/fin, descripción, completar)"""
     try:
-        task = Task.query.get(task_id)
+        task, caps = task_access(task_id)
         if not task:
             return jsonify({'success': False, 'msg': 'Tarea no encontrada'}), 404
         if not task.is_remote:
             return jsonify({'success': False, 'msg': 'No es una asistencia remota'}), 400
 
         # Permitir al admin O al técnico asignado
-        if current_user.role != 'admin' and current_user.id != task.tech_id:
+        if 'edit' not in caps:
             return jsonify({'success': False, 'msg': 'No autorizado'}), 403
 
         data = request.get_json()
@@ -3191,6 +5800,14 @@ def update_remote_task(task_id):
         description  = data.get('description')
         mark_complete = data.get('mark_complete', False)
 
+        # Consumo del mes sin esta tarea; se lee antes de modificarla (un autoflush ya la contaría)
+        used_hours = 0.0
+        if task.client_id:
+            used_hours, _ = client_remote_usage(task.client_id)
+            counted = _remote_usage_entry(_task_usage_values(task))
+            if counted and counted[0] == (task.client_id, year_month(date.today())):
+                used_hours -= counted[1]
+
         # Guardar horas
         if start_time:
             task.start_time = start_time
@@ -3217,27 +5834,15 @@ def update_remote_task(task_id):
             except Exception as _e:
                 print(f"Error calculando duración: {_e}")
 
-        # Límite mensual de horas de soporte por cliente
-        MONTHLY_LIMIT = 5.0
+        # Límite mensual de horas de soporte por cliente (registro mensual: una fila por clave)
         warning_msg = None
         if task.client_id and duration_hours > 0:
-            from datetime import date as _date
-            now = _date.today()
-            past_tasks = Task.query.filter(
-                Task.client_id == task.client_id,
-                Task.is_remote == True,
-                Task.status == 'Completado',
-                Task.id != task_id,
-                Task.date != None,
-                db.func.extract('year',  Task.date) == now.year,
-                db.func.extract('month', Task.date) == now.month,
-            ).all()
-            used_hours = sum(t.remote_support_hours or 0 for t in past_tasks)
+            limit = client_remote_limit(task.client) if task.client else REMOTE_HOURS_DEFAULT_LIMIT
             new_total  = used_hours + duration_hours
-            if new_total > MONTHLY_LIMIT:
+            if new_total > limit:
                 warning_msg = (
                     f"⚠️ El cliente acumulará {new_total:.2f}h de soporte remoto este mes "
-                    f"(límite: {MONTHLY_LIMIT}h). Se ha guardado igualmente."
+                    f"(límite: {limit}h). Se ha guardado igualmente."
                 )
 
         if mark_complete:
@@ -3266,35 +5871,25 @@ def update_remote_task(task_id):
 def get_client_monthly_remote_hours(client_id):
     """Horas de soporte remoto del cliente en el mes actual"""
     try:
-        from datetime import date as _date
         import calendar as _cal
         client = Client.query.get(client_id)
         if not client:
             return jsonify({'success': False}), 404
 
-        now = _date.today()
-        tasks = Task.query.filter(
-            Task.client_id == client_id,
-            Task.is_remote == True,
-            Task.status == 'Completado',
-            Task.date != None,
-            db.func.extract('year',  Task.date) == now.year,
-            db.func.extract('month', Task.date) == now.month,
-        ).all()
-
-        MONTHLY_LIMIT = 5.0
-        used_hours  = sum(t.remote_support_hours or 0 for t in tasks)
-        remaining   = max(0.0, MONTHLY_LIMIT - used_hours)
+        now = date.today()
+        used_hours, sessions = client_remote_usage(client_id, now)
+        limit       = client_remote_limit(client)
+        remaining   = max(0.0, limit - used_hours)
         month_name  = _cal.month_name[now.month]
 
         return jsonify({
             'success': True,
             'used_hours':      round(used_hours, 2),
             'remaining_hours': round(remaining, 2),
-            'limit_hours':     MONTHLY_LIMIT,
+            'limit_hours':     limit,
             'month':           month_name,
-            'session_count':   len(tasks),
-            'over_limit':      used_hours >= MONTHLY_LIMIT,
+            'session_count':   sessions,
+            'over_limit':      used_hours >= limit,
         })
     except Exception as e:
         print(f"Error monthly_remote_hours: {e}")
@@ -3314,7 +5909,9 @@ def edit_stock_item(item_id):
             return jsonify({'success': False, 'msg': 'Artículo no encontrado'}), 404
         
         item.name = request.form.get('name', item.name)
-        item.quantity = int(request.form.get('quantity', item.quantity))
+        new_quantity = int(request.form.get('quantity', item.quantity))
+        record_stock_movement(item, new_quantity - (item.quantity or 0), 'ajuste')
+        item.quantity = new_quantity
         item.min_stock = int(request.form.get('min_stock', item.min_stock))
         item.description = request.form.get('description', item.description)
         item.supplier = request.form.get('supplier', item.supplier)
@@ -3325,67 +5922,193 @@ def edit_stock_item(item_id):
         db.session.rollback()
         return jsonify({'success': False, 'msg': str(e)}), 500
 
+# --- IMPORTACIÓN MASIVA DE CLIENTES ---
+CLIENT_IMPORT_CHUNK = 500
+# Cabeceras aceptadas (normalizadas) → campo interno. Incluye las de export_clients_csv.
+CLIENT_IMPORT_COLUMNS = {
+    'nombre': 'name', 'name': 'name', 'cliente': 'name',
+    'telefono': 'phone', 'phone': 'phone',
+    'email': 'email', 'correo': 'email',
+    'direccion': 'address', 'address': 'address',
+    'enlace': 'link', 'link': 'link',
+    'notas': 'notes', 'notes': 'notes',
+    'tiene soporte': 'has_support', 'soporte': 'has_support', 'has_support': 'has_support',
+    'horario soporte': 'support_schedule', 'horario': 'support_schedule', 'support_schedule': 'support_schedule',
+}
+SUPPORT_SCHEDULE_IMPORT = {'lv': 'lv', 'l-v': 'lv', 'ls': 'ls', 'l-s': 'ls', 'ld': 'ld', 'l-d': 'ld'}
+
+def _import_cell_text(value):
+    # XLSX devuelve números: un teléfono 600123456 llega como 600123456.0
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value if value is not None else '').strip()
+
+def _client_import_row(values):
+    """Valida una fila ya mapeada a campos. Devuelve (dict para insertar o None, errores)"""
+    cell = lambda key: _import_cell_text(values.get(key))
+    errors = []
+    name, phone = cell('name'), cell('phone')
+    if not name:
+        errors.append('Falta el nombre')
+    elif len(name) > 100:
+        errors.append('El nombre supera los 100 caracteres')
+    if not phone:
+        errors.append('Falta el teléfono')
+    elif len(phone) > 20:
+        errors.append('El teléfono supera los 20 caracteres')
+    schedule = None
+    if cell('support_schedule') not in ('', '—', '-'):
+        schedule = SUPPORT_SCHEDULE_IMPORT.get(normalize_search_text(cell('support_schedule')).replace(' ', ''))
+        if not schedule:
+            errors.append(f'Horario de soporte no válido: {cell("support_schedule")}')
+    if errors:
+        return None, errors
+    has_support = normalize_search_text(cell('has_support')) in ('si', 'true', '1', 'x', 'yes')
+    return {
+        'name': name,
+        'name_search': normalize_search_text(name)[:100],
+        'phone': phone,
+        'email': cell('email')[:100] or None,
+        'address': cell('address')[:250] or None,
+        'link': cell('link')[:500] or None,
+        'notes': cell('notes'),
+        'has_support': has_support,
+        'support_schedule': schedule if has_support else None,
+    }, []
+
+def import_client_rows(header, raw_rows, dry_run=False, progress=None):
+    """Importa clientes fila a fila sin cargar el archivo entero.
+
+    Cada bloque de CLIENT_IMPORT_CHUNK filas resuelve los nombres existentes con una
+    sola consulta IN, descarta repetidos dentro del propio archivo e inserta el bloque
+    con un único INSERT de varias filas en su propia transacción. Devuelve (summary, rows)
+    con el resultado de cada fila: created | duplicate | error.
+    progress(filas_procesadas) se llama tras cada bloque.
+    """
+    columns = [CLIENT_IMPORT_COLUMNS.get(normalize_search_text(str(h or ''))) for h in header]
+    if 'name' not in columns:
+        raise ValueError('El archivo necesita una columna "nombre"')
+    report, seen = [], set()
+    summary = {'rows': 0, 'created': 0, 'duplicates': 0, 'errors': 0}
+
+    def flush_chunk(chunk):
+        names = [row['name'] for _, row, _ in chunk if row]
+        existing = set()
+        if names:
+            existing = {name for (name,) in db.session.query(Client.name).filter(Client.name.in_(names))}
+        inserts, created = [], []
+        for entry, row, errors in chunk:
+            if row is None:
+                entry.update(status='error', errors=errors)
+            elif row['name'] in existing:
+                entry.update(status='duplicate', errors=['Ya existe un cliente con ese nombre'])
+            elif row['name'] in seen:
+                entry.update(status='duplicate', errors=['Nombre repetido en el archivo'])
+            else:
+                seen.add(row['name'])
+                inserts.append(row)
+                created.append(entry)
+                entry['status'] = 'created'
+        if inserts and not dry_run:
+            try:
+                # render_nulls: sin él el ORM omite las claves None y parte el lote en muchos INSERT
+                db.session.execute(db.insert(Client).execution_options(render_nulls=True), inserts)
+                bump_data_versions(db.session, ['clients'])
+                db.session.commit()
+            except IntegrityError:
+                # Otro usuario dio de alta alguno de estos nombres mientras tanto
+                db.session.rollback()
+                for entry in created:
+                    entry.update(status='error', errors=['Conflicto al guardar el bloque; vuelve a importar esta fila'])
+        for entry in (e for e, _, _ in chunk):
+            summary[{'created': 'created', 'duplicate': 'duplicates', 'error': 'errors'}[entry['status']]] += 1
+        if progress:
+            progress(summary['rows'])
+
+    chunk = []
+    for line_no, raw in enumerate(raw_rows, start=2):
+        values = {col: raw[i] for i, col in enumerate(columns) if col and i < len(raw)}
+        if not any(v not in (None, '') for v in values.values()):
+            continue
+        row, errors = _client_import_row(values)
+        entry = {'line': line_no, 'name': _import_cell_text(values.get('name')), 'status': None, 'errors': []}
+        report.append(entry)
+        summary['rows'] += 1
+        chunk.append((entry, row, errors))
+        if len(chunk) >= CLIENT_IMPORT_CHUNK:
+            flush_chunk(chunk)
+            chunk = []
+    if chunk:
+        flush_chunk(chunk)
+    return summary, report
+
+@job_handler('import_clients')
+def import_clients_job(ctx, path, filename, dry_run=False):
+    """Importación de clientes en segundo plano. En result quedan el resumen y solo las
+    filas no importadas (repetidas o con errores): con miles de altas el resto no aporta."""
+    try:
+        with open(path, 'rb') as stream:
+            header, raw_rows = _read_import_rows(stream, filename)
+            summary, report = import_client_rows(
+                header, raw_rows, dry_run,
+                progress=lambda done: ctx.progress(done, message=f'{done} filas procesadas'))
+    finally:
+        os.remove(path)
+
+    if not summary['rows']:
+        msg = 'El archivo no contiene filas'
+    elif dry_run:
+        msg = f'Validación: {summary["created"]} clientes nuevos, {summary["duplicates"]} repetidos, {summary["errors"]} con errores'
+    else:
+        msg = f'{summary["created"]} clientes importados ({summary["duplicates"]} repetidos, {summary["errors"]} con errores)'
+    ctx.progress(summary['rows'], total=summary['rows'], message=msg)
+    return {
+        'success': bool(summary['rows']),
+        'applied': not dry_run and summary['created'] > 0,
+        'msg': msg,
+        'summary': summary,
+        'rows': [r for r in report if r['status'] != 'created'],
+    }
+
 @app.route('/import_clients', methods=['POST'])
 @login_required
 def import_clients():
-    """Importar clientes desde CSV"""
+    """Encola la importación de clientes desde CSV (',' o ';') o XLSX; dry_run=1 solo valida.
+    Responde 202 con job_id: el progreso y el resultado se consultan en /api/jobs/<id>."""
     if current_user.role != 'admin':
-        flash('No tienes permiso para realizar esta acción', 'error')
-        return redirect(url_for('dashboard'))
-    
+        return jsonify({'success': False, 'msg': 'No autorizado'}), 403
+
+    file = request.files.get('file')
+    if not file or not file.filename:
+        return jsonify({'success': False, 'msg': 'No se envió ningún archivo'}), 400
+    if not file.filename.lower().endswith(('.csv', '.txt', '.xlsx')):
+        return jsonify({'success': False, 'msg': 'Solo se aceptan archivos CSV o XLSX'}), 400
+    dry_run = request.form.get('dry_run') in ('1', 'true', 'on')
+
+    job_id = secrets.token_hex(16)
+    ext = os.path.splitext(secure_filename(file.filename))[1].lower() or '.csv'
+    path = job_file(job_id, '.upload' + ext)
+    file.save(path)
+    # Validar la cabecera antes de encolar: el error llega al momento y no como trabajo fallido
     try:
-        if 'file' not in request.files:
-            return jsonify({'success': False, 'msg': 'No file provided'}), 400
-        
-        file = request.files['file']
-        if file.filename == '':
-            return jsonify({'success': False, 'msg': 'No file selected'}), 400
-        
-        if not file.filename.endswith(('.csv', '.txt')):
-            return jsonify({'success': False, 'msg': 'Solo se aceptan archivos CSV'}), 400
-        
-        import csv
-        import io
-        
-        stream = io.StringIO(file.stream.read().decode('UTF-8'), newline=None)
-        csv_data = csv.DictReader(stream)
-        
-        count = 0
-        errors = []
-        
-        for row in csv_data:
-            try:
-                # Validar campos requeridos
-                if not row.get('name') or not row.get('phone') or not row.get('email') or not row.get('address'):
-                    errors.append(f"Fila {count+1}: Faltan campos requeridos")
-                    continue
-                
-                # Evitar duplicados
-                existing = Client.query.filter_by(name=row['name']).first()
-                if existing:
-                    errors.append(f"Fila {count+1}: Cliente '{row['name']}' ya existe")
-                    continue
-                
-                client = Client(
-                    name=row['name'],
-                    phone=row['phone'],
-                    email=row['email'],
-                    address=row['address'],
-                    link=row.get('link', ''),
-                    notes=row.get('notes', ''),
-                    has_support=row.get('has_support', 'False').lower() == 'true',
-                    support_schedule=row.get('support_schedule', None)
-                )
-                db.session.add(client)
-                count += 1
-            except Exception as e:
-                errors.append(f"Fila {count+1}: {str(e)}")
-        
-        db.session.commit()
-        return jsonify({'success': True, 'msg': f'{count} clientes importados', 'errors': errors})
+        with open(path, 'rb') as stream:
+            header, _ = _read_import_rows(stream, file.filename)
+            columns = [CLIENT_IMPORT_COLUMNS.get(normalize_search_text(str(h or ''))) for h in header]
     except Exception as e:
+        os.remove(path)
+        return jsonify({'success': False, 'msg': f'No se pudo leer el archivo: {e}'}), 400
+    if 'name' not in columns:
+        os.remove(path)
+        return jsonify({'success': False, 'msg': 'El archivo necesita una columna "nombre"'}), 400
+    try:
+        job = submit_job('import_clients', {'path': path, 'filename': file.filename, 'dry_run': dry_run},
+                         user_id=current_user.id, job_id=job_id, message='En cola')
+    except SQLAlchemyError as e:
         db.session.rollback()
-        return jsonify({'success': False, 'msg': str(e)}), 500
+        os.remove(path)
+        print(f"Error SQLAlchemy en import_clients: {e}")
+        return jsonify({'success': False, 'msg': 'Error al guardar en la base de datos'}), 500
+    return jsonify({'success': True, 'job_id': job.id, 'msg': 'Importación en curso'}), 202
 
 
 @app.route('/api/client/<int:client_id>/support_info', methods=['GET'])
@@ -3421,7 +6144,7 @@ def admin_tech_tasks(tech_id):
     if current_user.role != 'admin':
         return jsonify([])
     
-    tasks = Task.query.filter_by(tech_id=tech_id).all()
+    tasks = calendar_task_query().filter_by(tech_id=tech_id).all()
     events = []
     
     for task in tasks:
@@ -3460,48 +6183,17 @@ def get_tech_tasks():
         if current_user.role != 'tech':
             return jsonify([]), 403
         
-        # Tareas donde es técnico principal
+        # Tareas propias, como técnico secundario y sin asignar (una sola consulta)
         try:
-            primary_tasks = Task.query.filter_by(tech_id=current_user.id).all()
+            all_tasks = tech_agenda_query(current_user.id).all()
         except Exception as e:
-            print(f"Error cargando tareas primarias del técnico {current_user.id}: {e}")
-            primary_tasks = []
-        
-        # Tareas donde es técnico secundario
-        try:
-            secondary_task_ids = db.session.query(TaskTechnician.task_id).filter_by(user_id=current_user.id).all()
-            secondary_task_ids = [r[0] for r in secondary_task_ids]
-            secondary_tasks = Task.query.filter(Task.id.in_(secondary_task_ids)).all() if secondary_task_ids else []
-        except Exception as e:
-            print(f"Error cargando tareas secundarias del técnico {current_user.id}: {e}")
-            secondary_tasks = []
-        
-        # Combinar (sin duplicados)
-        task_ids = set([t.id for t in primary_tasks] + [t.id for t in secondary_tasks])
-
-        # Incluir tareas sin técnico asignado para que cualquier técnico las vea
-        try:
-            unassigned_ids = [t.id for t in Task.query.filter(
-                Task.tech_id == None, Task.status == 'Sin asignar').all()]
-            task_ids.update(unassigned_ids)
-        except Exception as e:
-            print(f"Error cargando tareas sin asignar: {e}")
-
-        try:
-            all_tasks = Task.query.filter(Task.id.in_(task_ids)).all() if task_ids else []
-        except Exception as e:
-            print(f"Error cargando tareas combinadas del técnico {current_user.id}: {e}")
+            print(f"Error cargando tareas del técnico {current_user.id}: {e}")
             all_tasks = []
         
         events = []
         for task in all_tasks:
             try:
-                service_type = None
-                try:
-                    if task.service_type_id:
-                        service_type = ServiceType.query.get(task.service_type_id)
-                except Exception as e:
-                    print(f"Error cargando servicio de tarea {task.id}: {e}")
+                service_type = task.service_type  # precargado con joinedload
                 
                 color = service_type.color if service_type else '#6c757d'
                 
@@ -3676,10 +6368,12 @@ def create_task_unassigned():
 def edit_appointment(task_id):
     """Endpoint para editar una cita existente"""
     try:
-        task = Task.query.get_or_404(task_id)
+        task, caps = task_access(task_id)
+        if not task:
+            abort(404)
         
         # Verificar permisos
-        if current_user.role != 'admin' and task.tech_id != current_user.id:
+        if 'edit' not in caps:
             flash('No autorizado', 'danger')
             return redirect(url_for('dashboard'))
         
@@ -3890,7 +6584,11 @@ def api_get_stock_category(category_id):
 def api_get_task_attachments(task_id):
     """API para obtener archivos adjuntos de una tarea"""
     try:
-        task = Task.query.get_or_404(task_id)
+        task, caps = task_access(task_id)
+        if not task:
+            abort(404)
+        if 'view' not in caps:
+            return jsonify({'success': False, 'msg': 'No autorizado'}), 403
         
         attachments_list = []
         if task.attachments:
@@ -3963,7 +6661,9 @@ def api_get_client(client_id):
                 'link': client.link or '',
                 'notes': client.notes or '',
                 'has_support': client.has_support,
-                'support_schedule': client.support_schedule or 'lv'
+                'support_schedule': client.support_schedule or 'lv',
+                'remote_hours_limit': client.remote_hours_limit,
+                'remote_hours_default': REMOTE_HOURS_DEFAULT_LIMIT
             }
         })
     except Exception as e:
@@ -4135,10 +6835,22 @@ def api_client_work_hours_alias(client_id):
         return jsonify({'success': False, 'msg': str(e)}), 500
 
 
+def _load_client_service_years(client_id):
+    rows = db.session.query(db.extract('year', Task.date).label('yr')) \
+        .filter(Task.client_id == client_id, Task.date.isnot(None)).distinct().all()
+    return tuple(sorted((int(r.yr) for r in rows), reverse=True))
+
+# Años con partes de cada cliente (selector del historial); se recalcula al cambiar cualquier tarea
+client_years_cache = CacheRegion('client_service_years', ('tasks',), max_entries=512)
+
+def client_service_years(client_id):
+    return client_years_cache.get(client_id, lambda: _load_client_service_years(client_id))
+
 @app.route('/api/client/<int:client_id>/service_history')
 @login_required
 def api_client_service_history(client_id):
-    """Devuelve el historial completo de servicios (partes) realizados para un cliente"""
+    """Historial de servicios (partes) de un cliente, paginado por cursor (paginate_keyset):
+    los más recientes primero; cursor y per_page para seguir cargando"""
     try:
         client = Client.query.get_or_404(client_id)
 
@@ -4146,18 +6858,28 @@ def api_client_service_history(client_id):
         year  = request.args.get('year',  type=int)
         month = request.args.get('month', type=int)
         status_filter = request.args.get('status', 'all')  # 'all', 'Completado', 'Pendiente'
+        if month is not None and not 1 <= month <= 12:
+            month = None
+        # period_bounds necesita el año siguiente: date(9999 + 1, ...) no existe
+        if year is not None and not date.min.year <= year < date.max.year:
+            return jsonify({'success': False, 'msg': 'Año no válido'}), 400
 
-        query = Task.query.filter(Task.client_id == client_id)
+        query = Task.query.filter(Task.client_id == client_id).options(
+            joinedload(Task.tech), joinedload(Task.service_type),
+            selectinload(Task.extra_technicians).joinedload(TaskTechnician.user),
+            defer(Task.signature_data), undefer(Task.has_signature))
 
         if status_filter != 'all':
             query = query.filter(Task.status == status_filter)
 
         if year:
-            query = query.filter(db.extract('year', Task.date) == year)
-        if month:
+            start, end = period_bounds(year, month)
+            query = query.filter(Task.date >= start, Task.date < end)
+        elif month:
+            # Un mes de todos los años no es un rango; el filtro por cliente ya acota las filas
             query = query.filter(db.extract('month', Task.date) == month)
 
-        tasks = query.order_by(Task.date.desc()).all()
+        tasks, meta = paginate_keyset(query, {'date': Task.date}, 'date', Task.id)
 
         task_list = []
         for task in tasks:
@@ -4190,22 +6912,17 @@ def api_client_service_history(client_id):
                 'status':       task.status,
                 'duration':     duration_str,
                 'is_remote':    task.is_remote,
-                'has_signature': bool(task.signature_data),
+                'has_signature': bool(task.has_signature),
                 'parts_text':   task.parts_text or '',
             })
 
-        # Años disponibles para el filtro
-        available_years = db.session.query(
-            db.extract('year', Task.date).label('yr')
-        ).filter(Task.client_id == client_id, Task.date != None).distinct().order_by(db.text('yr desc')).all()
-        available_years = [int(r.yr) for r in available_years]
-
         return jsonify({
             'success': True,
             'client_name': client.name,
-            'total': len(task_list),
             'tasks': task_list,
-            'available_years': available_years,
+            # Años disponibles para el filtro
+            'available_years': list(client_service_years(client_id)),
+            **meta,
         })
     except Exception as e:
         return jsonify({'success': False, 'msg': str(e)}), 500
@@ -4256,8 +6973,12 @@ def _run_migration(conn, sql, description=""):
         except Exception:
             pass
         err_str = str(e).lower()
+        # SQLite no abre transacción para algunas DDL (CREATE INDEX): el COMMIT falla pero la sentencia se aplicó
+        if 'no transaction is active' in err_str:
+            if description:
+                print(f"✓ {description}")
         # Errores esperados: columna/tabla ya existe
-        if any(x in err_str for x in ['already exists', 'duplicate column', 'ya existe']):
+        elif any(x in err_str for x in ['already exists', 'duplicate column', 'ya existe']):
             if description:
                 print(f"ℹ  Ya existe: {description} (ignorado)")
         else:
@@ -4266,6 +6987,7 @@ def _run_migration(conn, sql, description=""):
 
 def initialize_database():
     """Inicializar BD y migraciones. Se ejecuta siempre (gunicorn + python directo)."""
+    global FTS_PG_CONFIG, live_events
     with app.app_context():
         # 1. Crear todas las tablas definidas en los modelos (seguro, idempotente)
         db.create_all()
@@ -4273,11 +6995,17 @@ def initialize_database():
         # 2. Migraciones DDL — cada una en su propia transacción limpia
         is_pg = db.engine.dialect.name == 'postgresql'
         is_sqlite = db.engine.dialect.name == 'sqlite'
+        live_events = (PostgresEventBackend if is_pg else LocalEventBackend)(live_broker)
 
         with db.engine.connect() as conn:
             # Forzar autocommit desactivado y comenzar limpio
             conn.execute(db.text("ROLLBACK")) if is_pg else None
 
+            # SQLite (desarrollo): WAL para que las lecturas largas (exportaciones, trabajos en
+            # segundo plano) no bloqueen las escrituras de otras conexiones
+            if is_sqlite:
+                _run_migration(conn, 'PRAGMA journal_mode=WAL', "SQLite en modo WAL")
+
             # --- USER ---
             if is_pg:
                 _run_migration(conn, 'DROP INDEX IF EXISTS ix_user_email', "Drop ix_user_email")
@@ -4288,13 +7016,29 @@ def initialize_database():
             # --- CLIENT ---
             _run_migration(conn, 'ALTER TABLE client ADD COLUMN link VARCHAR(500)', "client.link")
             _run_migration(conn, 'ALTER TABLE client ADD COLUMN support_schedule VARCHAR(5)', "client.support_schedule")
+            _run_migration(conn, 'ALTER TABLE client ADD COLUMN remote_hours_limit FLOAT', "client.remote_hours_limit")
             # Hacer email y address opcionales en PostgreSQL (SQLite ya permite NULL)
             if is_pg:
                 _run_migration(conn, 'ALTER TABLE client ALTER COLUMN email DROP NOT NULL', "client.email nullable")
                 _run_migration(conn, 'ALTER TABLE client ALTER COLUMN address DROP NOT NULL', "client.address nullable")
 
+            _run_migration(conn, 'ALTER TABLE client ADD COLUMN name_search VARCHAR(100)', "client.name_search")
+            _run_migration(conn, 'CREATE INDEX IF NOT EXISTS ix_client_name_search ON client (name_search)', "ix_client_name_search")
+
             # --- STOCK ---
             _run_migration(conn, 'ALTER TABLE stock ADD COLUMN supplier VARCHAR(100)', "stock.supplier")
+            _run_migration(conn, 'ALTER TABLE stock ADD COLUMN name_search VARCHAR(100)', "stock.name_search")
+            _run_migration(conn, 'CREATE INDEX IF NOT EXISTS ix_stock_name_search ON stock (name_search)', "ix_stock_name_search")
+
+            # --- BÚSQUEDA: índices trigram (PostgreSQL) para LIKE '%q%' ---
+            if is_pg:
+                _run_migration(conn, 'CREATE EXTENSION IF NOT EXISTS pg_trgm', "Extensión pg_trgm")
+                _run_migration(conn,
+                    'CREATE INDEX IF NOT EXISTS ix_client_name_search_trgm ON client USING gin (name_search gin_trgm_ops)',
+                    "ix_client_name_search_trgm")
+                _run_migration(conn,
+                    'CREATE INDEX IF NOT EXISTS ix_stock_name_search_trgm ON stock USING gin (name_search gin_trgm_ops)',
+                    "ix_stock_name_search_trgm")
 
             # --- TASK: nuevas columnas ---
             _run_migration(conn, 'ALTER TABLE task ADD COLUMN work_duration VARCHAR(20)', "task.work_duration")
@@ -4306,6 +7050,16 @@ def initialize_database():
             _run_migration(conn, 'ALTER TABLE task ADD COLUMN parte_work_start VARCHAR(10)', "task.parte_work_start")
             _run_migration(conn, 'ALTER TABLE task ADD COLUMN parte_work_end VARCHAR(10)', "task.parte_work_end")
 
+            # --- TASK: índices de la agenda del técnico ---
+            _run_migration(conn, 'CREATE INDEX IF NOT EXISTS ix_task_tech_status_date ON task (tech_id, status, date)', "ix_task_tech_status_date")
+            # ix_task_status_date_id cubre (status, date) y además el desempate por id de los cursores
+            _run_migration(conn, 'CREATE INDEX IF NOT EXISTS ix_task_status_date_id ON task (status, date, id)', "ix_task_status_date_id")
+            _run_migration(conn, 'DROP INDEX IF EXISTS ix_task_status_date', "Drop ix_task_status_date")
+            _run_migration(conn, 'CREATE INDEX IF NOT EXISTS ix_task_date_id ON task (date, id)', "ix_task_date_id")
+            _run_migration(conn, 'CREATE INDEX IF NOT EXISTS ix_task_client_date_id ON task (client_id, date, id)', "ix_task_client_date_id")
+            _run_migration(conn, 'CREATE INDEX IF NOT EXISTS ix_task_technician_user_task ON task_technician (user_id, task_id)', "ix_task_technician_user_task")
+            _run_migration(conn, 'CREATE INDEX IF NOT EXISTS ix_task_technician_task ON task_technician (task_id)', "ix_task_technician_task")
+
             # --- TASK: hacer nullable tech_id y date en PostgreSQL ---
             if is_pg:
                 _run_migration(conn, 'ALTER TABLE task ALTER COLUMN tech_id DROP NOT NULL', "task.tech_id nullable")
@@ -4316,11 +7070,117 @@ def initialize_database():
                     'FOREIGN KEY (created_by) REFERENCES "user"(id) ON DELETE SET NULL',
                     "task.created_by FK")
 
+            # --- TASK: búsqueda de texto completo ---
+            if is_pg:
+                _run_migration(conn, 'CREATE EXTENSION IF NOT EXISTS unaccent', "Extensión unaccent")
+                _run_migration(conn, 'CREATE TEXT SEARCH CONFIGURATION oslaprint_es (COPY = spanish)', "FTS config oslaprint_es")
+                _run_migration(conn,
+                    'ALTER TEXT SEARCH CONFIGURATION oslaprint_es '
+                    'ALTER MAPPING FOR hword, hword_part, word WITH unaccent, spanish_stem',
+                    "FTS oslaprint_es sin acentos")
+                if conn.execute(db.text("SELECT 1 FROM pg_ts_config WHERE cfgname = 'oslaprint_es'")).first():
+                    FTS_PG_CONFIG = 'oslaprint_es'
+                conn.execute(db.text("ROLLBACK"))
+                _run_migration(conn,
+                    'ALTER TABLE task ADD COLUMN search_tsv tsvector GENERATED ALWAYS AS ('
+                    f"setweight(to_tsvector('{FTS_PG_CONFIG}', coalesce(client_name, '')), 'A') || "
+                    f"setweight(to_tsvector('{FTS_PG_CONFIG}', coalesce(signature_client_name, '')), 'A') || "
+                    f"setweight(to_tsvector('{FTS_PG_CONFIG}', coalesce(description, '')), 'B') || "
+                    f"setweight(to_tsvector('{FTS_PG_CONFIG}', coalesce(parts_text, '')), 'C')"
+                    ') STORED',
+                    "task.search_tsv")
+                _run_migration(conn, 'CREATE INDEX IF NOT EXISTS ix_task_search_tsv ON task USING gin (search_tsv)', "ix_task_search_tsv")
+            elif is_sqlite:
+                fts_exists = conn.execute(db.text(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'task_fts'")).first()
+                _run_migration(conn,
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS task_fts USING fts5("
+                    "client_name, description, parts_text, signature_client_name, "
+                    "content='task', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+                    "task_fts (FTS5)")
+                _run_migration(conn,
+                    "CREATE TRIGGER IF NOT EXISTS task_fts_ai AFTER INSERT ON task BEGIN "
+                    "INSERT INTO task_fts(rowid, client_name, description, parts_text, signature_client_name) "
+                    "VALUES (new.id, new.client_name, new.description, new.parts_text, new.signature_client_name); END",
+                    "task_fts trigger insert")
+                _run_migration(conn,
+                    "CREATE TRIGGER IF NOT EXISTS task_fts_ad AFTER DELETE ON task BEGIN "
+                    "INSERT INTO task_fts(task_fts, rowid, client_name, description, parts_text, signature_client_name) "
+                    "VALUES ('delete', old.id, old.client_name, old.description, old.parts_text, old.signature_client_name); END",
+                    "task_fts trigger delete")
+                _run_migration(conn,
+                    "CREATE TRIGGER IF NOT EXISTS task_fts_au AFTER UPDATE OF "
+                    "client_name, description, parts_text, signature_client_name ON task BEGIN "
+                    "INSERT INTO task_fts(task_fts, rowid, client_name, description, parts_text, signature_client_name) "
+                    "VALUES ('delete', old.id, old.client_name, old.description, old.parts_text, old.signature_client_name); "
+                    "INSERT INTO task_fts(rowid, client_name, description, parts_text, signature_client_name) "
+                    "VALUES (new.id, new.client_name, new.description, new.parts_text, new.signature_client_name); END",
+                    "task_fts trigger update")
+                if not fts_exists:
+                    _run_migration(conn, "INSERT INTO task_fts(task_fts) VALUES ('rebuild')", "task_fts indexado inicial")
+
             # --- PAYMENT_RECORD: is_paid ---
             _run_migration(conn, 'ALTER TABLE payment_record ADD COLUMN is_paid BOOLEAN NOT NULL DEFAULT FALSE', "payment_record.is_paid")
 
+            # --- CLIENT_PAYMENT: saldo materializado ---
+            _run_migration(conn, 'ALTER TABLE client_payment ADD COLUMN paid_total FLOAT NOT NULL DEFAULT 0', "client_payment.paid_total")
+            _run_migration(conn, 'ALTER TABLE client_payment ADD COLUMN pending_total FLOAT NOT NULL DEFAULT 0', "client_payment.pending_total")
+            _run_migration(conn, 'ALTER TABLE client_payment ADD COLUMN status VARCHAR(10)', "client_payment.status")
+            _run_migration(conn, 'CREATE INDEX IF NOT EXISTS ix_client_payment_status_pending ON client_payment (status, pending_total)', "ix_client_payment_status_pending")
+            _run_migration(conn, 'ALTER TABLE job ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0', "job.attempts")
+            _run_migration(conn, 'ALTER TABLE change_log ADD COLUMN user_id INTEGER', "change_log.user_id")
+
         print("✓ Migraciones completadas")
 
+        # Rellenar name_search en filas anteriores a la columna
+        for model in (Client, Stock):
+            pending = model.query.filter(model.name_search == None).all()
+            for row in pending:
+                row.name_search = normalize_search_text(row.name)[:100]
+            if pending:
+                db.session.commit()
+                print(f"✓ name_search rellenado en {len(pending)} filas de {model.__tablename__}")
+
+        # Saldo materializado de pagos anteriores a las columnas (status NULL = sin calcular)
+        stale = ClientPayment.query.filter(ClientPayment.status == None).all()
+        for payment in stale:
+            refresh_client_balance(payment)
+        if stale:
+            db.session.commit()
+            print(f"✓ Saldo calculado en {len(stale)} pagos de clientes")
+
+        # Consumo de soporte remoto de asistencias anteriores al registro mensual
+        if ClientRemoteUsage.query.first() is None:
+            rebuilt = reconcile_remote_usage(fix=True)
+            if rebuilt:
+                print(f"✓ Consumo de soporte remoto calculado en {len(rebuilt)} meses de clientes")
+
+        # Movimientos de stock de partes anteriores al registro de movimientos
+        if StockMovement.query.first() is None:
+            legacy = Task.query.filter(
+                Task.stock_item_id != None,
+                Task.stock_quantity_used > 0,
+                Task.stock_action.in_(STOCK_CONSUMPTION_ACTIONS)
+            ).all()
+            movements = [{
+                'stock_id': t.stock_item_id,
+                'task_id': t.id,
+                'user_id': t.tech_id,
+                'quantity': t.stock_quantity_used if t.stock_action == 'devolver' else -t.stock_quantity_used,
+                'action': t.stock_action,
+                'created_at': datetime.combine(t.date, datetime.min.time()) if t.date else datetime.now(),
+            } for t in legacy]
+            if movements:
+                db.session.execute(db.insert(StockMovement), movements)
+                db.session.commit()
+                print(f"✓ {len(movements)} movimientos de stock importados de partes anteriores")
+
+        # Filas de data_version para los conjuntos versionados (y el suelo de change_log)
+        for name in set(VERSIONED_MODELS.values()) | {'change_log'}:
+            if not db.session.get(DataVersion, name):
+                db.session.add(DataVersion(name=name, version=0))
+        db.session.commit()
+
         # Usuarios de prueba
         if not User.query.filter_by(username='admin').first():
             db.session.add(User(
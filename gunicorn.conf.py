@@ -0,0 +1,18 @@
+# Configuración de gunicorn: se carga sola al arrancar desde la raíz del proyecto
+# (gunicorn app:app lee ./gunicorn.conf.py). Las opciones de la línea de comandos mandan.
+import os
+
+# Workers con hilos: /api/events/stream mantiene la conexión abierta hasta
+# SSE_MAX_STREAM_SECONDS. Un worker síncrono quedaría bloqueado por cada panel abierto y,
+# sin poder avisar al master, moriría al superar timeout; con gthread cada stream ocupa un
+# hilo (como mucho SSE_MAX_STREAMS por worker) y el worker sigue atendiendo peticiones.
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_CONCURRENCY', '2'))
+threads = int(os.environ.get('GUNICORN_THREADS', '16'))
+
+
+def post_worker_init(worker):
+    """Arranca el pool de trabajos en cada worker recién creado (nunca en el master, antes
+    del fork), para que recoja lo encolado o interrumpido sin esperar a una petición."""
+    from app import job_runner
+    job_runner.start()